@@ -1,30 +1,66 @@
 #!/usr/bin/python
 
 import socket  
+import sys
 import time
 import fcntl
 import re
 import os
 import errno
 import struct
-from threading import Thread
+import select
+import heapq
+import math
+import json
+from threading import Thread, Lock, RLock, Condition, current_thread
 from time import sleep
-from collections import OrderedDict
+from collections import OrderedDict, deque, namedtuple
 
-detected_bulbs = {}
-bulb_idx2ip = {}
 DEBUGGING = False
 RUNNING = True
 current_command_id = 0
 MCAST_GRP = '239.255.255.250'
+MCAST_PORT = 1982
+# the option number differs between platforms (15 on linux, 0x200 on the BSDs and macOS); where the
+# socket module does not export it the option is skipped, SO_REUSEADDR alone shares a UDP port on linux
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", None)
+CONNECT_TIMEOUT = 3
+SEARCH_INTERVAL = 30
+MIN_SEARCH_INTERVAL = 2
+SEARCH_BACKOFF = 2
+DEDUP_WINDOW = 1.0
+# answers of a large fleet arrive in a burst, the default buffer only holds a few hundred
+DISCOVERY_RCVBUF = 1 << 20
+SEARCH_MESSAGE = "M-SEARCH * HTTP/1.1\r\n" \
+  + "HOST: 239.255.255.250:1982\r\n" \
+  + "MAN: \"ssdp:discover\"\r\n" \
+  + "ST: wifi_bulb"
+# properties synced on connect and tracked from replies/NOTIFY, with their types
+STATE_PROPS = OrderedDict([("power", str), ("bright", int), ("ct", int), ("rgb", int),
+  ("hue", int), ("sat", int), ("color_mode", int), ("name", str)])
+MAX_PENDING_COMMANDS = 64
+# the event loop leaves a connection a sender thread is busy with for this many seconds
+READ_RETRY_DELAY = 0.05
+# a bulb accepts at most this many commands per minute
+RATE_LIMIT = 60
+# requests arriving within this many seconds are merged into one write
+COALESCE_DELAY = 0.05
+# a bulb that did not report the state sent to it is sent it again after this many seconds,
+# doubling up to MAX_RETRY_DELAY
+RETRY_DELAY = 5
+MAX_RETRY_DELAY = 300
+# threads sending the flushes scheduled on an event loop, a connect to an unreachable bulb
+# holds one of them for CONNECT_TIMEOUT instead of the loop
+SEND_THREADS = 4
+# desired state property set by each command
+COMMAND_PROPS = OrderedDict([("set_power", "power"), ("set_ct_abx", "ct"), ("set_rgb", "rgb"), ("set_bright", "bright")])
+# properties following the kind of a set_scene command
+SCENE_PROPS = { "color" : ("rgb", "bright"), "ct" : ("ct", "bright"), "hsv" : ("hue", "sat", "bright") }
+# the color_mode in which a bulb shows its rgb, ct or hue/sat value
+COLOR_MODES = { "rgb" : 1, "ct" : 2, "hue" : 3 }
+bulb_state_listeners = []
+command_id_lock = Lock()
 
-scan_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) 
-fcntl.fcntl(scan_socket, fcntl.F_SETFL, os.O_NONBLOCK)
-listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-listen_socket.bind(("", 1982))
-fcntl.fcntl(listen_socket, fcntl.F_SETFL, os.O_NONBLOCK)
-mreq = struct.pack("4sl", socket.inet_aton(MCAST_GRP), socket.INADDR_ANY)
-listen_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
 
 def debug(msg):
   if DEBUGGING:
@@ -32,119 +68,1504 @@ def debug(msg):
 
 def next_cmd_id():
   global current_command_id
-  current_command_id += 1
-  return current_command_id
+  with command_id_lock:
+    current_command_id += 1
+    return current_command_id
     
+class Timer(object):
+  '''
+  Handle of a callback scheduled on an EventLoop.
+  '''
+  def __init__(self, when, callback, args, interval=None):
+    self.when = when
+    self.callback = callback
+    self.args = args
+    self.interval = interval
+    self.cancelled = False
+
+  def cancel(self):
+    self.cancelled = True
+
+class EventLoop(object):
+  '''
+  A poll() (select() where poll is missing) based reactor running readers, writers and
+  timers on a single thread. Other threads hand work over with call_soon_threadsafe().
+  One poller is kept for the life of the loop; adding and removing readers and writers
+  registers, modifies or unregisters their fd, so a wakeup costs nothing per idle file.
+  '''
+  def __init__(self):
+    self.readers = {}
+    self.writers = {}
+    self.timers = []
+    self.timer_seq = 0
+    self.pending = deque()
+    self.running = False
+    self.errors = 0        # callbacks that raised
+    self.wakeup_r, self.wakeup_w = os.pipe()
+    fcntl.fcntl(self.wakeup_r, fcntl.F_SETFL, os.O_NONBLOCK)
+    fcntl.fcntl(self.wakeup_w, fcntl.F_SETFL, os.O_NONBLOCK)
+    self.poller = select.poll() if hasattr(select, "poll") else None
+    self.files = {}        # fd -> fileobj registered with the poller
+    self.fds = {}          # fileobj -> fd, kept since a closed socket has no fileno()
+    if self.poller is not None:
+      self.poller.register(self.wakeup_r, select.POLLIN)
+
+  def add_reader(self, fileobj, callback, *args):
+    self.readers[fileobj] = (callback, args)
+    self.__update(fileobj)
+
+  def remove_reader(self, fileobj):
+    if self.readers.pop(fileobj, None) is not None:
+      self.__update(fileobj)
+
+  def add_writer(self, fileobj, callback, *args):
+    self.writers[fileobj] = (callback, args)
+    self.__update(fileobj)
+
+  def remove_writer(self, fileobj):
+    if self.writers.pop(fileobj, None) is not None:
+      self.__update(fileobj)
+
+  def __update(self, fileobj):
+    '''
+    Bring the poller registration of fileobj in line with its reader and writer.
+    '''
+    if self.poller is None:
+      return
+    mask = (select.POLLIN if fileobj in self.readers else 0) | (select.POLLOUT if fileobj in self.writers else 0)
+    fd = self.fds.get(fileobj)
+    if fd is None:
+      if not mask:
+        return
+      fd = fileno(fileobj)
+      if self.files.has_key(fd):
+        # the fd was closed behind our back and reused by fileobj
+        self.__forget(fd)
+    if not mask:
+      self.poller.unregister(fd)
+      del self.fds[fileobj]
+      del self.files[fd]
+    elif fileobj in self.fds:
+      self.poller.modify(fd, mask)
+    else:
+      self.poller.register(fd, mask)
+      self.fds[fileobj] = fd
+      self.files[fd] = fileobj
+
+  def call_later(self, delay, callback, *args):
+    timer = Timer(time.time() + delay, callback, args)
+    self.__push(timer)
+    return timer
+
+  def call_repeatedly(self, interval, callback, *args):
+    '''
+    Run callback now and then every interval seconds until the timer is cancelled.
+    '''
+    timer = Timer(time.time(), callback, args, interval)
+    self.__push(timer)
+    return timer
+
+  def call_soon_threadsafe(self, callback, *args):
+    self.pending.append((callback, args))
+    self.wakeup()
+
+  def wakeup(self):
+    try:
+      os.write(self.wakeup_w, "x")
+    except OSError:
+      pass # pipe full, the loop is awake anyway
+
+  def stop(self):
+    self.call_soon_threadsafe(self.__stop)
+
+  def close(self):
+    os.close(self.wakeup_r)
+    os.close(self.wakeup_w)
+
+  def run_forever(self):
+    self.running = True
+    while self.running:
+      self.__run_once()
+
+  def __stop(self):
+    self.running = False
+
+  def __push(self, timer):
+    self.timer_seq += 1
+    heapq.heappush(self.timers, (timer.when, self.timer_seq, timer))
+    if self.running:
+      self.wakeup()
+
+  def __run_callback(self, callback, args):
+    try:
+      callback(*args)
+    except Exception as e:
+      self.errors += 1
+      print "Unexpected error:", e
+
+  def __forget(self, fd):
+    fileobj = self.files.pop(fd)
+    self.readers.pop(fileobj, None)
+    self.writers.pop(fileobj, None)
+    self.fds.pop(fileobj, None)
+    self.poller.unregister(fd)
+
+  def __select(self, timeout):
+    '''
+    Wait for readable and writable files. poll() has no FD_SETSIZE limit, and neither
+    has is_readable() the connections read with, so a fleet of thousands of bulb
+    connections fits on one loop.
+    '''
+    if self.poller is None:
+      readable, writable, _ = select.select(self.readers.keys() + [self.wakeup_r], self.writers.keys(), [], timeout)
+      return readable, writable
+    events = self.poller.poll(None if timeout is None else int(math.ceil(timeout * 1000)))
+    readable, writable = [], []
+    for fd, event in events:
+      if fd == self.wakeup_r:
+        readable.append(self.wakeup_r)
+        continue
+      fileobj = self.files.get(fd)
+      if event & select.POLLNVAL:
+        # closed behind our back
+        self.__forget(fd)
+        continue
+      if fileobj in self.readers and event & (select.POLLIN | select.POLLERR | select.POLLHUP):
+        readable.append(fileobj)
+      if fileobj in self.writers and event & (select.POLLOUT | select.POLLERR | select.POLLHUP):
+        writable.append(fileobj)
+    return readable, writable
+
+  def __run_once(self):
+    while self.timers and self.timers[0][2].cancelled:
+      heapq.heappop(self.timers)
+    timeout = None
+    if self.pending:
+      timeout = 0
+    elif self.timers:
+      timeout = max(0, self.timers[0][0] - time.time())
+    try:
+      readable, writable = self.__select(timeout)
+    except (select.error, socket.error, ValueError):
+      # a file was closed behind our back; drop it and retry
+      for fileobj in self.readers.keys() + self.writers.keys():
+        try:
+          os.fstat(fileno(fileobj))
+        except (socket.error, OSError, ValueError):
+          self.remove_reader(fileobj)
+          self.remove_writer(fileobj)
+      return
+    for fileobj in writable:
+      if fileobj in self.writers:
+        callback, args = self.writers[fileobj]
+        self.__run_callback(callback, (fileobj,) + args)
+    for fileobj in readable:
+      if fileobj == self.wakeup_r:
+        try:
+          os.read(self.wakeup_r, 4096)
+        except OSError:
+          pass
+        continue
+      if fileobj in self.readers:
+        callback, args = self.readers[fileobj]
+        self.__run_callback(callback, (fileobj,) + args)
+    while self.pending:
+      callback, args = self.pending.popleft()
+      self.__run_callback(callback, args)
+    now = time.time()
+    while self.timers and self.timers[0][0] <= now:
+      _, _, timer = heapq.heappop(self.timers)
+      if timer.cancelled:
+        continue
+      self.__run_callback(timer.callback, timer.args)
+      if timer.interval is not None and not timer.cancelled:
+        timer.when = max(timer.when + timer.interval, now)
+        self.__push(timer)
+
+def fileno(fileobj):
+  return fileobj if isinstance(fileobj, (int, long)) else fileobj.fileno()
+
+def is_readable(sock):
+  '''
+  True when a recv() on sock returns right away: data, the end of the stream or an
+  error. Asks poll() where there is one, select() fails on fds past FD_SETSIZE.
+  '''
+  if not hasattr(select, "poll"):
+    return bool(select.select([sock], [], [], 0)[0])
+  poller = select.poll()
+  poller.register(sock, select.POLLIN)
+  return bool(poller.poll(0))
+
 def send_search_broadcast():
   '''
   multicast search request to all hosts in LAN, do not wait for response
   '''
-  multicase_address = (MCAST_GRP, 1982) 
+  if bulb_discovery.loop is not None:
+    bulb_discovery.search_now()
+    return
   debug("send search request")
-  msg = "M-SEARCH * HTTP/1.1\r\n" 
-  msg = msg + "HOST: 239.255.255.250:1982\r\n"
-  msg = msg + "MAN: \"ssdp:discover\"\r\n"
-  msg = msg + "ST: wifi_bulb"
-  scan_socket.sendto(msg, multicase_address)
+  lan_transport.scan_socket().sendto(SEARCH_MESSAGE, lan_transport.multicast_address)
 
-def bulbs_detection_loop():
+def read_search_responses(sock):
   '''
-  a standalone thread broadcasting search request and listening on all responses
+  drain all pending datagrams of a non-blocking discovery socket
   '''
-  debug("bulbs_detection_loop running")
-  search_interval=30000
-  read_interval=100
-  time_elapsed=0
+  while True:
+    try:
+      data = sock.recv(2048)
+    except socket.error, e:
+      err = e.args[0]
+      if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
+        break
+      else:
+        print e
+        return
+    handle_search_response(data)
 
-  while RUNNING:
-    if time_elapsed%search_interval == 0:
-      send_search_broadcast()
+def open_scan_socket(interface=None):
+  '''
+  non-blocking socket sending search requests out of the interface with the given address
+  '''
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, DISCOVERY_RCVBUF)
+  fcntl.fcntl(sock, fcntl.F_SETFL, os.O_NONBLOCK)
+  if interface is not None:
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+    sock.bind((interface, 0))
+  return sock
 
-    # scanner
-    while True:
+def join_multicast_group(sock, interface, group=MCAST_GRP):
+  '''
+  receive advertisements of the bulbs behind the interface with the given address
+  '''
+  mreq = struct.pack("4s4s", socket.inet_aton(group), socket.inet_aton(interface))
+  try:
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+  except socket.error, e:
+    if e.args[0] != errno.EADDRINUSE: # already joined
+      raise
+
+class LanTransport(object):
+  '''
+  The UDP endpoints of discovery: a scan socket sending search requests and a listen
+  socket receiving advertisements on the multicast group. Nothing is opened before
+  first use. The listen socket is bound with SO_REUSEADDR/SO_REUSEPORT, so several
+  controller processes on one host all receive the advertisements; the addresses can
+  be changed to run against a simulator or another port.
+  '''
+  def __init__(self, listen_address=("", MCAST_PORT), multicast_address=(MCAST_GRP, MCAST_PORT), reuse_port=True):
+    self.listen_address = listen_address
+    self.multicast_address = multicast_address
+    self.reuse_port = reuse_port
+    self.lock = Lock()
+    self.scan = None
+    self.listen = None
+
+  def scan_socket(self):
+    with self.lock:
+      if self.scan is None:
+        self.scan = self.open_scan_socket()
+      return self.scan
+
+  def listen_socket(self):
+    with self.lock:
+      if self.listen is None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, DISCOVERY_RCVBUF)
+        if self.reuse_port and SO_REUSEPORT is not None:
+          sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind(self.listen_address)
+        fcntl.fcntl(sock, fcntl.F_SETFL, os.O_NONBLOCK)
+        if self.is_multicast():
+          join_multicast_group(sock, "0.0.0.0", self.multicast_address[0])
+        self.listen = sock
+      return self.listen
+
+  def open_scan_socket(self, interface=None):
+    return open_scan_socket(interface)
+
+  def is_multicast(self):
+    # searches may go to a unicast endpoint instead, e.g. a simulator
+    return 224 <= int(self.multicast_address[0].split(".")[0]) <= 239
+
+  def join(self, interface):
+    if self.is_multicast():
+      join_multicast_group(self.listen_socket(), interface, self.multicast_address[0])
+
+  def close(self):
+    with self.lock:
+      for sock in (self.scan, self.listen):
+        if sock is not None:
+          sock.close()
+      self.scan = self.listen = None
+
+lan_transport = LanTransport()
+
+class DiscoveryStats(object):
+  '''
+  Discovery latency (seconds from a search request to the first answer of each bulb) and counters.
+  '''
+  def __init__(self):
+    self.searches = 0
+    self.responses = 0
+    self.duplicates = 0
+    self.latencies = 0
+    self.latency_total = 0.0
+    self.latency_last = 0.0
+    self.latency_max = 0.0
+    self.interval = 0
+
+  def record_latency(self, elapsed):
+    self.latencies += 1
+    self.latency_total += elapsed
+    self.latency_last = elapsed
+    self.latency_max = max(self.latency_max, elapsed)
+
+  def as_dict(self):
+    return {
+      "searches" : self.searches,
+      "responses" : self.responses,
+      "duplicates" : self.duplicates,
+      "interval" : self.interval,
+      "latency_last" : self.latency_last,
+      "latency_avg" : self.latency_total / self.latencies if self.latencies else 0.0,
+      "latency_max" : self.latency_max,
+    }
+
+class BulbDiscovery(object):
+  '''
+  SSDP discovery on an event loop, with one scan socket per interface address
+  (None is the default interface).
+  Searches repeat every min_interval seconds while the set of answering bulbs changes
+  and back off up to max_interval once it is stable; a bulb showing up at a new
+  address brings the fast searches back. A datagram seen again within dedup_window
+  seconds (the same answer on another interface, a repeated advertisement) is dropped.
+  '''
+  def __init__(self, interfaces=None, min_interval=MIN_SEARCH_INTERVAL, max_interval=SEARCH_INTERVAL,
+               backoff=SEARCH_BACKOFF, dedup_window=DEDUP_WINDOW, transport=None):
+    self.interfaces = list(interfaces or [None])
+    self.transport = transport or lan_transport
+    self.min_interval = min_interval
+    self.max_interval = max_interval
+    self.backoff = backoff
+    self.dedup_window = dedup_window
+    self.interval = min_interval
+    self.loop = None
+    self.timer = None
+    self.scan_sockets = []
+    self.last_search = 0
+    self.round_started = None
+    self.round_ids = set()
+    self.previous_round_ids = None
+    self.known = {}
+    self.recent = {}
+    self.stats = DiscoveryStats()
+    # listener(data, bulb) is called with every datagram that was not a duplicate
+    self.listeners = []
+    # observer(seconds) is called with the time each of them took to parse and apply
+    self.parse_observers = []
+
+  def attach(self, loop):
+    self.loop = loop
+    self.interval = self.min_interval
+    self.scan_sockets = [self.transport.open_scan_socket(interface) for interface in self.interfaces]
+    for sock in self.scan_sockets:
+      loop.add_reader(sock, self.on_readable, True)
+    for interface in self.interfaces:
+      if interface is not None:
+        self.transport.join(interface)
+    loop.add_reader(self.transport.listen_socket(), self.on_readable, False)
+    self.timer = loop.call_later(0, self.search)
+
+  def detach(self):
+    if self.timer is not None:
+      self.timer.cancel()
+      self.timer = None
+    if self.loop is not None:
+      for sock in self.scan_sockets:
+        self.loop.remove_reader(sock)
+      if self.transport.listen is not None:
+        self.loop.remove_reader(self.transport.listen)
+    for sock in self.scan_sockets:
+      sock.close()
+    self.scan_sockets = []
+    self.round_started = None
+    self.loop = None
+
+  def search_now(self):
+    '''
+    Ask for a search from any thread; it is still held back to one per min_interval.
+    '''
+    self.interval = self.min_interval
+    self.loop.call_soon_threadsafe(self.schedule, 0)
+
+  def schedule(self, delay):
+    if self.loop is None:
+      return
+    if self.timer is not None:
+      self.timer.cancel()
+    delay = max(delay, self.last_search + self.min_interval - time.time())
+    self.timer = self.loop.call_later(max(0, delay), self.search)
+
+  def search(self):
+    self.finish_round()
+    debug("send search request")
+    for sock in self.scan_sockets:
       try:
-        data = scan_socket.recv(2048)
+        sock.sendto(SEARCH_MESSAGE, self.transport.multicast_address)
       except socket.error, e:
-        err = e.args[0]
-        if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
-            break
-        else:
-            print e
-            sys.exit(1)
-      handle_search_response(data)
+        print "search request failed:", e
+    now = time.time()
+    self.last_search = self.round_started = now
+    self.round_ids = set()
+    self.stats.searches += 1
+    for key in [key for key, seen in self.recent.items() if now - seen[0] >= self.dedup_window]:
+      del self.recent[key]
+    self.schedule(self.interval)
 
-    # passive listener 
+  def finish_round(self):
+    if self.round_started is None:
+      return
+    if self.round_ids != self.previous_round_ids:
+      self.interval = self.min_interval
+    else:
+      self.interval = min(self.interval * self.backoff, self.max_interval)
+    self.previous_round_ids = self.round_ids
+    self.stats.interval = self.interval
+
+  def on_readable(self, sock, solicited):
     while True:
       try:
-        data, addr = listen_socket.recvfrom(2048)
+        data = sock.recv(2048)
       except socket.error, e:
         err = e.args[0]
         if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
-            break
+          break
         else:
-            print e
-            sys.exit(1)
-      handle_search_response(data)
+          print e
+          return
+      self.handle(data, solicited)
+
+  def handle(self, data, solicited):
+    now = time.time()
+    key = hash(data)
+    seen = self.recent.get(key)
+    if seen is not None and now - seen[0] < self.dedup_window:
+      # already handled, it only counts as an answer to the current search
+      self.stats.duplicates += 1
+      bulb = seen[1]
+    else:
+      bulb = handle_search_response(data)
+      for observer in list(self.parse_observers):
+        observer(time.time() - now)
+      if bulb is None:
+        return
+      self.recent[key] = (now, bulb)
+      self.stats.responses += 1
+      for listener in list(self.listeners):
+        listener(data, bulb)
+    if solicited and self.round_started is not None and bulb.id not in self.round_ids:
+      self.round_ids.add(bulb.id)
+      self.stats.record_latency(now - self.round_started)
+    if self.known.get(bulb.id) != bulb.ip:
+      self.known[bulb.id] = bulb.ip
+      if self.interval > self.min_interval:
+        self.interval = self.min_interval
+        self.schedule(self.min_interval)
 
-    time_elapsed+=read_interval
-    sleep(read_interval/1000.0)
-  scan_socket.close()
-  listen_socket.close()
+  def latency_stats(self):
+    return self.stats.as_dict()
+
+bulb_discovery = BulbDiscovery()
+
+def attach_discovery(loop, search_interval=SEARCH_INTERVAL, interfaces=None, transport=None):
+  '''
+  Run bulb discovery on an event loop: the sockets are read as soon as data arrives and
+  search requests are sent at an adaptive interval of up to search_interval seconds, out
+  of every given interface address.
+  Returns the BulbDiscovery.
+  '''
+  bulb_discovery.max_interval = search_interval
+  bulb_discovery.interfaces = list(interfaces or [None])
+  bulb_discovery.transport = transport or lan_transport
+  bulb_discovery.attach(loop)
+  return bulb_discovery
+
+def detach_discovery(loop, discovery=bulb_discovery):
+  discovery.detach()
+
+def bulbs_detection_loop():
+  '''
+  a standalone thread broadcasting search request and listening on all responses
+  '''
+  debug("bulbs_detection_loop running")
+  loop = EventLoop()
+  discovery = attach_discovery(loop)
+  connection_pool.attach(loop)
+  command_queue.attach(loop)
+  def check_running():
+    if not RUNNING:
+      loop.stop()
+  loop.call_repeatedly(0.5, check_running)
+  loop.run_forever()
+  detach_discovery(loop, discovery)
+  command_queue.detach()
+  connection_pool.detach()
+  loop.close()
+  lan_transport.close()
+
+LOCATION_RE = re.compile("yeelight[^0-9]*([0-9]{1,3}(?:\.[0-9]{1,3}){3}):([0-9]*)")
+param_value_res = {}
+
+# every field advertised in a search response or NOTIFY, parsed once into its type
+SearchResponse = namedtuple("SearchResponse", ["ip", "port", "id", "model", "fw_ver", "support",
+  "power", "bright", "color_mode", "ct", "rgb", "hue", "sat", "name"])
 
 def get_param_value(data, param):
   '''
   match line of 'param = value'
   '''
-  param_re = re.compile(param+":\s*([ -~]*)") #match all printable characters
+  param_re = param_value_res.get(param)
+  if param_re is None:
+    param_re = re.compile(param+":\s*([ -~]*)") #match all printable characters
+    param_value_res[param] = param_re
   match = param_re.search(data)
   value=""
   if match != None:
     value = match.group(1)
     return value
-    
+
+def parse_int(value):
+  if value is None or not value.isdigit():
+    return None
+  return int(value)
+
+def parse_search_response(data):
+  '''
+  Parse all headers of a search response in a single pass.
+  Returns a SearchResponse, or None if there is no yeelight Location header.
+  '''
+  headers = {}
+  for line in data.split("\n"):
+    key, sep, value = line.partition(":")
+    if sep:
+      headers[key] = value.strip()
+  location = headers.get("Location") or headers.get("location") or headers.get("LOCATION")
+  if location is None:
+    return None
+  match = LOCATION_RE.search(location)
+  if match is None:
+    return None
+  get = headers.get
+  return SearchResponse(match.group(1), parse_int(match.group(2)), get("id", ""), get("model", ""),
+    parse_int(get("fw_ver")), get("support", "").split(), get("power", ""), parse_int(get("bright")),
+    parse_int(get("color_mode")), parse_int(get("ct")), parse_int(get("rgb")), parse_int(get("hue")),
+    parse_int(get("sat")), get("name", ""))
+
+class Bulb(object):
+  '''
+  One detected bulb. Bulbs published in a registry snapshot are never modified,
+  except last_seen which a search response refreshes in place; other updates
+  replace them with a changed copy.
+  '''
+  __slots__ = ("idx", "ip", "port", "last_seen") + SearchResponse._fields[2:]
+
+  def __init__(self, **fields):
+    for field in self.__slots__:
+      setattr(self, field, fields.get(field))
+
+  def copy(self, **changes):
+    fields = self.as_dict()
+    fields.update(changes)
+    return Bulb(**fields)
+
+  def as_dict(self):
+    return dict((field, getattr(self, field)) for field in self.__slots__)
+
+  def __repr__(self):
+    return "Bulb(" + ", ".join([field + "=" + repr(getattr(self, field)) for field in self.__slots__]) + ")"
+
+class BulbSnapshot(object):
+  '''
+  An immutable, versioned view of the registry with O(1) lookup by id, ip, name and idx.
+  '''
+  __slots__ = ("version", "by_id", "by_ip", "by_name", "by_idx")
+
+  def __init__(self, version, by_id, indexes=None):
+    self.version = version
+    self.by_id = by_id
+    if indexes is None:
+      self.by_ip = dict((bulb.ip, bulb) for bulb in by_id.itervalues())
+      self.by_name = dict((bulb.name, bulb) for bulb in by_id.itervalues() if bulb.name)
+      self.by_idx = dict((bulb.idx, bulb) for bulb in by_id.itervalues())
+    else:
+      self.by_ip, self.by_name, self.by_idx = indexes
+
+  def replace(self, version, old, new):
+    '''
+    The next snapshot with bulb old replaced by new (None to add or remove one),
+    copying the indexes instead of rebuilding them from every bulb.
+    '''
+    by_id, by_ip, by_name, by_idx = dict(self.by_id), dict(self.by_ip), dict(self.by_name), dict(self.by_idx)
+    if old is not None:
+      del by_id[old.id]
+      for index, key in ((by_ip, old.ip), (by_name, old.name), (by_idx, old.idx)):
+        if index.get(key) is old:
+          del index[key]
+    if new is not None:
+      by_id[new.id] = new
+      by_ip[new.ip] = new
+      by_idx[new.idx] = new
+      if new.name:
+        by_name[new.name] = new
+    return BulbSnapshot(version, by_id, (by_ip, by_name, by_idx))
+
+  def __len__(self):
+    return len(self.by_id)
+
+  def __iter__(self):
+    return iter(sorted(self.by_id.itervalues(), key=lambda bulb: bulb.idx))
+
+class BulbRegistry(object):
+  '''
+  Thread-safe registry of detected bulbs keyed by the bulb's own id header.
+  Writers serialize on a lock and publish a new snapshot; readers just take
+  the current snapshot and never lock.
+  The short idx used by the CLI is assigned once per bulb id and never reused.
+  '''
+  def __init__(self):
+    self.lock = Lock()
+    self.current = BulbSnapshot(0, {})
+    self.idx_by_id = {}
+    self.used_idx = set()
+    self.next_idx = 1
+
+  def snapshot(self):
+    return self.current
+
+  def get(self, bulb_id):
+    return self.current.by_id.get(bulb_id)
+
+  def get_by_ip(self, ip):
+    return self.current.by_ip.get(ip)
+
+  def get_by_name(self, name):
+    return self.current.by_name.get(name)
+
+  def get_by_idx(self, idx):
+    return self.current.by_idx.get(idx)
+
+  def __len__(self):
+    return len(self.current)
+
+  def __iter__(self):
+    return iter(self.current)
+
+  def publish(self, by_id):
+    self.current = BulbSnapshot(self.current.version + 1, by_id)
+
+  def publish_change(self, old, new):
+    self.current = self.current.replace(self.current.version + 1, old, new)
+
+  def assign_idx(self, bulb_id, idx=None):
+    '''
+    The idx of a bulb id: the one it had, the given one if it is still free, or the next unused one.
+    '''
+    if self.idx_by_id.has_key(bulb_id):
+      return self.idx_by_id[bulb_id]
+    if idx is None or idx in self.used_idx:
+      idx = self.next_idx
+    self.idx_by_id[bulb_id] = idx
+    self.used_idx.add(idx)
+    self.next_idx = max(self.next_idx, idx + 1)
+    return idx
+
+  def update_from_response(self, response):
+    '''
+    Insert or refresh a bulb from a parsed SearchResponse.
+    '''
+    bulb_id = response.id or response.ip
+    now = time.time()
+    fields = response._asdict()
+    fields["id"] = bulb_id
+    with self.lock:
+      previous = self.current.by_id.get(bulb_id)
+      if previous is not None and all(getattr(previous, field) == value for field, value in fields.iteritems()):
+        # a refresh of a known bulb, nothing to index again
+        previous.last_seen = now
+        return previous
+      fields.update({ "idx" : self.assign_idx(bulb_id), "last_seen" : now })
+      bulb = Bulb(**fields)
+      self.publish_change(previous, bulb)
+      return bulb
+
+  def mark_seen(self, ip):
+    '''
+    Note that the bulb at ip just sent something over its connection, which is as good as a search response.
+    '''
+    with self.lock:
+      bulb = self.current.by_ip.get(ip)
+      if bulb is not None:
+        bulb.last_seen = time.time()
+
+  def update_state(self, ip, props):
+    '''
+    Merge reported properties into the bulb at ip and return the ones that changed.
+    '''
+    with self.lock:
+      bulb = self.current.by_ip.get(ip)
+      if bulb is None:
+        return {}
+      changed = {}
+      for prop, value in props.items():
+        if not STATE_PROPS.has_key(prop):
+          continue
+        value = parse_int(str(value)) if STATE_PROPS[prop] is int else str(value)
+        if getattr(bulb, prop) != value:
+          changed[prop] = value
+      if changed:
+        self.publish_change(bulb, bulb.copy(**changed))
+      return changed
+
+  def restore(self, bulbs):
+    '''
+    Insert bulbs saved by an earlier run (Bulb.as_dict() dicts) that are not known yet,
+    keeping their idx where it is still free. Returns the restored Bulbs.
+    '''
+    restored = []
+    with self.lock:
+      by_id = dict(self.current.by_id)
+      for fields in bulbs:
+        bulb_id = fields.get("id")
+        if not bulb_id or by_id.has_key(bulb_id):
+          continue
+        bulb = Bulb(**dict(fields, idx=self.assign_idx(bulb_id, fields.get("idx"))))
+        by_id[bulb_id] = bulb
+        restored.append(bulb)
+      if restored:
+        self.publish(by_id)
+    return restored
+
+  def remove(self, bulb_id):
+    with self.lock:
+      if self.current.by_id.has_key(bulb_id):
+        self.publish_change(self.current.by_id[bulb_id], None)
+
+  def clear(self):
+    with self.lock:
+      self.publish({})
+
+bulb_registry = BulbRegistry()
+
 def handle_search_response(data):
   '''
   Parse search response and extract all interested data.
-  If new bulb is found, insert it into dictionary of managed bulbs. 
+  If new bulb is found, insert it into the registry of managed bulbs.
+  Listeners are notified about new bulbs and about power/brightness changes.
+  Returns the registered Bulb, or None if the data is not a search response.
   '''
-  location_re = re.compile("Location.*yeelight[^0-9]*([0-9]{1,3}(\.[0-9]{1,3}){3}):([0-9]*)")
-  match = location_re.search(data)
-  if match == None:
+  response = parse_search_response(data)
+  if response is None:
     debug( "invalid data received: " + data )
-    return 
-
-  host_ip = match.group(1)
-  if detected_bulbs.has_key(host_ip):
-    bulb_id = detected_bulbs[host_ip][0]
+    return None
+  previous = bulb_registry.get(response.id or response.ip)
+  bulb = bulb_registry.update_from_response(response)
+  if previous is None or previous.ip != bulb.ip:
+    changed = { "power" : bulb.power, "bright" : bulb.bright }
   else:
-    bulb_id = len(detected_bulbs)+1
-  host_port = match.group(3)
-  model = get_param_value(data, "model")
-  power = get_param_value(data, "power") 
-  bright = get_param_value(data, "bright")
-  rgb = get_param_value(data, "rgb")
-  # use two dictionaries to store index->ip and ip->bulb map
-  detected_bulbs[host_ip] = [bulb_id, model, power, bright, rgb, host_port]
-  bulb_idx2ip[bulb_id] = host_ip
+    changed = dict((prop, getattr(bulb, prop)) for prop in ("power", "bright") if getattr(previous, prop) != getattr(bulb, prop))
+  if changed:
+    for listener in list(bulb_state_listeners):
+      listener(bulb.ip, changed)
+  return bulb
 
 def display_bulb(idx):
-  if not bulb_idx2ip.has_key(idx):
+  bulb = bulb_registry.get_by_idx(idx)
+  if bulb is None:
     print "error: invalid bulb idx"
     return
-  bulb_ip = bulb_idx2ip[idx]
-  model = detected_bulbs[bulb_ip][1]
-  power = detected_bulbs[bulb_ip][2]
-  bright = detected_bulbs[bulb_ip][3]
-  rgb = detected_bulbs[bulb_ip][4]
   print str(idx) + ": ip=" \
-    +bulb_ip + ",model=" + model \
-    +",power=" + power + ",bright=" \
-    + bright + ",rgb=" + rgb
+    +bulb.ip + ",model=" + bulb.model \
+    +",power=" + bulb.power + ",bright=" \
+    + str(bulb.bright) + ",rgb=" + str(bulb.rgb)
 
 def display_bulbs():
-  print str(len(detected_bulbs)) + " managed bulbs"
-  for i in range(1, len(detected_bulbs)+1):
-    display_bulb(i)
+  snapshot = bulb_registry.snapshot()
+  print str(len(snapshot)) + " managed bulbs"
+  for bulb in snapshot:
+    display_bulb(bulb.idx)
+
+def add_bulb_state_listener(listener):
+  '''
+  listener(ip, changed) is called with a dict of the properties that changed on a bulb
+  '''
+  bulb_state_listeners.append(listener)
+
+def remove_bulb_state_listener(listener):
+  if listener in bulb_state_listeners:
+    bulb_state_listeners.remove(listener)
+
+def update_bulb_state(ip, props):
+  '''
+  Merge reported properties into the registry and notify listeners about the ones that changed.
+  '''
+  changed = bulb_registry.update_state(ip, props)
+  if changed:
+    debug("bulb " + ip + " state changed: " + str(changed))
+    for listener in list(bulb_state_listeners):
+      listener(ip, changed)
+
+def get_command_param(params, pos=0):
+  '''
+  extract one positional value from a compiled params string, e.g. ("\"on\",\"smooth\",500", 0) -> "on"
+  '''
+  values = params.split(",")
+  if pos >= len(values):
+    return ""
+  return values[pos].strip().strip('"')
+
+def command_state(method, params):
+  '''
+  The properties a successful command sets,
+  e.g. ("set_scene", "\"ct\",2700,40") -> {"power": "on", "ct": "2700", "bright": "40", "color_mode": 2}
+  '''
+  state = {}
+  if COMMAND_PROPS.has_key(method):
+    state[COMMAND_PROPS[method]] = get_command_param(params)
+  elif method == "set_scene":
+    props = SCENE_PROPS.get(get_command_param(params), ())
+    state = dict((prop, get_command_param(params, pos + 1)) for pos, prop in enumerate(props))
+    if state:
+      state["power"] = "on"
+  for prop, color_mode in COLOR_MODES.items():
+    if state.has_key(prop):
+      state["color_mode"] = color_mode
+  return state
+
+def handle_bulb_reply(ip, command, result):
+  '''
+  Derive the new bulb state from a successful command reply.
+  '''
+  method, params = command
+  if method == "get_prop":
+    update_bulb_state(ip, dict(zip(STATE_PROPS.keys(), result)))
+    return
+  if result != ["ok"]:
+    return
+  state = command_state(method, params)
+  if state:
+    update_bulb_state(ip, state)
+  elif method == "toggle" and bulb_registry.get_by_ip(ip) is not None:
+    power = bulb_registry.get_by_ip(ip).power
+    update_bulb_state(ip, {"power" : "off" if power == "on" else "on"})
+
+def handle_bulb_message(ip, line, pending):
+  '''
+  Handle one JSON line received from a bulb: a command reply or a props NOTIFY.
+  '''
+  try:
+    msg = json.loads(line)
+  except ValueError:
+    debug("invalid message from " + ip + ": " + line)
+    return
+  bulb_registry.mark_seen(ip)
+  if msg.get("method") == "props":
+    update_bulb_state(ip, msg.get("params", {}))
+  elif msg.has_key("id"):
+    command = pending.pop(msg["id"], None)
+    if msg.has_key("error"):
+      debug("command " + str(command) + " failed on " + ip + ": " + str(msg["error"]))
+    elif command is not None:
+      handle_bulb_reply(ip, command, msg.get("result", []))
+
+class BulbLatencyStats(object):
+  '''
+  Connect and send latency (in seconds) recorded for one bulb.
+  '''
+  def __init__(self):
+    self.connects = 0
+    self.connect_total = 0.0
+    self.connect_last = 0.0
+    self.sends = 0
+    self.send_total = 0.0
+    self.send_last = 0.0
+    self.reconnects = 0
+
+  def record_connect(self, elapsed):
+    self.connects += 1
+    self.connect_total += elapsed
+    self.connect_last = elapsed
+
+  def record_send(self, elapsed):
+    self.sends += 1
+    self.send_total += elapsed
+    self.send_last = elapsed
+
+  def as_dict(self):
+    return {
+      "connects" : self.connects,
+      "reconnects" : self.reconnects,
+      "connect_last" : self.connect_last,
+      "connect_avg" : self.connect_total / self.connects if self.connects else 0.0,
+      "sends" : self.sends,
+      "send_last" : self.send_last,
+      "send_avg" : self.send_total / self.sends if self.sends else 0.0,
+    }
+
+class BulbConnection(object):
+  '''
+  A long-lived TCP connection to one bulb.
+  The socket is (re)opened on demand, so callers never see a stale connection.
+  Replies and NOTIFY messages are read either by an attached event loop or
+  whenever the connection is used.
+  '''
+  def __init__(self, ip, port, timeout=CONNECT_TIMEOUT, loop=None):
+    self.ip = ip
+    self.port = int(port)
+    self.timeout = timeout
+    self.loop = loop
+    self.sock = None
+    self.buffer = ""
+    self.pending = OrderedDict()
+    self.lock = RLock()
+    self.stats = BulbLatencyStats()
+
+  def connect(self):
+    with self.lock:
+      self.close()
+      debug("connect " + self.ip + ":" + str(self.port) + " ...")
+      start = time.time()
+      sock = socket.create_connection((self.ip, self.port), self.timeout)
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      self.stats.record_connect(time.time() - start)
+      self.sock = sock
+      if self.loop is not None:
+        self.loop.call_soon_threadsafe(self.loop.add_reader, sock, self.on_readable)
+      # learn the current state right away instead of waiting for a search response
+      self.write([("get_prop", ",".join(['"' + prop + '"' for prop in STATE_PROPS]))])
+
+  def ensure_connected(self):
+    with self.lock:
+      if self.is_stale():
+        self.connect()
+
+  def close(self):
+    with self.lock:
+      if self.sock is not None:
+        if self.loop is not None:
+          self.loop.call_soon_threadsafe(self.loop.remove_reader, self.sock)
+        try:
+          self.sock.close()
+        except socket.error:
+          pass
+        self.sock = None
+      self.buffer = ""
+      self.pending.clear()
+
+  def on_readable(self, sock):
+    # a sender thread holds the lock through a connect or a write for up to the timeout,
+    # the loop reads later instead of waiting for it
+    if not self.lock.acquire(False):
+      loop = self.loop
+      if loop is not None:
+        loop.remove_reader(sock)
+        loop.call_later(READ_RETRY_DELAY, self.rearm, sock)
+      return
+    try:
+      if sock is self.sock and not self.read_available():
+        self.close()
+    finally:
+      self.lock.release()
+
+  def rearm(self, sock):
+    loop = self.loop
+    if loop is None:
+      return
+    if not self.lock.acquire(False):
+      loop.call_later(READ_RETRY_DELAY, self.rearm, sock)
+      return
+    try:
+      if sock is self.sock:
+        loop.add_reader(sock, self.on_readable)
+    finally:
+      self.lock.release()
+
+  def read_available(self):
+    '''
+    Read and handle everything the bulb has sent so far.
+    Returns False when the bulb has closed the connection.
+    '''
+    try:
+      while True:
+        if not is_readable(self.sock):
+          return True
+        data = self.sock.recv(2048)
+        if data == "":
+          return False
+        self.buffer += data
+        while "\n" in self.buffer:
+          line, self.buffer = self.buffer.split("\n", 1)
+          line = line.strip()
+          if line:
+            handle_bulb_message(self.ip, line, self.pending)
+    except (socket.error, select.error, ValueError):
+      return False
+
+  def is_stale(self):
+    '''
+    A socket is stale when the bulb has closed it or it is in error state.
+    '''
+    return self.sock is None or not self.read_available()
+
+  def write(self, commands):
+    lines = []
+    for method, params in commands:
+      cmd_id = next_cmd_id()
+      self.pending[cmd_id] = (method, params)
+      lines.append(build_command(method, params, cmd_id))
+    while len(self.pending) > MAX_PENDING_COMMANDS:
+      self.pending.popitem(last=False)
+    start = time.time()
+    self.sock.sendall("".join(lines))
+    self.stats.record_send(time.time() - start)
+
+  def send(self, commands):
+    '''
+    Pipeline a list of (method, params) commands, reconnecting once if the socket went stale.
+    '''
+    with self.lock:
+      for attempt in range(2):
+        try:
+          if self.is_stale():
+            if attempt == 0 and self.sock is not None:
+              self.stats.reconnects += 1
+            self.connect()
+          self.write(commands)
+          return
+        except socket.error:
+          self.close()
+          if attempt > 0:
+            raise
+          self.stats.reconnects += 1
+
+class BulbConnectionPool(object):
+  '''
+  Long-lived connections keyed by (ip, port), shared by all callers.
+  '''
+  def __init__(self, timeout=CONNECT_TIMEOUT):
+    self.timeout = timeout
+    self.connections = {}
+    self.loop = None
+    self.lock = Lock()
+
+  def attach(self, loop):
+    '''
+    Let an event loop read replies and NOTIFY messages of all pooled connections.
+    '''
+    with self.lock:
+      self.loop = loop
+      connections = self.connections.values()
+    for conn in connections:
+      with conn.lock:
+        conn.loop = loop
+        if conn.sock is not None:
+          loop.call_soon_threadsafe(loop.add_reader, conn.sock, conn.on_readable)
+
+  def detach(self):
+    with self.lock:
+      self.loop = None
+      connections = self.connections.values()
+    for conn in connections:
+      with conn.lock:
+        conn.loop = None
+
+  def get(self, ip, port):
+    key = (ip, int(port))
+    with self.lock:
+      conn = self.connections.get(key)
+      if conn is None:
+        conn = BulbConnection(ip, port, self.timeout, self.loop)
+        self.connections[key] = conn
+      return conn
+
+  def open(self, ip, port):
+    '''
+    Make sure a connection to the bulb is up so its NOTIFY messages are received.
+    '''
+    self.get(ip, port).ensure_connected()
+
+  def send(self, ip, port, commands):
+    '''
+    Pipeline a list of (method, params) tuples onto the connection of one bulb.
+    '''
+    self.get(ip, port).send(commands)
+
+  def close(self, ip, port):
+    with self.lock:
+      conn = self.connections.pop((ip, int(port)), None)
+    if conn is not None:
+      conn.close()
+
+  def close_all(self):
+    with self.lock:
+      connections = self.connections.values()
+      self.connections = {}
+    for conn in connections:
+      conn.close()
+
+  def connected(self):
+    '''
+    The ips of bulbs with an open pooled connection.
+    '''
+    with self.lock:
+      return set([conn.ip for conn in self.connections.values() if conn.sock is not None])
+
+  def latency_stats(self):
+    '''
+    Return {ip: stats dict} for every pooled bulb connection.
+    '''
+    with self.lock:
+      connections = self.connections.values()
+    return dict((conn.ip, conn.stats.as_dict()) for conn in connections)
+
+connection_pool = BulbConnectionPool()
+
+class BulbCommandQueue(object):
+  '''
+  Reconciles the desired state of each bulb (power, bright, ct, rgb) with the state it
+  reports in replies and NOTIFY messages.
+  Requests made in quick succession are merged into the latest desired state, and a
+  flush sends only the absolute commands for what differs from the bulb's state (or
+  from what was just sent to it), at most rate_limit commands per minute.
+  Until the bulb reports the desired state the commands are sent again, waiting
+  retry_delay seconds after the first send and twice as long after each retry, up to
+  max_retry_delay.
+  With an attached event loop flushes and retries are timed by the loop, after a short
+  coalescing delay and deferred while a bulb is over its quota, and sent by sender
+  threads so that connecting never blocks the loop; without one a request is sent
+  right away in the caller and never retried.
+  '''
+  def __init__(self, pool=connection_pool, rate_limit=RATE_LIMIT, delay=COALESCE_DELAY,
+               retry_delay=RETRY_DELAY, max_retry_delay=MAX_RETRY_DELAY, send_threads=SEND_THREADS):
+    self.pool = pool
+    self.rate_limit = rate_limit
+    self.delay = delay
+    self.retry_delay = retry_delay
+    self.max_retry_delay = max_retry_delay
+    self.send_threads = send_threads
+    self.loop = None
+    self.lock = Lock()
+    self.ready = Condition(self.lock)
+    self.senders = []      # threads flushing the ips in outbox while attached
+    self.outbox = deque()  # ips due for a flush
+    self.queued = set()    # ips in outbox
+    self.desired = {}      # ip -> (port, {prop: value}) until the bulb reports it
+    self.sent = {}         # ip -> {prop: (value, expiry)} sent but not confirmed yet
+    self.attempts = {}     # ip -> sends of the current desired state
+    self.deferred = set()  # ips waiting for their quota
+    self.tokens = {}       # ip -> (tokens, time of the last refill)
+    self.timers = {}       # ip -> Timer of a scheduled flush
+    self.retries = 0
+
+  def attach(self, loop):
+    with self.lock:
+      self.loop = loop
+      if not self.senders:
+        self.senders = [Thread(target=self.send_flushes) for i in range(self.send_threads)]
+        for sender in self.senders:
+          sender.setDaemon(True)
+          sender.start()
+
+  def detach(self):
+    '''
+    Stop timing flushes. Sender threads finish the flush they are in and exit.
+    '''
+    with self.lock:
+      self.loop = None
+      timers, self.timers = self.timers.values(), {}
+      self.senders = []
+      self.outbox.clear()
+      self.queued.clear()
+      self.ready.notify_all()
+    for timer in timers:
+      timer.cancel()
+
+  def request(self, ip, port, flush=False, force=(), **state):
+    '''
+    Merge desired state (power="on"/"off", bright=1..100, ct=1700..6500, rgb=0..0xffffff)
+    into what is desired for a bulb.
+    Properties in force are sent even if the bulb already reports them.
+    With flush the commands go out from the calling thread and are returned, otherwise
+    they are sent by the event loop (or right away when no loop is attached).
+    '''
+    with self.lock:
+      port, desired = self.desired.get(ip, (port, {}))
+      if [prop for prop, value in state.items() if desired.get(prop) != value]:
+        self.attempts[ip] = 0
+      desired.update(state)
+      self.desired[ip] = (port, desired)
+      if force:
+        # whatever the bulb reports or was sent, it has to be told again
+        sent = self.sent.setdefault(ip, {})
+        for prop in force:
+          sent[prop] = (None, time.time() + self.retry_delay)
+      loop = self.loop
+    if flush or loop is None:
+      return self.flush(ip)
+    loop.call_soon_threadsafe(self.schedule, ip, self.delay)
+    return None
+
+  def toggle(self, ip, port, flush=False):
+    '''
+    Request the opposite of the power state the bulb is going to have, as an absolute set_power.
+    '''
+    with self.lock:
+      power = self.desired.get(ip, (port, {}))[1].get("power") or self.expected(ip).get("power")
+    return self.request(ip, port, flush, power="off" if power == "on" else "on")
+
+  def send(self, ip, port, commands):
+    '''
+    Send raw commands that do not map to desired state (e.g. color flows) through the
+    rate limit. They supersede whatever is desired for the bulb.
+    Returns False, sending nothing, when the bulb is over its quota.
+    '''
+    with self.lock:
+      if not self.take(ip, len(commands)):
+        return False
+      self.forget(ip)
+    self.pool.send(ip, port, commands)
+    return True
+
+  def is_deferred(self, ip):
+    '''
+    True while desired state of the bulb waits for its command quota.
+    '''
+    with self.lock:
+      return ip in self.deferred
+
+  def schedule(self, ip, delay):
+    '''
+    Flush the bulb after delay seconds, unless a flush is scheduled before that. Runs on the loop.
+    '''
+    with self.lock:
+      timer = self.timers.get(ip)
+      if self.loop is None or (timer is not None and timer.when <= time.time() + delay):
+        return
+      if timer is not None:
+        timer.cancel()
+      self.timers[ip] = self.loop.call_later(delay, self.on_timer, ip)
+
+  def on_timer(self, ip):
+    '''
+    Hand the bulb to a sender thread. Runs on the loop.
+    '''
+    with self.lock:
+      self.timers.pop(ip, None)
+      if ip not in self.queued:
+        self.queued.add(ip)
+        self.outbox.append(ip)
+        self.ready.notify()
+
+  def send_flushes(self):
+    sender = current_thread()
+    while True:
+      with self.lock:
+        while not self.outbox and sender in self.senders:
+          self.ready.wait()
+        if sender not in self.senders:
+          return
+        ip = self.outbox.popleft()
+        self.queued.discard(ip)
+      try:
+        self.flush(ip)
+      except socket.error as e:
+        debug("failed to send to " + ip + ": " + str(e))
+
+  def flush(self, ip):
+    '''
+    Send the net difference between the desired and the expected state of a bulb.
+    Returns the commands sent; nothing is sent while the bulb is over its quota or
+    the commands sent last have not timed out yet.
+    '''
+    with self.lock:
+      if not self.desired.has_key(ip):
+        return []
+      if bulb_registry.get_by_ip(ip) is None:
+        # the bulb went away, whoever wants it is told again when it is back
+        self.forget(ip)
+        return []
+      port, desired = self.desired[ip]
+      now = time.time()
+      commands = self.diff(ip, desired)
+      if not commands:
+        expiries = [expiry for prop, (value, expiry) in self.sent.get(ip, {}).items() if desired.has_key(prop) and expiry > now]
+        if expiries:
+          self.call_later(ip, min(expiries) - now)
+        else:
+          self.forget(ip)
+        return []
+      if not self.take(ip, len(commands)):
+        self.deferred.add(ip)
+        self.call_later(ip, (len(commands) - self.tokens[ip][0]) * 60.0 / self.rate_limit)
+        return []
+      self.deferred.discard(ip)
+      attempts = self.attempts.get(ip, 0)
+      if attempts > 0:
+        self.retries += 1
+      self.attempts[ip] = attempts + 1
+      delay = min(self.max_retry_delay, self.retry_delay * 2 ** attempts)
+      sent = self.sent.setdefault(ip, {})
+      for method, params in commands:
+        for prop, value in command_state(method, params).items():
+          sent[prop] = (value, now + delay)
+      self.call_later(ip, delay)
+    try:
+      self.pool.send(ip, port, commands)
+    except socket.error:
+      with self.lock:
+        self.sent.pop(ip, None)
+      raise
+    return commands
+
+  def call_later(self, ip, delay):
+    if self.loop is not None:
+      self.loop.call_soon_threadsafe(self.schedule, ip, delay)
+
+  def diff(self, ip, desired):
+    '''
+    Absolute commands taking the bulb from its expected to the desired state.
+    A bulb that stays off keeps its other properties, bulbs do not accept them while off.
+    Several changes of a bulb that is (to be) on are sent as a single set_scene.
+    '''
+    expected = self.expected(ip)
+    power = desired.get("power", expected.get("power"))
+    commands = []
+    if power in ("on", "off") and power != expected.get("power"):
+      commands.append(("set_power", '"' + power + '"'))
+    if power == "off":
+      return commands
+    for prop, method, params in (("ct", "set_ct_abx", '%s,"sudden",30'), ("rgb", "set_rgb", '%s,"sudden",30'),
+                                 ("bright", "set_bright", "%s")):
+      if desired.get(prop) is not None and str(desired[prop]) != str(expected.get(prop)):
+        commands.append((method, params % desired[prop]))
+    if len(commands) > 1:
+      scene = self.scene(ip, desired, expected)
+      if scene is not None:
+        return [("set_scene", scene)]
+    return commands
+
+  def scene(self, ip, desired, expected):
+    '''
+    Params of one set_scene setting the desired color and brightness, keeping the color the
+    bulb shows when none is desired. None when the bulb does not support set_scene.
+    '''
+    bulb = bulb_registry.get_by_ip(ip)
+    bright = desired.get("bright", expected.get("bright"))
+    if bulb is None or "set_scene" not in (bulb.support or []) or bright is None:
+      return None
+    rgb, ct = desired.get("rgb"), desired.get("ct")
+    if rgb is not None and ct is None:
+      return '"color",%s,%s' % (rgb, bright)
+    if ct is not None and rgb is None:
+      return '"ct",%s,%s' % (ct, bright)
+    if rgb is None and ct is None:
+      if bulb.color_mode == 1 and expected.get("rgb") is not None:
+        return '"color",%s,%s' % (expected["rgb"], bright)
+      if bulb.color_mode == 3 and bulb.hue is not None and bulb.sat is not None:
+        return '"hsv",%s,%s,%s' % (bulb.hue, bulb.sat, bright)
+      if bulb.color_mode == 2 and expected.get("ct") is not None:
+        return '"ct",%s,%s' % (expected["ct"], bright)
+    return None
+
+  def observed(self, ip):
+    '''
+    The state a bulb reports; its rgb or ct only count while the bulb is in that color mode.
+    '''
+    bulb = bulb_registry.get_by_ip(ip)
+    if bulb is None:
+      return {}
+    observed = dict((prop, getattr(bulb, prop)) for prop in COMMAND_PROPS.values())
+    for prop in ("rgb", "ct"):
+      if bulb.color_mode != COLOR_MODES[prop]:
+        observed[prop] = None
+    return observed
+
+  def expected(self, ip):
+    '''
+    The state a bulb reports, overridden by commands sent to it that have not timed out yet.
+    '''
+    expected = self.observed(ip)
+    now = time.time()
+    for prop, (value, expiry) in self.sent.get(ip, {}).items():
+      if expiry > now:
+        expected[prop] = value
+    return expected
+
+  def converged(self, ip):
+    desired = self.desired[ip][1]
+    observed = self.observed(ip)
+    if not observed:
+      return False
+    if desired.get("power") == "off":
+      return observed["power"] == "off"
+    return all([str(observed.get(prop)) == str(value) for prop, value in desired.items()])
+
+  def take(self, ip, count):
+    '''
+    Token bucket of rate_limit commands per minute, full for a bulb not seen before.
+    '''
+    now = time.time()
+    tokens, last = self.tokens.get(ip, (self.rate_limit, now))
+    tokens = min(self.rate_limit, tokens + (now - last) * self.rate_limit / 60.0)
+    if tokens < count:
+      self.tokens[ip] = (tokens, now)
+      return False
+    self.tokens[ip] = (tokens - count, now)
+    return True
+
+  def forget(self, ip):
+    self.desired.pop(ip, None)
+    self.sent.pop(ip, None)
+    self.attempts.pop(ip, None)
+    self.deferred.discard(ip)
+    timer = self.timers.pop(ip, None)
+    if timer is not None:
+      timer.cancel()
+
+  def on_state_changed(self, ip, changed):
+    '''
+    A reported change replaces what was assumed from sent commands; a bulb that
+    reports the desired state needs nothing more.
+    '''
+    with self.lock:
+      sent = self.sent.get(ip)
+      if sent:
+        for prop in changed:
+          sent.pop(prop, None)
+      if self.desired.has_key(ip) and ip not in self.deferred and self.converged(ip):
+        self.forget(ip)
+
+  def stats(self):
+    with self.lock:
+      return { "desired" : len(self.desired), "deferred" : len(self.deferred), "retries" : self.retries }
+
+  def clear(self):
+    self.detach()
+    with self.lock:
+      for ip in self.desired.keys():
+        self.forget(ip)
+      self.sent.clear()
+      self.tokens.clear()
+
+command_queue = BulbCommandQueue()
+add_bulb_state_listener(command_queue.on_state_changed)
+
+def build_command(method, params, cmd_id=None):
+  if cmd_id is None:
+    cmd_id = next_cmd_id()
+  return "{\"id\":" + str(cmd_id) + ",\"method\":\"" \
+    + method + "\",\"params\":[" + params + "]}\r\n"
 
 def operate_on_bulb(idx, method, params):
   '''
@@ -152,20 +1573,32 @@ def operate_on_bulb(idx, method, params):
   Input data 'params' must be a compiled into one string.
   E.g. params="1"; params="\"smooth\"", params="1,\"smooth\",80"
   '''
-  if not bulb_idx2ip.has_key(idx):
+  operate_on_bulb_batch(idx, [(method, params)])
+
+def operate_on_bulb_batch(idx, commands):
+  '''
+  Pipeline several (method, params) commands to one bulb over its pooled connection.
+  Plain power and brightness changes become desired state in the command queue, so
+  only their net effect is sent; a toggle is turned into an absolute set_power.
+  '''
+  bulb = bulb_registry.get_by_idx(idx)
+  if bulb is None:
     print "error: invalid bulb idx"
     return
-  
-  bulb_ip=bulb_idx2ip[idx]
-  port=detected_bulbs[bulb_ip][5]
+
   try:
-    tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    print "connect ",bulb_ip, port ,"..."
-    tcp_socket.connect((bulb_ip, int(port)))
-    msg="{\"id\":" + str(next_cmd_id()) + ",\"method\":\""
-    msg += method + "\",\"params\":[" + params + "]}\r\n"
-    tcp_socket.send(msg)
-    tcp_socket.close()
+    raw = []
+    for method, params in commands:
+      if method == "toggle" and not params:
+        command_queue.toggle(bulb.ip, bulb.port)
+      elif method == "set_power" and "," not in params:
+        command_queue.request(bulb.ip, bulb.port, power=get_command_param(params))
+      elif method == "set_bright" and "," not in params:
+        command_queue.request(bulb.ip, bulb.port, bright=parse_int(get_command_param(params)))
+      else:
+        raw.append((method, params))
+    if raw and not command_queue.send(bulb.ip, bulb.port, raw):
+      print "error: bulb", idx, "is over its command quota, try again later"
   except Exception as e:
     print "Unexpected error:", e
 
@@ -202,8 +1635,7 @@ def handle_user_input():
     elif argv[0] == "l" or argv[0] == "list":
       display_bulbs()
     elif argv[0] == "r" or argv[0] == "refresh":
-      detected_bulbs.clear()
-      bulb_idx2ip.clear()
+      bulb_registry.clear()
       send_search_broadcast()
       #sleep(0.5)
       #display_bulbs()
@@ -254,4 +1686,5 @@ if __name__ == "__main__":
   # user interaction end, tell detection thread to quit and wait
   RUNNING = False
   detection_thread.join()
+  connection_pool.close_all()
   # done
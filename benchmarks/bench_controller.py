@@ -0,0 +1,154 @@
+#!/usr/bin/python
+'''
+Load test of the controller against simulated bulbs (see bulb_simulator.py).
+
+Usage: python benchmarks/bench_controller.py [bulbs ...]
+
+For every fleet size (10 100 1000 5000 by default) a simulator runs in its own
+process and the benchmark reports:
+  discovery   seconds until every bulb was found, and the searches it took
+  commands/s  set_bright commands dispatched per second over pooled connections
+  tick p50/99 latency of one policy tick (calculate + dispatch) over the fleet
+It exits with status 1 when the event loop or the controller reported errors
+along the way, numbers measured over failing connections mean nothing.
+'''
+
+import os
+import sys
+import imp
+import time
+import logging
+import resource
+import threading
+import multiprocessing
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+from YeelightWifiBulbLanCtrl import EventLoop, LanTransport, attach_discovery, detach_discovery, bulb_registry, connection_pool
+from bulb_simulator import BulbSimulator
+
+SIZES = [10, 100, 1000, 5000]
+DISCOVERY_TIMEOUT = 60
+COMMAND_ROUNDS = 5
+TICKS = 20
+
+class ErrorCounter(logging.Handler):
+  def __init__(self):
+    logging.Handler.__init__(self, logging.ERROR)
+    self.count = 0
+
+  def emit(self, record):
+    self.count += 1
+
+def raise_file_limit():
+  # every bulb takes a listening and an accepted socket in the simulator and a connection here
+  soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+  resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+  return hard
+
+def run_simulator(count, ready, done):
+  simulator = BulbSimulator(count).start()
+  ready.send(simulator.search_address)
+  done.wait()
+  ready.send(simulator.stats())
+  simulator.stop()
+
+def percentile(values, fraction):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def ramp_policy(bulb_ips):
+  return [{
+    "bulb_ip" : bulb_ips,
+    "policies" : [{ "bright_time" : "00:00:00", "dark_time" : "23:59:59", "min_brightness" : 1, "max_brightness" : 99 }],
+  }]
+
+def bench_discovery(count, loop, transport):
+  bulb_registry.clear()
+  start = time.time()
+  discovery = attach_discovery(loop, transport=transport)
+  while len(bulb_registry) < count and time.time() - start < DISCOVERY_TIMEOUT:
+    time.sleep(0.01)
+  elapsed = time.time() - start
+  searches = discovery.stats.searches
+  # the sockets belong to the loop thread, detach there
+  detached = threading.Event()
+  loop.call_soon_threadsafe(lambda: (detach_discovery(loop, discovery), detached.set()))
+  detached.wait(5)
+  return elapsed, searches
+
+def bench_commands(controller, bulb_ips):
+  elapsed = 0.0
+  commands = 0
+  for i in range(COMMAND_ROUNDS + 1):
+    brightness = 10 + i % 2
+    start = time.time()
+    report = controller.dispatch_yeelight_brightness([{ "bulb_ip" : bulb_ips, "calculated_brightness" : brightness }])
+    if i > 0: # the first round opens the connections
+      elapsed += time.time() - start
+      commands += sum([len(result["commands"]) for result in report.values()])
+  return commands / elapsed
+
+def bench_ticks(controller, bulb_ips):
+  from datetime import datetime, timedelta
+  from dateutil import tz
+  policy = ramp_policy(bulb_ips)
+  current_time = datetime.now().replace(tzinfo = tz.tzlocal(), hour = 0, minute = 30)
+  latencies = []
+  for i in range(TICKS):
+    current_time += timedelta(minutes = 10)
+    start = time.time()
+    controller.dispatch_yeelight_brightness(controller.calculate_light_brightness(current_time, policy))
+    latencies.append(time.time() - start)
+  return percentile(latencies, 0.5), percentile(latencies, 0.99)
+
+def bench(count, controller_module):
+  # returns the errors seen
+  errors = ErrorCounter()
+  logging.getLogger().addHandler(errors)
+  ready, child_end = multiprocessing.Pipe()
+  done = multiprocessing.Event()
+  simulator = multiprocessing.Process(target=run_simulator, args=(count, child_end, done))
+  simulator.start()
+  search_address = ready.recv()
+  # searches go straight to the simulator instead of the multicast group
+  transport = LanTransport(listen_address=("127.0.0.1", 0), multicast_address=search_address, reuse_port=False)
+  loop = EventLoop()
+  connection_pool.attach(loop)
+  loop_thread = threading.Thread(target=loop.run_forever)
+  loop_thread.setDaemon(True)
+  loop_thread.start()
+  try:
+    discovery_time, searches = bench_discovery(count, loop, transport)
+    bulb_ips = [bulb.ip for bulb in bulb_registry]
+    controller = controller_module.SmartYeelight(logging_level=logging.ERROR, latitude=0, longitude=0,
+      sun_time_cache_file=None, dispatch_workers=64)
+    commands_per_second = bench_commands(controller, bulb_ips)
+    tick_p50, tick_p99 = bench_ticks(controller, bulb_ips)
+    controller.stop()
+  finally:
+    loop.stop()
+    loop_thread.join(5)
+    connection_pool.detach()
+    connection_pool.close_all()
+    transport.close()
+    done.set()
+    stats = ready.recv()
+    simulator.join(10)
+    logging.getLogger().removeHandler(errors)
+  print "%6d %5d found %8.2fs %4d searches %10.0f %9.1fms %9.1fms %6d commands" % (count, len(bulb_ips),
+    discovery_time, searches, commands_per_second, tick_p50 * 1000, tick_p99 * 1000, stats["commands"])
+  if loop.errors or errors.count:
+    print "%6d errors: %d in event loop callbacks, %d logged" % (count, loop.errors, errors.count)
+  return loop.errors + errors.count
+
+if __name__ == "__main__":
+  sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+  controller_module = imp.load_source("smart_controller", os.path.join(ROOT, "smart-controller.py"))
+  print "open file limit: " + str(raise_file_limit())
+  print " bulbs            discovery                commands/s  tick p50  tick p99  simulator"
+  failed = False
+  for count in sizes:
+    failed = bench(count, controller_module) > 0 or failed
+  if failed:
+    sys.exit(1)
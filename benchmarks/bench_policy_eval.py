@@ -0,0 +1,117 @@
+#!/usr/bin/python
+'''
+Micro-benchmark of light policy evaluation, the work of one policy tick.
+
+Usage: python benchmarks/bench_policy_eval.py [bulbs] [ticks]
+
+A policy with one entry per bulb (a few ramps and constant ranges each, every
+other entry bound to a monitored device) is deployed, then the brightness of
+every bulb is calculated for the current time, as the scheduler does, and for
+a given aware datetime. The cost is reported per tick and per bulb, next to the
+cost of the evaluator the policy index replaced.
+'''
+
+import os
+import sys
+import imp
+import math
+import time
+import logging
+from datetime import datetime
+from dateutil import tz
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+def make_policy(bulbs):
+  policy = []
+  for i in range(bulbs):
+    entry = {
+      "bulb_ip" : ["10.0.%d.%d" % (i // 250, i % 250 + 1)],
+      "policies" : [
+        { "dark_time" : "00:00:00", "bright_time" : "01:30:00", "max_brightness" : 40, "min_brightness" : 1 },
+        { "bright_time" : "01:30:00", "dark_time" : "$sunrise$", "const_brightness" : 0 },
+        { "bright_time" : "$civil_twilight_end$ - 1h", "dark_time" : "$sunset$" },
+        { "bright_time" : "$civil_twilight_end$", "dark_time" : "23:00", "const_brightness" : 100 },
+        { "dark_time" : "23:00", "bright_time" : "23:59:59", "max_brightness" : 100, "min_brightness" : 40 },
+      ],
+    }
+    if i % 2:
+      entry["light_on_only_when_device_online"] = ["10.1.0.%d" % (i % 8 + 1)]
+    policy.append(entry)
+  return policy
+
+def legacy_diff(datetime1, datetime2):
+  td = datetime1 - datetime2
+  return (td.microseconds + (td.seconds + td.days * 86400) * 10**6) / 10**6
+
+def legacy_policy_brightness(current_time, light_policy):
+  bright_time, dark_time = light_policy['bright_time'], light_policy['dark_time']
+  if current_time < min(bright_time, dark_time) or current_time > max(bright_time, dark_time):
+    return -1
+  if 'const_brightness' in light_policy:
+    return light_policy['const_brightness']
+  min_brightness = light_policy.get('min_brightness', 0)
+  max_brightness = light_policy.get('max_brightness', 100)
+  time_scale = abs(legacy_diff(bright_time, dark_time))
+  time_passed = abs(legacy_diff(current_time, bright_time))
+  brightness = int(math.ceil(min_brightness + float(time_passed) / float(time_scale) * float(max_brightness - min_brightness)))
+  return brightness + min_brightness
+
+def legacy_calculate(compiled_policy, current_time, devices_online):
+  '''
+  the evaluator this benchmark is compared against: aware datetimes compared
+  against every policy of a bulb in turn until one covers the current time
+  '''
+  calculated = []
+  for bulb in compiled_policy:
+    calculated_light = { "bulb_ip" : bulb["bulb_ip"] }
+    if 'light_on_only_when_device_online' in bulb and \
+        not [ip for ip in bulb["light_on_only_when_device_online"] if ip in devices_online]:
+      calculated_light["calculated_brightness"] = 0
+    else:
+      for policy in bulb['policies']:
+        brightness = legacy_policy_brightness(current_time, policy)
+        if brightness > -1:
+          calculated_light["calculated_brightness"] = brightness
+          calculated_light["policy_matched"] = policy
+          break
+    if 'calculated_brightness' in calculated_light:
+      calculated.append(calculated_light)
+  return calculated
+
+def brightness_by_ip(calculated):
+  return dict((ip, light["calculated_brightness"]) for light in calculated for ip in light["bulb_ip"])
+
+def bench(calculate, ticks):
+  start = time.time()
+  for i in xrange(ticks):
+    calculate()
+  return (time.time() - start) / ticks
+
+if __name__ == "__main__":
+  bulbs = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+  ticks = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+  controller_module = imp.load_source("smart_controller", os.path.join(ROOT, "smart-controller.py"))
+  controller = controller_module.SmartYeelight(logging_level=logging.WARNING, latitude=37.77, longitude=-122.42,
+    sun_time_cache_file=None)
+  controller.deploy_policy(make_policy(bulbs))
+  controller.calculate_light_brightness()
+  # the compiled entries of the deployed policy, which still carry their aware datetimes
+  compiled_policy = controller._SmartYeelight__compiled_policy
+  given_time = datetime.now().replace(tzinfo=tz.tzlocal())
+  if brightness_by_ip(legacy_calculate(compiled_policy, given_time, [])) != \
+      brightness_by_ip(controller.calculate_light_brightness(given_time)):
+    sys.exit("the evaluators disagree at " + given_time.isoformat())
+  print "bulbs: " + str(bulbs) + ", ticks: " + str(ticks)
+  print "%-15s %27s %27s %8s" % ("", "before", "after", "speedup")
+  cases = (
+    ("current time", lambda: legacy_calculate(compiled_policy, datetime.now().replace(tzinfo=tz.tzlocal()), []),
+     controller.calculate_light_brightness),
+    ("given datetime", lambda: legacy_calculate(compiled_policy, given_time, []),
+     lambda: controller.calculate_light_brightness(given_time)))
+  for name, before, after in cases:
+    before, after = bench(before, ticks), bench(after, ticks)
+    print "%-15s %8.1f us/tick %6.2f us/bulb %8.1f us/tick %6.2f us/bulb %7.1fx" % (name,
+      before * 1e6, before * 1e6 / bulbs, after * 1e6, after * 1e6 / bulbs, before / after)
+  controller.stop()
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+'''
+Micro-benchmark of the SSDP search response parser.
+
+Usage: python benchmarks/bench_ssdp_parser.py [corpus_file] [packets]
+
+The corpus file holds captured responses separated by lines of "----";
+the built-in corpus is used when no file is given.
+'''
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from YeelightWifiBulbLanCtrl import parse_search_response
+
+CORPUS = [
+  "HTTP/1.1 200 OK\r\n"
+  "Cache-Control: max-age=3600\r\n"
+  "Date: \r\n"
+  "Ext: \r\n"
+  "Location: yeelight://192.168.1.239:55443\r\n"
+  "Server: POSIX UPnP/1.0 YGLC/1\r\n"
+  "id: 0x000000000015243f\r\n"
+  "model: color\r\n"
+  "fw_ver: 18\r\n"
+  "support: get_prop set_default set_power toggle set_bright start_cf stop_cf set_scene cron_add cron_get cron_del set_ct_abx set_rgb\r\n"
+  "power: on\r\n"
+  "bright: 100\r\n"
+  "color_mode: 2\r\n"
+  "ct: 4000\r\n"
+  "rgb: 16711680\r\n"
+  "hue: 100\r\n"
+  "sat: 35\r\n"
+  "name: my_bulb\r\n",
+  "NOTIFY * HTTP/1.1\r\n"
+  "Host: 239.255.255.250:1982\r\n"
+  "Cache-Control: max-age=3600\r\n"
+  "Location: yeelight://192.168.1.201:55443\r\n"
+  "NTS: ssdp:alive\r\n"
+  "Server: POSIX, UPnP/1.0 YGLC/1\r\n"
+  "id: 0x0000000002dfb19a\r\n"
+  "model: mono\r\n"
+  "fw_ver: 45\r\n"
+  "support: get_prop set_default set_power toggle set_bright start_cf stop_cf set_scene cron_add cron_get cron_del\r\n"
+  "power: off\r\n"
+  "bright: 1\r\n"
+  "color_mode: 2\r\n"
+  "ct: 2700\r\n"
+  "rgb: 0\r\n"
+  "hue: 0\r\n"
+  "sat: 0\r\n"
+  "name: \r\n",
+  "M-SEARCH * HTTP/1.1\r\n"
+  "HOST: 239.255.255.250:1982\r\n"
+  "MAN: \"ssdp:discover\"\r\n"
+  "ST: wifi_bulb",
+]
+
+def load_corpus(path):
+  with open(path) as corpus_file:
+    return [packet.strip("\n").replace("\r\n", "\n").replace("\n", "\r\n")
+      for packet in corpus_file.read().split("\n----\n") if packet.strip()]
+
+FIELDS = ("id", "model", "fw_ver", "support", "power", "bright", "color_mode", "ct", "rgb", "hue", "sat", "name")
+
+def legacy_parse(data):
+  '''
+  the parser this benchmark is compared against: one regex compiled and
+  one scan of the payload per field, for the same fields as parse_search_response
+  '''
+  location_re = re.compile("Location.*yeelight[^0-9]*([0-9]{1,3}(\.[0-9]{1,3}){3}):([0-9]*)")
+  match = location_re.search(data)
+  if match == None:
+    return None
+  values = [match.group(1), match.group(3)]
+  for param in FIELDS:
+    param_match = re.compile(param+":\s*([ -~]*)").search(data)
+    values.append(param_match.group(1) if param_match else "")
+  return values
+
+def bench(parse, corpus, packets):
+  start = time.time()
+  for i in xrange(packets):
+    parse(corpus[i % len(corpus)])
+  return packets / (time.time() - start)
+
+if __name__ == "__main__":
+  corpus = CORPUS
+  if len(sys.argv) > 1:
+    corpus = load_corpus(sys.argv[1])
+  packets = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+  print "corpus: " + str(len(corpus)) + " responses, " + str(packets) + " packets"
+  print "legacy regex parser: %.0f packets/s" % bench(legacy_parse, corpus, packets)
+  print "single-pass parser:  %.0f packets/s" % bench(parse_search_response, corpus, packets)
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+
+import json
+import random
+import socket
+import struct
+import errno
+import threading
+from YeelightWifiBulbLanCtrl import EventLoop, LanTransport, STATE_PROPS
+
+MAX_CONNECTIONS = 4     # a real bulb serves at most 4 control connections at a time
+RESPONSE_SPREAD = 0.2   # bulbs answer a search at a random point of this many seconds, like SSDP MX
+SUPPORT = "get_prop set_default set_power toggle set_bright start_cf stop_cf set_scene cron_add cron_get " \
+          "cron_del set_ct_abx set_rgb set_hsv set_adjust set_name"
+SILENT_METHODS = ('get_prop', 'set_default', 'set_adjust', 'cron_add', 'cron_get', 'cron_del')
+# a connection that does not read this much pending output is dropped
+MAX_PENDING_OUTPUT = 256 * 1024
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+def bulb_address(network, index):
+    # the index-th address after network, e.g. 127.1.0.1; all of 127.0.0.0/8 is on the loopback interface
+    base = struct.unpack('!I', socket.inet_aton(network))[0]
+    return socket.inet_ntoa(struct.pack('!I', base + index + 1))
+
+class SimulatorError(Exception):
+    pass
+
+class SimulatedBulb(object):
+    # State and command handling of one bulb; the sockets are driven by the BulbSimulator.
+
+    def __init__(self, index, ip, model = 'color'):
+        self.id = '0x%016x' % (0x5000000 + index)
+        self.ip = ip
+        self.port = None
+        self.model = model
+        self.fw_ver = 18
+        self.state = { 'power' : 'off', 'bright' : 50, 'ct' : 4000, 'rgb' : 16711680, 'hue' : 100, 'sat' : 35,
+                       'color_mode' : 2, 'name' : '' }
+        self.server = None
+        self.clients = {}       # socket -> partial input line
+        self.output = {}        # socket -> output the client has not taken yet
+        self.flow_timer = None
+        self.commands = 0
+
+    def search_response(self):
+        lines = ["HTTP/1.1 200 OK", "Cache-Control: max-age=3600", "Date: ", "Ext: ",
+                 "Location: yeelight://%s:%d" % (self.ip, self.port), "Server: POSIX UPnP/1.0 YGLC/1",
+                 "id: %s" % self.id, "model: %s" % self.model, "fw_ver: %d" % self.fw_ver, "support: %s" % SUPPORT]
+        lines += ["%s: %s" % (prop, self.state[prop]) for prop in STATE_PROPS]
+        return "\r\n".join(lines) + "\r\n"
+
+    def advertisement(self):
+        return self.search_response().replace("HTTP/1.1 200 OK", "NOTIFY * HTTP/1.1\r\nHost: 239.255.255.250:1982", 1) \
+            .replace("Ext: \r\n", "NTS: ssdp:alive\r\n", 1)
+
+    def execute(self, method, params):
+        # result of a command and the properties it changed; SimulatorError for a bad command
+        self.commands += 1
+        if method == 'get_prop':
+            return [str(self.state.get(prop, "")) for prop in params], {}
+        if method in SILENT_METHODS:
+            return ["ok"], {}
+        if method == 'set_power':
+            return ["ok"], self.change(power = self.choice(params, 0, ('on', 'off')))
+        if method == 'toggle':
+            return ["ok"], self.change(power = 'off' if self.state['power'] == 'on' else 'on')
+        if method == 'set_bright':
+            return ["ok"], self.change(bright = self.number(params, 0, 1, 100))
+        if method == 'set_ct_abx':
+            return ["ok"], self.change(ct = self.number(params, 0, 1700, 6500), color_mode = 2)
+        if method == 'set_rgb':
+            return ["ok"], self.change(rgb = self.number(params, 0, 0, 0xffffff), color_mode = 1)
+        if method == 'set_hsv':
+            return ["ok"], self.change(hue = self.number(params, 0, 0, 359), sat = self.number(params, 1, 0, 100), color_mode = 3)
+        if method == 'set_name':
+            return ["ok"], self.change(name = str(params[0]) if params else '')
+        if method == 'set_scene':
+            return ["ok"], self.scene(params)
+        if method in ('start_cf', 'stop_cf'):
+            return ["ok"], {}
+        raise SimulatorError("method not supported")
+
+    def change(self, **props):
+        changed = dict((prop, value) for prop, value in props.items() if self.state[prop] != value)
+        self.state.update(changed)
+        return changed
+
+    def scene(self, params):
+        kind = self.choice(params, 0, ('color', 'hsv', 'ct', 'cf', 'auto_delay_off'))
+        if kind == 'color':
+            return self.change(power = 'on', rgb = self.number(params, 1, 0, 0xffffff), bright = self.number(params, 2, 1, 100), color_mode = 1)
+        if kind == 'hsv':
+            return self.change(power = 'on', hue = self.number(params, 1, 0, 359), sat = self.number(params, 2, 0, 100),
+                               bright = self.number(params, 3, 1, 100), color_mode = 3)
+        if kind == 'ct':
+            return self.change(power = 'on', ct = self.number(params, 1, 1700, 6500), bright = self.number(params, 2, 1, 100), color_mode = 2)
+        if kind == 'auto_delay_off':
+            return self.change(power = 'on', bright = self.number(params, 1, 1, 100))
+        return self.change(power = 'on')
+
+    def flow_end_state(self, params):
+        # (seconds, props at the end) of a start_cf flow that stays at its last state, else None
+        if len(params) < 3 or self.number(params, 1, 0, 2) != 1 or self.number(params, 0, 0, 1000000) == 0:
+            return None
+        values = [int(value) for value in str(params[2]).split(',')]
+        if len(values) % 4 != 0 or not values:
+            raise SimulatorError("invalid params")
+        steps = [values[i:i + 4] for i in range(0, len(values), 4)] * self.number(params, 0, 0, 1000000)
+        duration, mode, value, bright = steps[-1]
+        props = { 'power' : 'on' }
+        if bright > 0:
+            props['bright'] = bright
+        if mode == 1:
+            props.update(rgb = value, color_mode = 1)
+        elif mode == 2:
+            props.update(ct = value, color_mode = 2)
+        return sum([step[0] for step in steps]) / 1000.0, props
+
+    def choice(self, params, pos, choices):
+        if len(params) <= pos or params[pos] not in choices:
+            raise SimulatorError("invalid params")
+        return str(params[pos])
+
+    def number(self, params, pos, low, high):
+        if len(params) <= pos:
+            raise SimulatorError("invalid params")
+        try:
+            value = int(params[pos])
+        except (TypeError, ValueError):
+            raise SimulatorError("invalid params")
+        if value < low or value > high:
+            raise SimulatorError("invalid params")
+        return value
+
+class BulbSimulator(object):
+    # Emulates count Yeelight bulbs on localhost, each on its own loopback address (127.1.0.1,
+    # 127.1.0.2, ...), all served by one event loop thread.
+    #
+    # Search requests sent to search_address are answered like multicast ones, every bulb at a
+    # random point within response_spread. Commands are answered with JSON-RPC replies followed
+    # by a props NOTIFY to every connection of the bulb. latency (plus up to jitter) delays every
+    # answer, loss is the share of datagrams and commands that are dropped without an answer and
+    # a bulb refuses connections beyond max_connections.
+
+    def __init__(self, count = 10, network = '127.1.0.0', search_address = ('127.0.0.1', 0), latency = 0.0,
+                 jitter = 0.0, loss = 0.0, max_connections = MAX_CONNECTIONS, response_spread = RESPONSE_SPREAD,
+                 seed = None):
+        self.bulbs = [SimulatedBulb(index, bulb_address(network, index)) for index in range(count)]
+        self.search_address = search_address
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.max_connections = max_connections
+        self.response_spread = response_spread
+        self.random = random.Random(seed)
+        self.searches = 0
+        self.refused = 0
+        self.dropped = 0
+        self.__loop = None
+        self.__thread = None
+        self.__search_socket = None
+
+    def start(self):
+        self.__loop = EventLoop()
+        self.__search_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__search_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.__search_socket.bind(self.search_address)
+        self.__search_socket.setblocking(0)
+        self.search_address = self.__search_socket.getsockname()
+        self.__loop.add_reader(self.__search_socket, self.__on_search)
+        for bulb in self.bulbs:
+            bulb.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            bulb.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            bulb.server.bind((bulb.ip, bulb.port or 0))
+            bulb.server.listen(16)
+            bulb.server.setblocking(0)
+            bulb.port = bulb.server.getsockname()[1]
+            self.__loop.add_reader(bulb.server, self.__on_accept, bulb)
+        self.__thread = threading.Thread(name = 'BulbSimulator', target = self.__loop.run_forever)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        if self.__thread is None:
+            return
+        self.__loop.stop()
+        self.__thread.join(5)
+        self.__thread = None
+        for bulb in self.bulbs:
+            for client in bulb.clients.keys():
+                client.close()
+            bulb.clients = {}
+            bulb.output = {}
+            bulb.server.close()
+        self.__search_socket.close()
+        self.__loop.close()
+
+    def transport(self):
+        # a LanTransport sending the controller's searches to this simulator instead of the multicast group
+        return LanTransport(listen_address = ('127.0.0.1', 0), multicast_address = self.search_address, reuse_port = False)
+
+    def advertise(self, address):
+        # send the NOTIFY advertisement of every bulb to address, e.g. the listen socket of a LanTransport
+        self.__loop.call_soon_threadsafe(self.__advertise, address)
+
+    def __advertise(self, address):
+        for bulb in self.bulbs:
+            self.__later(self.__delay(self.response_spread), self.__send_datagram, bulb.advertisement(), address)
+
+    def __lost(self):
+        if self.loss and self.random.random() < self.loss:
+            self.dropped += 1
+            return True
+        return False
+
+    def __delay(self, spread = 0.0):
+        return self.latency + self.random.random() * (self.jitter + spread)
+
+    def __later(self, delay, callback, *args):
+        if delay > 0:
+            self.__loop.call_later(delay, callback, *args)
+        else:
+            callback(*args)
+
+    def __on_search(self, sock):
+        while True:
+            try:
+                data, address = sock.recvfrom(2048)
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK:
+                    return
+                raise
+            if not data.startswith("M-SEARCH") or "wifi_bulb" not in data:
+                continue
+            self.searches += 1
+            for bulb in self.bulbs:
+                if not self.__lost():
+                    self.__later(self.__delay(self.response_spread), self.__send_datagram, bulb.search_response(), address)
+
+    def __send_datagram(self, data, address):
+        try:
+            self.__search_socket.sendto(data, address)
+        except socket.error:
+            self.dropped += 1
+
+    def __on_accept(self, server, bulb):
+        while True:
+            try:
+                client, address = server.accept()
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK:
+                    return
+                raise
+            if len(bulb.clients) >= self.max_connections:
+                self.refused += 1
+                client.close()
+                continue
+            # non-blocking, a client that does not read holds up no other bulb
+            client.setblocking(0)
+            bulb.clients[client] = ""
+            bulb.output[client] = ""
+            self.__loop.add_reader(client, self.__on_readable, bulb)
+
+    def __close(self, bulb, client):
+        self.__loop.remove_reader(client)
+        self.__loop.remove_writer(client)
+        bulb.clients.pop(client, None)
+        bulb.output.pop(client, None)
+        client.close()
+
+    def __on_readable(self, client, bulb):
+        try:
+            data = client.recv(4096)
+        except socket.error as e:
+            if e.args[0] in WOULD_BLOCK:
+                return
+            data = ""
+        if not data:
+            self.__close(bulb, client)
+            return
+        lines = (bulb.clients[client] + data).split("\n")
+        bulb.clients[client] = lines.pop()
+        for line in lines:
+            if line.strip() and not self.__lost():
+                self.__later(self.__delay(), self.__execute, bulb, client, line)
+
+    def __execute(self, bulb, client, line):
+        try:
+            command = json.loads(line)
+        except ValueError:
+            return
+        reply = { "id" : command.get("id") }
+        changed = {}
+        try:
+            method, params = command.get("method"), command.get("params", [])
+            if method == 'start_cf':
+                self.__start_flow(bulb, params)
+            elif method == 'stop_cf':
+                self.__stop_flow(bulb)
+            reply["result"], changed = bulb.execute(method, params)
+            if method in ('set_power', 'toggle') and bulb.state['power'] == 'off':
+                self.__stop_flow(bulb)
+        except SimulatorError as e:
+            reply["error"] = { "code" : -1, "message" : str(e) }
+        self.__send(bulb, client, reply)
+        self.__notify(bulb, changed)
+
+    def __start_flow(self, bulb, params):
+        self.__stop_flow(bulb)
+        flow = bulb.flow_end_state(params)
+        if flow is not None:
+            bulb.flow_timer = self.__loop.call_later(flow[0], self.__end_flow, bulb, flow[1])
+
+    def __stop_flow(self, bulb):
+        if bulb.flow_timer is not None:
+            bulb.flow_timer.cancel()
+            bulb.flow_timer = None
+
+    def __end_flow(self, bulb, props):
+        bulb.flow_timer = None
+        self.__notify(bulb, bulb.change(**props))
+
+    def __notify(self, bulb, changed):
+        if changed:
+            message = { "method" : "props", "params" : changed }
+            for client in bulb.clients.keys():
+                self.__send(bulb, client, message)
+
+    def __send(self, bulb, client, message):
+        if client not in bulb.output:
+            return
+        bulb.output[client] += json.dumps(message) + "\r\n"
+        if len(bulb.output[client]) > MAX_PENDING_OUTPUT:
+            self.__close(bulb, client)
+            return
+        self.__on_writable(client, bulb)
+
+    def __on_writable(self, client, bulb):
+        try:
+            sent = client.send(bulb.output[client])
+        except socket.error as e:
+            if e.args[0] not in WOULD_BLOCK:
+                self.__close(bulb, client)
+                return
+            sent = 0
+        bulb.output[client] = bulb.output[client][sent:]
+        if bulb.output[client]:
+            self.__loop.add_writer(client, self.__on_writable, bulb)
+        else:
+            self.__loop.remove_writer(client)
+
+    def stats(self):
+        return {
+            "bulbs" : len(self.bulbs),
+            "searches" : self.searches,
+            "commands" : sum([bulb.commands for bulb in self.bulbs]),
+            "connections" : sum([len(bulb.clients) for bulb in self.bulbs]),
+            "refused" : self.refused,
+            "dropped" : self.dropped,
+        }
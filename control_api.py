@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+
+import json
+import errno
+import socket
+import struct
+import base64
+import hashlib
+
+# HTTP/JSON control endpoints and a websocket of state change events, served on the controller's
+# event loop next to discovery and the bulb connections. Handlers only read controller state or queue
+# commands; connecting and writing to the bulbs is left to the command queue's sender threads and a new
+# policy is compiled on the controller's dispatch pool, so one loop thread serves any number of clients.
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+MAX_REQUEST_SIZE = 1024 * 1024
+# a websocket client this far behind on events is dropped instead of buffering forever
+MAX_PENDING_OUTPUT = 4 * 1024 * 1024
+OP_TEXT, OP_CLOSE, OP_PING, OP_PONG = 0x1, 0x8, 0x9, 0xa
+CLOSE_PROTOCOL_ERROR, CLOSE_TOO_BIG = 1002, 1009
+REASONS = { 200 : 'OK', 202 : 'Accepted', 400 : 'Bad Request', 404 : 'Not Found', 405 : 'Method Not Allowed',
+            413 : 'Request Entity Too Large', 500 : 'Internal Server Error' }
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+class ApiError(ValueError):
+
+    def __init__(self, status, message):
+        ValueError.__init__(self, message)
+        self.status = status
+
+class FrameError(ValueError):
+    # a websocket frame the server does not take, code is the status of the close frame sent back
+
+    def __init__(self, code, message):
+        ValueError.__init__(self, message)
+        self.code = code
+
+def websocket_accept(key):
+    return base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest())
+
+def encode_frame(payload, opcode = OP_TEXT):
+    # a final, unmasked server frame
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 0x10000:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+def decode_frame(data):
+    # (opcode, payload, frame size) of the first frame in data, None until it is complete.
+    # Raises FrameError on an unmasked frame or one longer than MAX_REQUEST_SIZE, as soon as
+    # its header says so.
+    if len(data) < 2:
+        return None
+    opcode, length = ord(data[0]) & 0x0f, ord(data[1]) & 0x7f
+    offset = 2
+    if length == 126:
+        if len(data) < 4:
+            return None
+        length, = struct.unpack_from('!H', data, 2)
+        offset = 4
+    elif length == 127:
+        if len(data) < 10:
+            return None
+        length, = struct.unpack_from('!Q', data, 2)
+        offset = 10
+    if not ord(data[1]) & 0x80:
+        # RFC 6455 5.1: a client masks every frame it sends
+        raise FrameError(CLOSE_PROTOCOL_ERROR, "Client frames must be masked")
+    if length > MAX_REQUEST_SIZE:
+        raise FrameError(CLOSE_TOO_BIG, "Frame of %d bytes is too large" % length)
+    if len(data) < offset + 4 + length:
+        return None
+    mask = [ord(c) for c in data[offset:offset + 4]]
+    offset += 4
+    payload = ''.join([chr(ord(c) ^ mask[i % 4]) for i, c in enumerate(data[offset:offset + length])])
+    return opcode, payload, offset + length
+
+class ApiConnection(object):
+    # One client: a single HTTP request and its response, or a websocket receiving events.
+
+    def __init__(self, server, sock, loop):
+        self.server = server
+        self.sock = sock
+        self.loop = loop
+        self.input = ''
+        self.output = ''
+        self.websocket = False
+        self.closing = False
+
+    def on_readable(self, sock):
+        try:
+            data = sock.recv(65536)
+        except socket.error as e:
+            if e.args[0] not in WOULD_BLOCK:
+                self.close()
+            return
+        if not data:
+            self.close()
+            return
+        if self.closing:
+            # whatever comes after the request or a close frame is not read
+            return
+        self.input += data
+        if self.websocket:
+            self.read_frames()
+        else:
+            self.read_request()
+
+    def read_request(self):
+        head, separator, body = self.input.partition('\r\n\r\n')
+        if not separator:
+            if len(self.input) > MAX_REQUEST_SIZE:
+                self.respond(413, { 'error' : 'Request too large' })
+            return
+        lines = head.split('\r\n')
+        try:
+            method, path, version = lines[0].split()
+        except ValueError:
+            self.respond(400, { 'error' : 'Malformed request line' })
+            return
+        headers = {}
+        for line in lines[1:]:
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.respond(400, { 'error' : 'Malformed Content-Length' })
+            return
+        if length > MAX_REQUEST_SIZE:
+            self.respond(413, { 'error' : 'Request too large' })
+            return
+        if len(body) < length:
+            return
+        path = path.split('?')[0]
+        if headers.get('upgrade', '').lower() == 'websocket':
+            self.upgrade(path, headers)
+        else:
+            # nothing more is read while the response is pending
+            self.closing = True
+            self.server.handle(method, path, body[:length], self.respond)
+
+    def upgrade(self, path, headers):
+        if path != '/events':
+            self.respond(404, { 'error' : 'No websocket at %s' % path })
+            return
+        if 'sec-websocket-key' not in headers:
+            self.respond(400, { 'error' : 'Missing Sec-WebSocket-Key' })
+            return
+        self.input = ''
+        self.websocket = True
+        self.write('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                   'Sec-WebSocket-Accept: %s\r\n\r\n' % websocket_accept(headers['sec-websocket-key']))
+
+    def read_frames(self):
+        while not self.closing:
+            try:
+                frame = decode_frame(self.input)
+            except FrameError as e:
+                self.input = ''
+                self.write(encode_frame(struct.pack('!H', e.code) + str(e), OP_CLOSE))
+                self.closing = True
+                self.on_writable(self.sock)
+                return
+            if frame is None:
+                return
+            opcode, payload, size = frame
+            self.input = self.input[size:]
+            if opcode == OP_CLOSE:
+                self.write(encode_frame(payload[:2], OP_CLOSE))
+                self.closing = True
+                self.on_writable(self.sock)
+            elif opcode == OP_PING:
+                self.write(encode_frame(payload, OP_PONG))
+            # anything a client sends otherwise is ignored, the stream only goes out
+
+    def respond(self, status, result):
+        body = json.dumps(result)
+        self.write('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s'
+                   % (status, REASONS.get(status, ''), len(body), body))
+        self.closing = True
+        self.on_writable(self.sock)
+
+    def write(self, data):
+        if self.sock is None:
+            return
+        self.output += data
+        if len(self.output) > MAX_PENDING_OUTPUT:
+            self.close()
+            return
+        self.on_writable(self.sock)
+
+    def on_writable(self, sock):
+        if self.sock is None:
+            return
+        try:
+            sent = self.sock.send(self.output)
+            self.output = self.output[sent:]
+        except socket.error as e:
+            if e.args[0] not in WOULD_BLOCK:
+                self.close()
+                return
+        if self.output:
+            self.loop.add_writer(self.sock, self.on_writable)
+        else:
+            self.loop.remove_writer(self.sock)
+            if self.closing:
+                self.close()
+
+    def close(self):
+        if self.sock is None:
+            return
+        self.loop.remove_reader(self.sock)
+        self.loop.remove_writer(self.sock)
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        self.sock = None
+        self.server.forget(self)
+
+class ControlServer(object):
+    # Serves the control API of a SmartYeelight on an EventLoop:
+    #   GET /bulbs, /groups, /scenes, /presence, /policy, /status   current state as JSON
+    #   POST /commands   {"bulbs": [...] or "group": name, "state": {...} or "scene": name}
+    #   PUT /policy      a light policy, deployed like deploy_policy once it compiled
+    #   GET /events      websocket of {"type": "bulb" | "presence" | "policy", ...} events
+
+    def __init__(self, controller, address = ('127.0.0.1', 8765), logger = None):
+        self.controller = controller
+        self.address = address
+        self.__logger = logger
+        self.__loop = None
+        self.__sock = None
+        self.__connections = set()
+        self.__routes = {
+            ('GET', '/bulbs') : lambda body: (200, controller.get_bulbs()),
+            ('GET', '/groups') : lambda body: (200, controller.get_groups()),
+            ('GET', '/scenes') : lambda body: (200, controller.get_scenes()),
+            ('GET', '/presence') : lambda body: (200, controller.get_presence()),
+            ('GET', '/policy') : lambda body: (200, controller.get_policy()),
+            ('GET', '/status') : lambda body: (200, controller.get_status()),
+            ('POST', '/commands') : self.__post_commands,
+        }
+        # routes that answer later: route(body, respond) calls respond(status, result) on the loop
+        self.__deferred_routes = {
+            ('PUT', '/policy') : self.__put_policy,
+            ('POST', '/policy') : self.__put_policy,
+        }
+
+    def start(self, loop):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(self.address)
+        sock.listen(64)
+        sock.setblocking(0)
+        self.address = sock.getsockname()
+        self.__sock = sock
+        self.__loop = loop
+        loop.add_reader(sock, self.__on_accept)
+
+    def stop(self):
+        # called once the loop is stopped, or on the loop thread
+        if self.__sock is None:
+            return
+        self.__loop.remove_reader(self.__sock)
+        self.__sock.close()
+        self.__sock = None
+        for connection in list(self.__connections):
+            connection.close()
+        self.__loop = None
+
+    def publish(self, event):
+        # thread-safe: send an event to every websocket client
+        loop = self.__loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self.__broadcast, json.dumps(event))
+
+    def clients(self):
+        return len([connection for connection in self.__connections if connection.websocket])
+
+    def forget(self, connection):
+        self.__connections.discard(connection)
+
+    def handle(self, method, path, body, respond):
+        # answers one request with respond(status, JSON serializable result), right away or once a
+        # deferred route finished
+        route = self.__routes.get((method, path))
+        deferred = self.__deferred_routes.get((method, path))
+        if route is None and deferred is None:
+            if [key for key in self.__routes.keys() + self.__deferred_routes.keys() if key[1] == path]:
+                respond(405, { 'error' : 'Method %s not allowed on %s' % (method, path) })
+            else:
+                respond(404, { 'error' : 'Unknown path %s' % path })
+            return
+        try:
+            if deferred is not None:
+                deferred(body, respond)
+            else:
+                respond(*route(body))
+        except Exception as e:
+            status, result = self.__error_response(e)
+            if status == 500 and self.__logger is not None:
+                self.__logger.exception("Control API request %s %s failed", method, path)
+            respond(status, result)
+
+    def __error_response(self, error):
+        if isinstance(error, ApiError):
+            return error.status, { 'error' : str(error) }
+        if isinstance(error, ValueError):
+            return 400, { 'error' : str(error) }
+        return 500, { 'error' : str(error) }
+
+    def __on_accept(self, sock):
+        while True:
+            try:
+                client, address = sock.accept()
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK:
+                    return
+                raise
+            client.setblocking(0)
+            connection = ApiConnection(self, client, self.__loop)
+            self.__connections.add(connection)
+            self.__loop.add_reader(client, connection.on_readable)
+
+    def __broadcast(self, message):
+        frame = encode_frame(message)
+        for connection in list(self.__connections):
+            if connection.websocket and not connection.closing:
+                connection.write(frame)
+
+    def __read_json(self, body):
+        try:
+            return json.loads(body)
+        except ValueError as e:
+            raise ApiError(400, "Invalid JSON body - %s" % e)
+
+    def __post_commands(self, body):
+        command = self.__read_json(body)
+        if not isinstance(command, dict):
+            raise ApiError(400, "Expected a JSON object")
+        group = command.get('group', command.get('bulbs'))
+        state = command.get('scene', command.get('state'))
+        if not group or not state:
+            raise ApiError(400, "A command needs bulbs or group, and state or scene")
+        if not isinstance(group, basestring) and not (isinstance(group, list)
+                                                      and all(isinstance(bulb, basestring) for bulb in group)):
+            raise ApiError(400, "bulbs is a list of bulb ips or names, group a group name")
+        if not isinstance(state, (basestring, dict)):
+            raise ApiError(400, "state is an object of bulb properties, scene a scene name")
+        return 202, self.controller.request_scene(group, state)
+
+    def __put_policy(self, body, respond):
+        policy = self.__read_json(body)
+        if not isinstance(policy, list):
+            raise ApiError(400, "A light policy is a JSON list of bulb policies")
+        for bulb_policy in policy:
+            if not isinstance(bulb_policy, dict) or 'bulb_ip' in bulb_policy and (
+                    not isinstance(bulb_policy['bulb_ip'], list) or not isinstance(bulb_policy.get('policies'), list)
+                    or [entry for entry in bulb_policy['policies'] if not isinstance(entry, dict)]):
+                raise ApiError(400, "A bulb policy is an object with a bulb_ip list and a list of policy objects")
+        # a policy that does not compile is answered with its error, the deployed one is kept then
+        def deployed(error):
+            if error is None:
+                respond(200, { 'bulb_policies' : len(policy) })
+                return
+            status, result = self.__error_response(error)
+            if status == 500 and self.__logger is not None:
+                self.__logger.error("Deploying the policy failed: %s", error)
+            respond(status, result)
+        self.controller.deploy_policy_async(policy, deployed)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+import threading
+import BaseHTTPServer
+from SocketServer import ThreadingMixIn
+
+# Counters, gauges and histograms rendered in the Prometheus text exposition format.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra = ()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(['%s="%s"' % (name, escape_label(value)) for name, value in pairs]) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+class Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelnames = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def label_values(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("%s takes labels %s, got %s" % (self.name, self.labelnames, sorted(labels)))
+        return tuple([labels[name] for name in self.labelnames])
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        with self.lock:
+            samples = sorted(self.values.items())
+        for values, value in samples:
+            lines.append('%s%s %s' % (self.name, format_labels(self.labelnames, values), format_value(value)))
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount = 1, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames = (), function = None):
+        Metric.__init__(self, name, help, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def render(self):
+        if self.function is not None:
+            # evaluated when scraped, so the hot path never updates it
+            with self.lock:
+                self.values[()] = self.function()
+        return Metric.render(self)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames = (), buckets = DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        with self.lock:
+            samples = sorted([(key, (list(state[0]), state[1], state[2])) for key, state in self.values.items()])
+        for values, (counts, total, count) in samples:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labelnames, values, [('le', format_value(float(bound)))])
+                lines.append('%s_bucket%s %d' % (self.name, labels, cumulative))
+            labels = format_labels(self.labelnames, values)
+            lines.append('%s_sum%s %s' % (self.name, labels, format_value(total)))
+            lines.append('%s_count%s %d' % (self.name, labels, count))
+        return lines
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self.__metrics = []
+        self.__lock = threading.Lock()
+
+    def register(self, metric):
+        with self.__lock:
+            self.__metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames = ()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames = (), function = None):
+        return self.register(Gauge(name, help, labelnames, function))
+
+    def histogram(self, name, help, labelnames = (), buckets = DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        with self.__lock:
+            metrics = list(self.__metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+class ThreadingHTTPServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class MetricsServer(object):
+    # Serves GET /metrics of a registry from a background thread.
+
+    def __init__(self, registry, address = ('127.0.0.1', 9464)):
+        self.registry = registry
+        self.address = address
+        self.__server = None
+        self.__thread = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = ThreadingHTTPServer(self.address, Handler)
+        self.address = self.__server.server_address
+        self.__thread = threading.Thread(name = 'MetricsServer', target = self.__server.serve_forever)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def stop(self):
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__thread.join(1)
+            self.__server = None
+            self.__thread = None
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+import re
+
+# Policy time expressions, e.g. "$civil_twilight_end$ - 3600", "min($sunset$ + 1h30m, 23:00)".
+#
+#   expr     := term (('+' | '-') term)*
+#   term     := unary (('*' | '/') unary)*
+#   unary    := '-' unary | atom
+#   atom     := number | duration | time | variable | func '(' expr (',' expr)* ')' | '(' expr ')'
+#   duration := number followed by h, m or s, may be chained: 1h30m
+#   time     := HH:MM or HH:MM:SS, the local time of that day
+#   variable := '$' name '$'
+#
+# Values are seconds; times and variables are epoch seconds. Expressions are parsed once
+# into a tuple based AST and then evaluated against a variable table, without eval().
+
+TOKEN_RE = re.compile(r'''
+    \s*(?:
+      (?P<time>\d{1,2}:\d{2}(?::\d{2})?)
+    | (?P<duration>(?:\d+(?:\.\d+)?[hms])+)
+    | (?P<number>\d+(?:\.\d+)?)
+    | \$(?P<variable>[A-Za-z_][A-Za-z0-9_]*)\$
+    | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<op>[-+*/(),])
+    )''', re.VERBOSE)
+DURATION_PART_RE = re.compile(r'(\d+(?:\.\d+)?)([hms])')
+UNIT_SECONDS = { 'h' : 3600, 'm' : 60, 's' : 1 }
+FUNCTIONS = { 'min' : min, 'max' : max }
+
+class ExpressionError(ValueError):
+    pass
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = TOKEN_RE.match(text, pos)
+        if match is None or match.end() == pos:
+            raise ExpressionError("Unexpected character %r at %d in %r" % (text[pos], pos, text))
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        pos = match.end()
+    tokens.append(('end', None))
+    return tokens
+
+class Parser(object):
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def parse(self):
+        node = self.expr()
+        self.expect('end')
+        return node
+
+    def peek(self):
+        return self.tokens[self.pos]
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def expect(self, kind, value = None):
+        token = self.next()
+        if token[0] != kind or (value is not None and token[1] != value):
+            raise ExpressionError("Expected %s but found %r in %r" % (value or kind, token[1], self.text))
+        return token
+
+    def expr(self):
+        node = self.term()
+        while self.peek() in (('op', '+'), ('op', '-')):
+            node = (self.next()[1], node, self.term())
+        return node
+
+    def term(self):
+        node = self.unary()
+        while self.peek() in (('op', '*'), ('op', '/')):
+            node = (self.next()[1], node, self.unary())
+        return node
+
+    def unary(self):
+        if self.peek() == ('op', '-'):
+            self.next()
+            return ('neg', self.unary())
+        return self.atom()
+
+    def atom(self):
+        kind, value = self.next()
+        if kind == 'number':
+            return ('num', float(value))
+        if kind == 'duration':
+            return ('num', float(sum(float(n) * UNIT_SECONDS[unit] for n, unit in DURATION_PART_RE.findall(value))))
+        if kind == 'time':
+            parts = [int(part) for part in value.split(':')] + [0]
+            return ('time', parts[0], parts[1], parts[2])
+        if kind == 'variable':
+            return ('var', value)
+        if kind == 'name':
+            if value not in FUNCTIONS:
+                raise ExpressionError("Unknown function %s in %r" % (value, self.text))
+            self.expect('op', '(')
+            args = [self.expr()]
+            while self.peek() == ('op', ','):
+                self.next()
+                args.append(self.expr())
+            self.expect('op', ')')
+            return ('call', value, tuple(args))
+        if (kind, value) == ('op', '('):
+            node = self.expr()
+            self.expect('op', ')')
+            return node
+        if kind == 'end':
+            raise ExpressionError("Unexpected end of %r" % self.text)
+        raise ExpressionError("Unexpected %r in %r" % (value, self.text))
+
+def parse(text):
+    return Parser(text).parse()
+
+def evaluate(node, variables, resolve_time = None):
+    # resolve_time(hour, minute, second) returns the epoch seconds of that local time
+    op = node[0]
+    if op == 'num':
+        return node[1]
+    if op == 'var':
+        if node[1] not in variables:
+            raise ExpressionError("Unknown variable $%s$" % node[1])
+        return variables[node[1]]
+    if op == 'time':
+        if resolve_time is None:
+            raise ExpressionError("Time of day %02d:%02d:%02d needs a date" % node[1:])
+        return resolve_time(*node[1:])
+    if op == 'neg':
+        return -evaluate(node[1], variables, resolve_time)
+    if op == 'call':
+        return FUNCTIONS[node[1]]([evaluate(arg, variables, resolve_time) for arg in node[2]])
+    left, right = evaluate(node[1], variables, resolve_time), evaluate(node[2], variables, resolve_time)
+    if op == '+':
+        return left + right
+    if op == '-':
+        return left - right
+    if op == '*':
+        return left * right
+    return left / right
+
+class ExpressionCache(object):
+    # Parsed expressions by source text, so a policy is parsed once and only re-evaluated later.
+
+    def __init__(self):
+        self.__expressions = {}
+
+    def compile(self, text):
+        node = self.__expressions.get(text)
+        if node is None:
+            node = self.__expressions[text] = parse(text)
+        return node
+
+    def evaluate(self, text, variables, resolve_time = None):
+        return evaluate(self.compile(text), variables, resolve_time)
+
+    def clear(self):
+        self.__expressions.clear()
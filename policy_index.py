@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+import math
+import calendar
+from bisect import bisect_left
+
+def to_epoch(value):
+    # aware datetime -> epoch seconds (float), numbers are returned as they are
+    if hasattr(value, 'utctimetuple'):
+        return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+    return value
+
+class PolicySegment(object):
+    # One compiled light policy with everything a lookup needs precomputed.
+    __slots__ = ('policy', 'start', 'end', 'bright_time', 'const_brightness', 'min_brightness',
+                 'brightness_range', 'time_scale')
+
+    def __init__(self, policy):
+        self.policy = policy
+        bright_time, dark_time = to_epoch(policy['bright_time']), to_epoch(policy['dark_time'])
+        self.start, self.end = min(bright_time, dark_time), max(bright_time, dark_time)
+        self.bright_time = bright_time
+        self.const_brightness = policy.get('const_brightness')
+        self.min_brightness = policy.get('min_brightness', 0)
+        self.brightness_range = float(policy.get('max_brightness', 100) - self.min_brightness)
+        # whole seconds, like the datetime difference of the original implementation
+        self.time_scale = float(abs(int(math.floor(bright_time - dark_time))))
+
+    def brightness(self, t):
+        if self.const_brightness is not None:
+            return self.const_brightness
+        if self.time_scale == 0:
+            return self.min_brightness * 2
+        time_passed = abs(int(math.floor(t - self.bright_time)))
+        brightness = int(math.ceil(self.min_brightness + time_passed / self.time_scale * self.brightness_range))
+        brightness += self.min_brightness
+        return brightness
+
+class PolicyIndex(object):
+    # Sorted, non-overlapping segment table of one bulb's policies.
+    #
+    # Policies cover closed ranges [start, end] and the first policy that covers a time wins.
+    # All boundaries are sorted into `points`; piece 2*i is the point points[i] itself and
+    # piece 2*i+1 the open range between points[i] and points[i+1]. Each piece stores the
+    # winning segment (or None), so a lookup is one bisect.
+
+    def __init__(self, policies):
+        self.segments = [PolicySegment(policy) for policy in policies]
+        self.points = sorted(set([segment.start for segment in self.segments] + [segment.end for segment in self.segments]))
+        self.pieces = []
+        for i, point in enumerate(self.points):
+            self.pieces.append(self.__first_match(point, point))
+            if i + 1 < len(self.points):
+                self.pieces.append(self.__first_match(point, self.points[i + 1]))
+
+    def __repr__(self):
+        return 'PolicyIndex(%d segments, %d pieces)' % (len(self.segments), len(self.pieces))
+
+    def __first_match(self, start, end):
+        for segment in self.segments:
+            if segment.start <= start and end <= segment.end:
+                return segment
+        return None
+
+    def __piece(self, t):
+        i = bisect_left(self.points, t)
+        if i < len(self.points) and self.points[i] == t:
+            return 2 * i
+        if i == 0 or i == len(self.points):
+            return None
+        return 2 * i - 1
+
+    def lookup(self, t):
+        # (brightness, policy) at epoch time t, or (-1, None) when no policy matches
+        piece = self.__piece(t)
+        segment = None if piece is None else self.pieces[piece]
+        if segment is None:
+            return -1, None
+        return segment.brightness(t), segment.policy
+
+    def next_change(self, t):
+        # epoch time of the next change of the looked up brightness after t, None if it never changes
+        piece = self.__piece(t)
+        if piece is None:
+            i = bisect_left(self.points, t)
+            return self.points[i] if i < len(self.points) else None
+        segment = self.pieces[piece]
+        if piece % 2 == 0:
+            # a boundary point lasts no time, the next piece starts right after it
+            i = piece // 2
+            return self.points[i] + 1e-6 if i + 1 < len(self.points) else None
+        piece_end = self.points[piece // 2 + 1]
+        if segment is None or segment.const_brightness is not None:
+            return piece_end
+        # a ramp is monotonic within a piece: binary search the first whole second with another value
+        current = segment.brightness(t)
+        low, high = int(math.floor(t)) + 1, int(math.ceil(piece_end))
+        if high <= low or segment.brightness(min(high, piece_end)) == current:
+            return piece_end
+        while low < high:
+            middle = (low + high) // 2
+            if segment.brightness(middle) != current:
+                high = middle
+            else:
+                low = middle + 1
+        return min(low, piece_end)
+
+    def ramp(self, t):
+        # (end, brightness at end) of the ramp running at epoch time t, None outside of a ramp
+        piece = self.__piece(t)
+        if piece is None or piece % 2 == 0:
+            return None
+        segment = self.pieces[piece]
+        if segment is None or segment.const_brightness is not None or segment.time_scale == 0:
+            return None
+        piece_end = self.points[piece // 2 + 1]
+        return piece_end, segment.brightness(piece_end)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import csv
+from datetime import datetime
+from dateutil import tz
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Batch evaluation of compiled light policies over many instants, for previewing a schedule.
+
+def require_numpy():
+    if numpy is None:
+        raise ValueError("NumPy is required to preview light policies")
+
+def lookup_many(index, times):
+    # brightness of a PolicyIndex at every epoch time of a numpy array, -1 where no policy matches;
+    # the same arithmetic as PolicySegment.brightness, so results match PolicyIndex.lookup exactly
+    require_numpy()
+    times = numpy.asarray(times, dtype = numpy.float64)
+    brightness = numpy.full(times.shape, -1, dtype = numpy.int64)
+    if not index.points:
+        return brightness
+    points = numpy.asarray(index.points, dtype = numpy.float64)
+    i = numpy.searchsorted(points, times, 'left')
+    exact = (i < len(points)) & (points[numpy.minimum(i, len(points) - 1)] == times)
+    piece = numpy.where(exact, 2 * i, 2 * i - 1)
+    inside = exact | ((i > 0) & (i < len(points)))
+    for p, segment in enumerate(index.pieces):
+        if segment is None:
+            continue
+        mask = inside & (piece == p)
+        if not mask.any():
+            continue
+        if segment.const_brightness is not None:
+            brightness[mask] = segment.const_brightness
+        elif segment.time_scale == 0:
+            brightness[mask] = segment.min_brightness * 2
+        else:
+            time_passed = numpy.abs(numpy.floor(times[mask] - segment.bright_time))
+            value = numpy.ceil(segment.min_brightness + time_passed / segment.time_scale * segment.brightness_range)
+            brightness[mask] = value.astype(numpy.int64) + segment.min_brightness
+    return brightness
+
+def bulb_brightness(compiled_policy, times, devices_online = True, brightness = None):
+    # {bulb_ip: brightness array} of a compiled policy; like a dispatch, a bulb listed by several
+    # entries gets the last value calculated for it, and entries bound to devices give 0 when
+    # devices_online is False
+    if brightness is None:
+        brightness = {}
+    for bulb in compiled_policy:
+        if 'light_on_only_when_device_online' in bulb and not devices_online:
+            values = numpy.zeros(len(times), dtype = numpy.int64)
+        else:
+            values = lookup_many(bulb['policy_index'], times)
+        for bulb_ip in bulb['bulb_ip']:
+            current = brightness.setdefault(bulb_ip, numpy.full(len(times), -1, dtype = numpy.int64))
+            numpy.copyto(current, values, where = values > -1)
+    return brightness
+
+def format_time(epoch, timezone = None):
+    return datetime.fromtimestamp(epoch, timezone or tz.tzlocal()).isoformat()
+
+def write_csv(path, times, brightness, timezone = None):
+    # one row per instant: local ISO time, then the brightness of every bulb (-1: no policy)
+    bulb_ips = sorted(brightness)
+    if timezone is None:
+        # once per file, not once per row
+        timezone = tz.tzlocal()
+    with open(path, 'wb') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['time'] + bulb_ips)
+        columns = [brightness[bulb_ip].tolist() for bulb_ip in bulb_ips]
+        for row, epoch in enumerate(times.tolist()):
+            writer.writerow([format_time(epoch, timezone)] + [column[row] for column in columns])
+
+def write_parquet(path, times, brightness):
+    # a UTC timestamp column and an int16 column per bulb
+    if pyarrow is None:
+        raise ValueError("pyarrow is required to write Parquet files")
+    bulb_ips = sorted(brightness)
+    columns = [pyarrow.array((times * 1000).astype(numpy.int64), type = pyarrow.timestamp('ms', tz = 'UTC'))]
+    columns += [pyarrow.array(brightness[bulb_ip].astype(numpy.int16)) for bulb_ip in bulb_ips]
+    table = pyarrow.Table.from_arrays(columns, ['time'] + bulb_ips)
+    pyarrow.parquet.write_table(table, path)
+
+def write_preview(path, times, brightness):
+    # Parquet for *.parquet files, CSV otherwise
+    if path.endswith('.parquet'):
+        write_parquet(path, times, brightness)
+    else:
+        write_csv(path, times, brightness)
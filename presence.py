@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+import socket
+import struct
+import errno
+import os
+import threading
+
+ARP_TABLE = '/proc/net/arp'
+ATF_COM = 0x2   # arp entry is complete
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+# 62078 is the iOS lockdown port, open on most iPhones; a refused connection is as good as an accepted one
+DEFAULT_TCP_PORTS = (62078, 80, 443, 22)
+TCP_HIT_ERRORS = (0, errno.ECONNREFUSED)
+PROBE_METHODS = ('icmp', 'tcp', 'arp')
+# options of a PresenceProber that configure() changes, e.g. from the presence section of a config
+PROBE_OPTIONS = ('methods', 'online_threshold', 'offline_delay', 'timeout', 'retry_delay', 'backoff', 'tcp_ports')
+
+def read_arp_table(path = ARP_TABLE):
+    # ip -> mac of every complete entry in the kernel arp table
+    entries = {}
+    try:
+        with open(path) as arp_file:
+            arp_file.readline()    # skip header
+            for line in arp_file:
+                fields = line.split()
+                if len(fields) >= 4 and int(fields[2], 16) & ATF_COM and fields[3] != '00:00:00:00:00:00':
+                    entries[fields[0]] = fields[3]
+    except (IOError, OSError, ValueError):
+        pass
+    return entries
+
+def icmp_checksum(packet):
+    if len(packet) % 2:
+        packet += '\0'
+    total = sum(struct.unpack('!%dH' % (len(packet) // 2), packet))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+def build_icmp_echo(seq, payload = 'yeelight'):
+    ident = os.getpid() & 0xffff
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    checksum = icmp_checksum(header + payload)
+    return struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum, ident, seq) + payload
+
+def open_icmp_socket():
+    # unprivileged ping socket, only available when net.ipv4.ping_group_range allows our group
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.getprotobyname('icmp'))
+    except socket.error:
+        return None
+    sock.setblocking(0)
+    return sock
+
+def check_probe_options(options):
+    # the options as a PresenceProber takes them, ValueError on anything it does not
+    unknown = set(options) - set(PROBE_OPTIONS)
+    if unknown:
+        raise ValueError("Unknown presence options %s" % sorted(unknown))
+    options = dict(options)
+    if 'methods' in options:
+        methods = options['methods']
+        if isinstance(methods, basestring) or not methods or set(methods) - set(PROBE_METHODS):
+            raise ValueError("Presence methods are a list of %s, got %r" % (', '.join(PROBE_METHODS), methods))
+        options['methods'] = tuple(methods)
+    if 'tcp_ports' in options:
+        options['tcp_ports'] = tuple(options['tcp_ports'])
+        if [port for port in options['tcp_ports'] if not isinstance(port, (int, long)) or not 0 < port < 65536]:
+            raise ValueError("Presence tcp_ports must be port numbers, got %r" % (options['tcp_ports'],))
+    for key in ('online_threshold', 'offline_delay'):
+        if key in options and not (isinstance(options[key], (int, long)) and options[key] >= 1):
+            raise ValueError("Presence %s must be a positive integer, got %r" % (key, options[key]))
+    for key in ('timeout', 'retry_delay', 'backoff'):
+        if key in options and not (isinstance(options[key], (int, long, float)) and options[key] > 0):
+            raise ValueError("Presence %s must be a positive number, got %r" % (key, options[key]))
+    return options
+
+class DeviceState(object):
+    __slots__ = ('ip', 'online', 'hits', 'misses', 'probe', 'retry_timer')
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.online = False
+        self.hits = 0
+        self.misses = 0
+        self.probe = None
+        self.retry_timer = None
+
+class Probe(object):
+    __slots__ = ('sockets', 'timer')
+
+    def __init__(self):
+        self.sockets = []
+        self.timer = None
+
+class PresenceProber(object):
+    # Checks every monitored device from the controller's event loop, without forking.
+    # A device goes online after online_threshold consecutive hits and offline after
+    # offline_delay consecutive misses; misses of an online device are re-probed after
+    # retry_delay, growing by backoff each time, instead of waiting for the next round.
+    # methods are any of 'icmp', 'tcp' and 'arp' (a device in the kernel arp table is a hit).
+
+    def __init__(self, interval = 10, offline_delay = 10, online_threshold = 1, timeout = 1.0,
+                 retry_delay = 0.2, backoff = 2, methods = ('icmp', 'tcp'), tcp_ports = DEFAULT_TCP_PORTS,
+                 on_change = None):
+        self.interval = interval
+        self.on_change = on_change
+        options = check_probe_options(dict(offline_delay = offline_delay, online_threshold = online_threshold,
+                                           timeout = timeout, retry_delay = retry_delay, backoff = backoff,
+                                           methods = methods, tcp_ports = tcp_ports))
+        for key, value in options.items():
+            setattr(self, key, value)
+        self.__devices = {}
+        self.__lock = threading.RLock()
+        self.__loop = None
+        self.__round_timer = None
+        self.__icmp_socket = None
+        self.__icmp_seq = 0
+
+    def start(self, loop):
+        with self.__lock:
+            self.__loop = loop
+            self.__round_timer = loop.call_repeatedly(self.interval, self.probe_all)
+
+    def configure(self, **options):
+        # thread-safe; methods take effect with the next round of probes
+        options = check_probe_options(options)
+        with self.__lock:
+            for key, value in options.items():
+                setattr(self, key, value)
+
+    def stop(self):
+        with self.__lock:
+            if self.__round_timer is not None:
+                self.__round_timer.cancel()
+                self.__round_timer = None
+            for state in self.__devices.values():
+                self.__cancel(state)
+            if self.__icmp_socket is not None:
+                self.__loop.remove_reader(self.__icmp_socket)
+                self.__icmp_socket.close()
+                self.__icmp_socket = None
+            self.__loop = None
+
+    def add(self, ip, online = False):
+        # online: the state to start from, e.g. as known before a restart; probes confirm it
+        with self.__lock:
+            if ip not in self.__devices:
+                self.__devices[ip] = DeviceState(ip)
+                self.__devices[ip].online = online
+
+    def remove(self, ip):
+        with self.__lock:
+            state = self.__devices.pop(ip, None)
+            if state is not None:
+                self.__cancel(state)
+
+    def clear(self):
+        with self.__lock:
+            for ip in list(self.__devices):
+                self.remove(ip)
+
+    def devices(self):
+        with self.__lock:
+            return list(self.__devices)
+
+    def is_online(self, ip):
+        with self.__lock:
+            return ip in self.__devices and self.__devices[ip].online
+
+    def online_devices(self):
+        with self.__lock:
+            return [ip for ip, state in self.__devices.items() if state.online]
+
+    def probe_all(self):
+        with self.__lock:
+            self.__update_icmp_socket()
+            for state in self.__devices.values():
+                if state.probe is None and state.retry_timer is None:
+                    self.__start_probe(state.ip)
+
+    def __update_icmp_socket(self):
+        # open the ping socket while icmp is among the methods, close it otherwise
+        if 'icmp' in self.methods and self.__icmp_socket is None:
+            self.__icmp_socket = open_icmp_socket()
+            if self.__icmp_socket is not None:
+                self.__loop.add_reader(self.__icmp_socket, self.__on_icmp_readable)
+        elif 'icmp' not in self.methods and self.__icmp_socket is not None:
+            self.__loop.remove_reader(self.__icmp_socket)
+            self.__icmp_socket.close()
+            self.__icmp_socket = None
+
+    def __cancel(self, state):
+        if state.retry_timer is not None:
+            state.retry_timer.cancel()
+            state.retry_timer = None
+        if state.probe is not None:
+            self.__close_probe(state.probe)
+            state.probe = None
+
+    def __close_probe(self, probe):
+        if probe.timer is not None:
+            probe.timer.cancel()
+        for sock in probe.sockets:
+            if self.__loop is not None:
+                self.__loop.remove_writer(sock)
+            sock.close()
+        probe.sockets = []
+
+    def __start_probe(self, ip):
+        with self.__lock:
+            state = self.__devices.get(ip)
+            if state is None or self.__loop is None:
+                return
+            state.retry_timer = None
+            probe = state.probe = Probe()
+            if self.__icmp_socket is not None:
+                self.__icmp_seq = (self.__icmp_seq + 1) & 0xffff
+                try:
+                    self.__icmp_socket.sendto(build_icmp_echo(self.__icmp_seq), (ip, 0))
+                except socket.error:
+                    pass
+            if 'tcp' in self.methods:
+                for port in self.tcp_ports:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    sock.setblocking(0)
+                    err = sock.connect_ex((ip, port))
+                    if err in TCP_HIT_ERRORS:
+                        sock.close()
+                        self.__finish_probe(ip, True)
+                        return
+                    if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                        probe.sockets.append(sock)
+                        self.__loop.add_writer(sock, self.__on_tcp_writable, ip)
+                    else:
+                        sock.close()
+            probe.timer = self.__loop.call_later(self.timeout, self.__finish_probe, ip, False)
+
+    def __on_icmp_readable(self, sock):
+        while True:
+            try:
+                data, addr = sock.recvfrom(1024)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            if data and ord(data[0]) == ICMP_ECHO_REPLY:
+                self.__finish_probe(addr[0], True)
+
+    def __on_tcp_writable(self, sock, ip):
+        self.__loop.remove_writer(sock)
+        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) in TCP_HIT_ERRORS:
+            self.__finish_probe(ip, True)
+
+    def __finish_probe(self, ip, hit):
+        with self.__lock:
+            state = self.__devices.get(ip)
+            if state is None or state.probe is None:
+                return
+            self.__close_probe(state.probe)
+            state.probe = None
+            if not hit and 'arp' in self.methods:
+                hit = ip in read_arp_table()
+            changed = self.__record(state, hit)
+        if changed and self.on_change is not None:
+            self.on_change(ip, state.online)
+
+    def __record(self, state, hit):
+        if hit:
+            state.misses = 0
+            state.hits += 1
+            if not state.online and state.hits >= self.online_threshold:
+                state.online = True
+                return True
+            return False
+        state.hits = 0
+        state.misses += 1
+        if not state.online:
+            return False
+        if state.misses >= self.offline_delay:
+            state.online = False
+            return True
+        delay = min(self.retry_delay * self.backoff ** (state.misses - 1), self.interval)
+        state.retry_timer = self.__loop.call_later(delay, self.__start_probe, state.ip)
+        return False
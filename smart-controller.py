@@ -1,229 +1,690 @@
 #!/usr/bin/env python
 
 from YeelightWifiBulbLanCtrl import *
+from presence import PresenceProber, check_probe_options
+from policy_expr import ExpressionCache
+from policy_index import PolicyIndex, to_epoch
+import policy_preview
+from policy_preview import numpy
+from sun_time import SunTimeCache, DEFAULT_CACHE_FILE as DEFAULT_SUN_TIME_CACHE_FILE
+from metrics import MetricsRegistry, MetricsServer
+from state_snapshot import Snapshot, SnapshotError, write_snapshot
+from control_api import ControlServer
 import json
 import urllib2
 import math
 import sys, os
 import threading
+import multiprocessing
+import Queue
+import zlib
+from multiprocessing.pool import ThreadPool
 import signal
 import logging, logging.handlers
 from collections import Counter
+try:
+    import yaml
+except ImportError:
+    yaml = None
 # sudo apt-get install python-dateutil
 import time
-from datetime import date, datetime
+import heapq
+from datetime import date, datetime, timedelta
 from dateutil import tz
 import dateutil.parser
 
+# how ramp policies are sent: None steps set_bright on every change, 'flow' runs one start_cf
+# color flow and 'smooth' one set_bright transition over the remaining ramp
+RAMP_MODES = (None, 'flow', 'smooth')
+MIN_RAMP_STEP_MS = 50
+DEFAULT_RAMP_CT = 4000
+# one local timezone object for the whole process instead of a new one per call
+LOCAL_TZ = tz.tzlocal()
+# a bulb without an open connection is online while it answered discovery this recently; searches
+# back off to every SEARCH_INTERVAL seconds
+BULB_ONLINE_WINDOW = 2 * SEARCH_INTERVAL + 5
+SCENE_STATE_RANGES = { 'bright' : (1, 100), 'ct' : (1700, 6500), 'rgb' : (0, 0xffffff) }
+# finer than DEBUG: whole policies, bulbs and per tick results are only formatted at this level
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
+
 class SmartYeelight(object):
 
-    def __init__(self, apply_light_policy_interval = 10, device_detection_interval = 10, device_offline_delay = 10, logging_level = logging.INFO):
-        self.__yeelight_detection_thread = None
-        self.__device_detection_thread = None
-        self.__device_detection_thread_woker = {}
-        self.__device_detection_thread_rlock = threading.Lock()
+    def __init__(self, apply_light_policy_interval = 10, device_detection_interval = 10, device_offline_delay = 10, logging_level = logging.INFO,
+                 dispatch_workers = 16, dispatch_timeout = CONNECT_TIMEOUT + 1,
+                 latitude = None, longitude = None, sun_time_cache_file = DEFAULT_SUN_TIME_CACHE_FILE,
+                 policy_max_sleep = 3600, ramp_mode = None, ramp_min_duration = 60, ramp_drift_tolerance = 5,
+                 discovery_interfaces = None, lan_transport = None, run_discovery = True, metrics_address = None,
+                 snapshot_file = None, snapshot_interval = 60, snapshot_revalidate = 60, api_address = None,
+                 presence_methods = ('icmp', 'tcp'), presence_online_threshold = 1, presence_retry_delay = 0.2,
+                 presence_backoff = 2):
+        if ramp_mode not in RAMP_MODES:
+            raise ValueError("Unknown ramp mode %r, expected one of %s" % (ramp_mode, RAMP_MODES))
+        self.__event_loop = None
+        self.__event_loop_thread = None
+        self.__discovery = None
+        self.__discovery_interfaces = discovery_interfaces
+        self.__lan_transport = lan_transport
+        self.__run_discovery = run_discovery
         self.__thread_rlock = threading.Lock()
-        self.__apply_light_policy_thread = None
         self.__current_geo = None
+        if latitude is not None and longitude is not None:
+            self.__current_geo = { 'latitude' : latitude, 'longitude' : longitude }
+        self.__sun_time_cache = None
+        self.__sun_time_cache_file = sun_time_cache_file
+        self.__light_policy = []
         self.__compiled_policy = []
-        self.__compiled_policy_date = None
+        self.__compiled_day = (0, 0)
+        self.__compiled_entries = {}
+        self.__policy_expressions = ExpressionCache()
         self.__device_on_monitor = []
         self.__device_online = []
         self.__device_detection_interval = device_detection_interval
         self.__apply_light_policy_interval = apply_light_policy_interval
         self.__device_offline_delay = device_offline_delay
+        self.__dispatch_workers = dispatch_workers
+        self.__dispatch_timeout = dispatch_timeout
+        self.__dispatch_pool = None
+        self.__dispatch_lock = threading.Lock()
+        self.__deploy_lock = threading.Lock()
+        self.__policy_max_sleep = policy_max_sleep
+        self.__policy_heap = []
+        self.__policy_schedule = {}
+        self.__policy_timer = None
+        self.__scheduled_policy = None
+        self.__policy_in_flight = set()
+        self.__policy_redo = set()
+        self.__policy_wake_lock = threading.Lock()
+        self.__policy_wake_all = False
+        self.__policy_wake_ips = set()
+        self.__ramp_mode = ramp_mode
+        self.__ramp_min_duration = ramp_min_duration
+        self.__ramp_drift_tolerance = ramp_drift_tolerance
+        self.__offloaded_ramps = {}
+        self.__dispatch_counts = Counter()
+        self.__metrics_address = metrics_address
+        self.__metrics_server = None
+        self.__api_address = api_address
+        self.__control_server = None
+        self.__setup_metrics()
+        self.__presence = PresenceProber(interval = device_detection_interval, offline_delay = device_offline_delay,
+                                         online_threshold = presence_online_threshold, retry_delay = presence_retry_delay,
+                                         backoff = presence_backoff, methods = presence_methods,
+                                         on_change = self.__on_device_presence_changed)
+        self.__groups = {}
+        self.__scenes = {}
+        # bulb ip -> time a scene was set, the light policy leaves the bulb alone until its next step
+        self.__scene_holds = {}
+        self.__scene_holds_lock = threading.Lock()
         self.__config = {}
+        self.__config_file = None
+        self.__config_poll_interval = None
+        self.__config_stat = None
+        self.__config_timer = None
+        self.__log_handlers = []
+        self.__snapshot_file = snapshot_file
+        self.__snapshot_interval = snapshot_interval
+        self.__snapshot_revalidate = snapshot_revalidate
+        self.__snapshot_timer = None
+        self.__restored_bulbs = {}
+        self.__restored_online = set()
         self.__RUNNING = False
         # a few setups
         self.register_signal_handler()
         self.__setup_log(logging_level = logging_level)
+        if snapshot_file is not None:
+            self.__load_snapshot()
         self.__logger.info("Controller instance created")
 
     def __setup_log(self, log_file = None, logging_level = None):
         rootLogger = logging.getLogger("SmartYeelightCtrl")
         if logging_level is None:
             logging_level = logging.INFO
+        elif isinstance(logging_level, basestring):
+            # names as written in a config file, e.g. "DEBUG"
+            logging_level = logging.getLevelName(logging_level.upper())
         rootLogger.setLevel(logging_level)
+        # a config reload sets the log up again, drop the handlers of the previous setup
+        for handler in self.__log_handlers:
+            rootLogger.removeHandler(handler)
+            handler.close()
+        self.__log_handlers = []
         formatter = logging.Formatter('%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
         # create the logging file handler
         if log_file is not None:
             fh = logging.handlers.RotatingFileHandler(log_file, maxBytes=1024 * 1024 * 5, backupCount=5)
             fh.setFormatter(formatter)
-            rootLogger.addHandler(fh)
+            self.__log_handlers.append(fh)
         ch = logging.StreamHandler(sys.stdout)
         ch.setFormatter(formatter)
-        rootLogger.addHandler(ch)
+        self.__log_handlers.append(ch)
+        for handler in self.__log_handlers:
+            rootLogger.addHandler(handler)
         self.__logger = rootLogger
 
+    def __setup_metrics(self):
+        metrics = self.__metrics = MetricsRegistry()
+        self.__commands_sent = metrics.counter('yeelight_commands_sent_total', 'Commands sent to a bulb', ['bulb'])
+        self.__commands_failed = metrics.counter('yeelight_commands_failed_total', 'Commands that could not be sent to a bulb', ['bulb'])
+        self.__dispatch_results = metrics.counter('yeelight_dispatch_results_total', 'Bulb dispatch results by status', ['status'])
+        self.__command_latency = metrics.histogram('yeelight_command_latency_seconds', 'Time to send the commands of one dispatch to a bulb')
+        self.__policy_tick_duration = metrics.histogram('yeelight_policy_tick_seconds', 'Duration of one light policy evaluation')
+        self.__ssdp_parse_duration = metrics.histogram('yeelight_ssdp_parse_seconds', 'Time to parse and apply one discovery datagram',
+                                                       buckets = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.01))
+        metrics.gauge('yeelight_bulbs_known', 'Bulbs in the registry, found by discovery or restored and not removed since', function = lambda: len(bulb_registry))
+        metrics.gauge('yeelight_bulbs_online', 'Bulbs with an open connection or seen within %d seconds' % BULB_ONLINE_WINDOW,
+                      function = lambda: len(self.get_online_bulbs()))
+        metrics.gauge('yeelight_devices_online', 'Monitored devices that are online', function = lambda: len(self.__device_online))
+        metrics.gauge('yeelight_bulbs_reconciling', 'Bulbs that did not report their desired state yet',
+                      function = lambda: command_queue.stats()['desired'])
+        metrics.gauge('yeelight_devices_monitored', 'Devices monitored for presence', function = lambda: len(self.__device_on_monitor))
+
+    def get_metrics(self):
+        # all metrics in the Prometheus text format, as served on metrics_address/metrics
+        return self.__metrics.render()
+
     def deploy_policy(self, light_policy):
-        self.__get_compiled_policy(light_policy, enforce_update = True)
-        self.__logger.info("New policy loaded: %s", self.__compiled_policy)
+        # only bulb entries that changed are compiled and evaluated again, the others keep their schedule
+        # a policy that fails to compile raises here and the deployed one stays in place
+        with self.__deploy_lock:
+            previous = set([id(bulb) for bulb in self.__compiled_policy or []])
+            compiled_policy = self.__get_compiled_policy(light_policy, enforce_update = True) or []
+            self.__light_policy = light_policy
+        changed = [bulb for bulb in compiled_policy if id(bulb) not in previous]
+        self.__logger.info("New policy loaded for %d bulb policies, %d changed", len(compiled_policy), len(changed))
+        self.__logger.log(TRACE, "New policy: %s", compiled_policy)
+        changed_ips = set()
+        for bulb in changed:
+            changed_ips.update(bulb["bulb_ip"])
+        if changed_ips:
+            # a new policy for a bulb takes over from a scene set on it
+            self.__hold_scene(changed_ips, None)
+            self.__wake_light_policy(changed_ips)
+        self.__publish_event({ "type" : "policy", "bulb_policies" : len(compiled_policy), "changed" : len(changed) })
+
+    def deploy_policy_async(self, light_policy, callback):
+        # deploy_policy on the dispatch pool, as compiling may wait on the geo lookup and the sun times;
+        # callback(error) then runs on the event loop with None or the exception deploy_policy raised
+        loop = self.__event_loop
+        def deploy():
+            try:
+                self.deploy_policy(light_policy)
+            except Exception as e:
+                return e
+        self.__get_dispatch_pool().apply_async(deploy, callback = lambda error: loop.call_soon_threadsafe(callback, error))
+
+    def get_policy(self):
+        return self.__light_policy
 
     def load_config_file(self, config_file):
-        with open(config_file, encoding='utf-8') as data_file:
-            self.__logger.info("Reading config from file %s", config_file)
-            config = json.load(data_file)
-            self.load_config(config)
+        # a JSON config, or YAML when the file is named *.yaml/*.yml and PyYAML is installed
+        self.__logger.info("Reading config from file %s", config_file)
+        with open(config_file) as data_file:
+            if config_file.endswith(('.yaml', '.yml')):
+                if yaml is None:
+                    raise ValueError("PyYAML is required to read %s" % config_file)
+                config = yaml.safe_load(data_file)
+            else:
+                config = json.load(data_file)
+        self.load_config(config or {})
 
     def load_config(self, config):
-        if config['log']:
-            self.__setup_log(log_file = config['log']['log_file'], logging_level = config['log']['logging_level'])
-        if data['policy']:
+        # sections that did not change since the last config are left alone; nothing is applied
+        # unless the log, scenes, groups, presence options and policy are all valid
+        scenes, groups, presence, log = self.__scenes, self.__groups, None, None
+        if config.get('log') and config['log'] != self.__config.get('log'):
+            log = self.__check_log_options(config['log'])
+        if config.get('presence') and config['presence'] != self.__config.get('presence'):
+            if not isinstance(config['presence'], dict):
+                raise ValueError("The presence section is an object of presence options")
+            presence = check_probe_options(config['presence'])
+        if 'scenes' in config:
+            scenes = dict((name, self.__check_scene_state(state)) for name, state in (config['scenes'] or {}).items())
+        if 'groups' in config:
+            groups = dict((name, list(bulbs)) for name, bulbs in (config['groups'] or {}).items() if bulbs)
+        if config.get('policy') and config['policy'] != self.__config.get('policy'):
             self.deploy_policy(config['policy'])
-        self.__logger.info("Config loaded: %s", config)
+        self.__scenes, self.__groups = scenes, groups
+        if presence is not None:
+            self.__presence.configure(**presence)
+        if log is not None:
+            self.__setup_log(**log)
+        self.__logger.info("Config loaded")
+        self.__logger.log(TRACE, "Config: %s", config)
         self.__config = config
 
-    def __start_yeelight(self, daemon = False):
-        if self.__yeelight_detection_thread is None:
-            RUNNING = True
-            self.__yeelight_detection_thread = Thread(name = 'YeelightThread', target = bulbs_detection_loop)
-            self.__yeelight_detection_thread.setDaemon(daemon)
-            self.__yeelight_detection_thread.start()
-
-    def __stop_yeelight(self):
-        self.__logger.debug("Stopping yeelight worker thread..")
-        if self.__yeelight_detection_thread is not None:
-            RUNNING = False
-            self.__yeelight_detection_thread.join(1)
-            self.__yeelight_detection_thread = None
-            self.__logger.debug("Yeelight worker thread stopped")
+    def __check_log_options(self, log):
+        if not isinstance(log, dict):
+            raise ValueError("The log section is an object with log_file and logging_level")
+        unknown = set(log) - set(['log_file', 'logging_level'])
+        if unknown:
+            raise ValueError("Unknown log options %s" % sorted(unknown))
+        logging_level = log.get('logging_level')
+        if isinstance(logging_level, basestring):
+            # getLevelName maps a known name to its number and anything else to "Level ..."
+            logging_level = logging.getLevelName(logging_level.upper())
+        if logging_level is not None and not isinstance(logging_level, (int, long)):
+            raise ValueError("Unknown logging_level %r" % log['logging_level'])
+        log_file = log.get('log_file')
+        if log_file is not None:
+            if not isinstance(log_file, basestring):
+                raise ValueError("log_file must be a path, got %r" % log_file)
+            # the handler appends to the file, find out now whether it can
+            try:
+                open(log_file, 'a').close()
+            except IOError as e:
+                raise ValueError("Cannot write log_file %s: %s" % (log_file, e.strerror))
+        return { 'log_file' : log_file, 'logging_level' : logging_level }
+
+    def watch_config_file(self, config_file, poll_interval = 2):
+        # load the config now and again whenever the file changes (checked every poll_interval seconds,
+        # no polling when None) or the process receives SIGHUP
+        self.__config_file = config_file
+        self.__config_poll_interval = poll_interval
+        self.__config_stat = self.__get_config_stat()
+        self.load_config_file(config_file)
+        with self.__thread_rlock:
+            if self.__event_loop_thread is not None:
+                self.__event_loop.call_soon_threadsafe(self.__arm_config_watch)
+
+    def reload_config(self):
+        if self.__config_file is None:
+            self.__logger.warning("No config file to reload")
+            return
+        self.__config_stat = self.__get_config_stat()
+        try:
+            self.load_config_file(self.__config_file)
+        except Exception as e:
+            # keep running with the config loaded last
+            self.__logger.error("Failed to reload config from %s: %s", self.__config_file, e)
+
+    def __get_config_stat(self):
+        try:
+            stat = os.stat(self.__config_file)
+        except OSError:
+            return None
+        # editors often save by renaming a new file over the old one
+        return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+    def __check_config_file(self):
+        stat = self.__get_config_stat()
+        if stat is not None and stat != self.__config_stat:
+            self.__logger.info("Config file %s changed", self.__config_file)
+            self.reload_config()
+
+    def __arm_config_watch(self):
+        if self.__config_timer is not None:
+            self.__config_timer.cancel()
+            self.__config_timer = None
+        if self.__config_file is not None and self.__config_poll_interval:
+            self.__config_timer = self.__event_loop.call_repeatedly(self.__config_poll_interval, self.__check_config_file)
+
+    def save_snapshot(self):
+        # bulbs, device presence, geo location and today's compiled policy, so a restart can act
+        # before discovery and presence probes answered
+        if self.__snapshot_file is None:
+            return
+        compiled_entries = [{ 'key' : key, 'compiled' : self.__dump_compiled_bulb_policy(compiled) }
+                            for key, compiled in self.__compiled_entries.items()]
+        sections = [
+            ('bulbs', [bulb.as_dict() for bulb in bulb_registry]),
+            ('presence', { 'monitored' : list(self.__device_on_monitor), 'online' : list(self.__device_online) }),
+            ('geo', self.__current_geo),
+            ('policy', { 'source' : self.__light_policy, 'day' : list(self.__compiled_day), 'entries' : compiled_entries }),
+        ]
+        try:
+            write_snapshot(self.__snapshot_file, sections)
+        except (IOError, OSError, TypeError, ValueError) as e:
+            self.__logger.error("Failed to write snapshot %s: %s", self.__snapshot_file, e)
+            return
+        self.__logger.debug("Snapshot written to %s", self.__snapshot_file)
+
+    def __load_snapshot(self):
+        try:
+            with Snapshot(self.__snapshot_file) as snapshot:
+                bulbs = snapshot.get('bulbs') or []
+                presence = snapshot.get('presence') or {}
+                geo = snapshot.get('geo')
+                policy = snapshot.get('policy') or {}
+        except (IOError, OSError) as e:
+            self.__logger.info("No snapshot loaded from %s: %s", self.__snapshot_file, e)
+            return
+        except SnapshotError as e:
+            self.__logger.warning("Ignoring snapshot: %s", e)
+            return
+        restored = bulb_registry.restore(bulbs)
+        # the bulbs have snapshot_revalidate seconds after start to be seen again
+        self.__restored_bulbs = dict((bulb.id, bulb.last_seen) for bulb in restored)
+        self.__restored_online = set(presence.get('online', []))
+        if self.__current_geo is None and geo:
+            self.__current_geo = geo
+        day = tuple(policy.get('day') or (0, 0))
+        if day[0] <= time.time() < day[1]:
+            # compiled the same day: entries of the policy deployed below are not compiled again
+            self.__compiled_entries = dict((entry['key'], self.__load_compiled_bulb_policy(entry['compiled']))
+                                           for entry in policy.get('entries', []))
+            self.__compiled_day = day
+        if policy.get('source') and not self.__light_policy:
+            self.deploy_policy(policy['source'])
+        self.__logger.info("Snapshot %s restored: %d bulbs, %d compiled bulb policies", self.__snapshot_file,
+                           len(restored), len(self.__compiled_entries))
+
+    def __dump_compiled_bulb_policy(self, compiled_bulb_policy):
+        # datetimes are saved as epoch seconds, the policy index is built again when loading
+        entry = dict((key, value) for key, value in compiled_bulb_policy.items() if key != 'policy_index')
+        entry['policies'] = [dict((key, { 'epoch' : to_epoch(value) } if isinstance(value, datetime) else value)
+                                  for key, value in policy.items()) for policy in compiled_bulb_policy['policies']]
+        return entry
+
+    def __load_compiled_bulb_policy(self, entry):
+        entry = dict(entry)
+        entry['policies'] = [dict((key, datetime.fromtimestamp(value['epoch'], LOCAL_TZ) if isinstance(value, dict) and 'epoch' in value else value)
+                                  for key, value in policy.items()) for policy in entry['policies']]
+        entry['policy_index'] = PolicyIndex(entry['policies'])
+        return entry
+
+    def __expire_restored_bulbs(self):
+        # restored bulbs that did not answer a search or send anything over their connection since the start are gone
+        restored, self.__restored_bulbs = self.__restored_bulbs, {}
+        for bulb in bulb_registry:
+            if bulb.id in restored and bulb.last_seen <= restored[bulb.id]:
+                self.__logger.info("Bulb %s from the snapshot was not found again, removing it", bulb.ip)
+                bulb_registry.remove(bulb.id)
 
     def __register_device_for_monitor(self, device_list = []):
         for device_ip in device_list:
             if device_ip not in self.__device_on_monitor:
                 self.__device_on_monitor.append(device_ip)
+                # devices online before a restart count as online until probes tell otherwise
+                online = device_ip in self.__restored_online
+                self.__presence.add(device_ip, online = online)
+                if online and device_ip not in self.__device_online:
+                    self.__device_online.append(device_ip)
 
-    def __unregister_all_device_for_monitor(self):
-        self.__stop_detect_device_worker()
-        self.__device_on_monitor = []
-        self.__device_online = []
+    def __unregister_device_for_monitor(self, device_ip):
+        self.__presence.remove(device_ip)
+        if device_ip in self.__device_on_monitor:
+            self.__device_on_monitor.remove(device_ip)
+        if device_ip in self.__device_online:
+            self.__device_online.remove(device_ip)
+
+    def __sync_devices_for_monitor(self, compiled_policy):
+        # devices still referenced keep their probe and presence state
+        devices = []
+        for bulb in compiled_policy:
+            for device_ip in bulb.get('light_on_only_when_device_online', []):
+                if device_ip not in devices:
+                    devices.append(device_ip)
+        for device_ip in list(self.__device_on_monitor):
+            if device_ip not in devices:
+                self.__unregister_device_for_monitor(device_ip)
+        self.__register_device_for_monitor(devices)
 
-    def __detect_device_loop(self):
-        while self.__device_detection_thread is not None:
-            with self.__device_detection_thread_rlock:
-                for device_ip in self.__device_on_monitor:
-                    if device_ip in self.__device_detection_thread_woker:
-                        continue
-                    self.__logger.debug("Starting device detection worker thread for ip %s", device_ip)
-                    thread = Thread(name = 'DeviceDetectionWorkerThread', target = self.__detect_device_worker, args = (device_ip, ))
-                    self.__device_detection_thread_woker[device_ip] = thread
-                    thread.setDaemon(True)
-                    thread.start()
-            sleep(self.__device_detection_interval)
-
-    def __detect_device_worker(self, ip):
-        while ip in self.__device_detection_thread_woker:
-            self.__logger.debug("Detecting if device %s is online..", ip)
-            retry = self.__device_offline_delay
-            device_is_online = False
-            while not device_is_online and retry > 0:
-                retry -= 1
-                device_is_online = (os.system("ping -c 1 "+ ip +" > /dev/null 2>&1") == 0)
-                if ip not in self.__device_online:
-                    if device_is_online:
-                        self.__device_online.append(ip)
-                        self.__logger.info('Device is online: %s', ip)
-                        break
-                    if retry > 0:
-                        self.__logger.debug('Device %s is going to be offline in %s retries.', ip, retry)
-                sleep(0.2)
-            if not device_is_online and ip in self.__device_online:
+    def __on_device_presence_changed(self, ip, online):
+        if online:
+            if ip not in self.__device_online:
+                self.__device_online.append(ip)
+            self.__logger.info('Device is online: %s', ip)
+        else:
+            if ip in self.__device_online:
                 self.__device_online.remove(ip)
-                self.__logger.info('Device is offline: %s', ip)
-            sleep(self.__device_detection_interval)
-
-    def __start_detect_device(self, daemon = False):
-        if self.__device_detection_thread is None:
-            self.__device_detection_thread = Thread(name = 'DeviceDetectionThread', target = self.__detect_device_loop)
-            self.__device_detection_thread.setDaemon(daemon)
-            self.__device_detection_thread.start()
-
-    def __stop_detect_device(self):
-        self.__logger.debug("Stopping device detection thread..")
-        if self.__device_detection_thread is not None:
-            thread = self.__device_detection_thread
-            # set thread to None so that the loop can exit
-            self.__device_detection_thread = None
-            thread.join(0.2)
-            self.__logger.debug("Device detection thread stopped")
-
-    def __stop_detect_device_worker(self):
-        with self.__device_detection_thread_rlock:
-            if self.__device_detection_thread_woker:
-                self.__logger.debug("Stopping device detection worker thread..")
-            for ip in list(self.__device_detection_thread_woker):
-                self.__logger.debug("Stopping device detection worker thread for %s..", ip)
-                thread = self.__device_detection_thread_woker[ip]
-                self.__device_detection_thread_woker.pop(ip, None)
-                thread.join(0.2)
-        self.__logger.debug("Device detection worker thread stopped")
-
-    def __apply_light_policy_loop(self):
-        while self.__apply_light_policy_thread is not None:
-            self.__apply_light_policy()
-            sleep(self.__apply_light_policy_interval)
-
-    def __apply_light_policy(self):
-        # update compiled policy
-        self.__get_compiled_policy(light_policy)
-        # recalculate light brightness
-        calculated_light_brigtness = self.calculate_light_brightness()
-        change_applied = self.change_yeelight_brightness(calculated_light_brigtness)
-        # if a change is a applied, we want to refresh the light status
-        # sometimes passively listening for light status change doesn't work
-        if change_applied:
+            self.__logger.info('Device is offline: %s', ip)
+        self.__publish_event({ "type" : "presence", "ip" : ip, "online" : online })
+        self.__wake_light_policy()
+
+    def __wake_light_policy(self, bulb_ips = None):
+        # thread-safe: evaluate the given bulbs (all when None) on the event loop as soon as possible
+        with self.__policy_wake_lock:
+            if self.__event_loop_thread is None:
+                return
+            schedule = not self.__policy_wake_all and not self.__policy_wake_ips
+            if bulb_ips is None:
+                self.__policy_wake_all = True
+            else:
+                self.__policy_wake_ips.update(bulb_ips)
+            if schedule:
+                self.__event_loop.call_soon_threadsafe(self.__on_light_policy_wake)
+
+    def __on_light_policy_wake(self):
+        with self.__policy_wake_lock:
+            wake_all, wake_ips = self.__policy_wake_all, self.__policy_wake_ips
+            self.__policy_wake_all, self.__policy_wake_ips = False, set()
+        if wake_all:
+            self.__apply_light_policy(everything = True)
+        elif wake_ips:
+            self.__apply_light_policy(bulb_ips = wake_ips)
+
+    def __on_bulb_state_changed(self, ip, changed):
+        self.__publish_event({ "type" : "bulb", "ip" : ip, "changed" : changed })
+        self.__wake_light_policy([ip])
+
+    def __publish_event(self, event):
+        # thread-safe: stream an event to the websocket clients of the control API
+        control_server = self.__control_server
+        if control_server is not None:
+            control_server.publish(event)
+
+    def __apply_light_policy(self, bulb_ips = None, everything = False):
+        # evaluates the bulbs that are due (or the given ones), then sleeps until the next brightness step
+        started = now = time.time()
+        compiled_policy = self.__get_compiled_policy(self.__light_policy, now)
+        recompiled = []
+        if compiled_policy is not self.__scheduled_policy:
+            # the policy was (re)compiled: bulb entries reused from the previous compilation keep
+            # their schedule, new ones are evaluated right away
+            previous = self.__scheduled_policy or []
+            schedule = dict((id(previous[i]), when) for i, when in self.__policy_schedule.items())
+            unscheduled = set([id(bulb) for bulb in previous]) - set(schedule)
+            self.__scheduled_policy = compiled_policy
+            self.__policy_heap = []
+            self.__policy_schedule = {}
+            for i, bulb in enumerate(compiled_policy or []):
+                when = schedule.get(id(bulb))
+                if when is None:
+                    if id(bulb) not in unscheduled:
+                        recompiled.append(i)
+                else:
+                    self.__policy_schedule[i] = when
+                    heapq.heappush(self.__policy_heap, (when, i))
+        if compiled_policy is None:
+            self.__logger.error("No policy is found. Skip light update")
+            entries = []
+        elif everything:
+            entries = range(len(compiled_policy))
+        elif bulb_ips is not None:
+            entries = [i for i, bulb in enumerate(compiled_policy) if i in recompiled or set(bulb["bulb_ip"]) & set(bulb_ips)]
+        else:
+            entries = list(recompiled)
+            while self.__policy_heap and self.__policy_heap[0][0] <= now:
+                when, i = heapq.heappop(self.__policy_heap)
+                if self.__policy_schedule.get(i) == when and i not in recompiled:
+                    entries.append(i)
+        in_flight = [i for i in entries if id(compiled_policy[i]) in self.__policy_in_flight]
+        if in_flight:
+            # still waiting for bulbs of the last dispatch: evaluate again as soon as it is done
+            self.__policy_redo.update([id(compiled_policy[i]) for i in in_flight])
+            entries = [i for i in entries if i not in in_flight]
+        if entries:
+            # recalculate light brightness; the bulbs are set on the dispatch pool, so the loop keeps
+            # reading replies and running timers, and the entries are scheduled again once all answered
+            bulbs = [compiled_policy[i] for i in entries]
+            calculated_light_brigtness = self.__release_scene_holds(self.__calculate_light_brightness(bulbs, now), bulbs, now)
+            self.__policy_in_flight.update([id(bulb) for bulb in bulbs])
+            for i in entries:
+                self.__policy_schedule.pop(i, None)
+            self.__dispatch_brightness_async(calculated_light_brigtness,
+                                             lambda report: self.__on_light_policy_dispatched(bulbs, now, report))
+        self.__policy_tick_duration.observe(time.time() - started)
+        self.__arm_light_policy_timer(now)
+
+    def __release_scene_holds(self, calculated_light_brigtness, bulbs, now):
+        # drop the bulbs set to a scene since the current step of their policy, they follow it again at its next step
+        with self.__scene_holds_lock:
+            if not self.__scene_holds:
+                return calculated_light_brigtness
+            released = []
+            for bulb, calculated_light in zip(bulbs, calculated_light_brigtness):
+                bulb_ips = []
+                for bulb_ip in calculated_light["bulb_ip"]:
+                    scene_time = self.__scene_holds.get(bulb_ip)
+                    if scene_time is not None:
+                        step = bulb['policy_index'].next_change(scene_time)
+                        if step is None or step > now:
+                            continue
+                        del self.__scene_holds[bulb_ip]
+                    bulb_ips.append(bulb_ip)
+                if bulb_ips:
+                    released.append(dict(calculated_light, bulb_ip = bulb_ips))
+            return released
+
+    def __hold_scene(self, bulb_ips, scene_time):
+        # a scene_time of None hands the bulbs back to the policy, e.g. when the scene did not reach them
+        with self.__scene_holds_lock:
+            for bulb_ip in bulb_ips:
+                if scene_time is None:
+                    self.__scene_holds.pop(bulb_ip, None)
+                else:
+                    self.__scene_holds[bulb_ip] = scene_time
+
+    def __on_light_policy_dispatched(self, bulbs, now, report):
+        # runs on the event loop with the report of the dispatch started at now
+        self.__dispatch_counts.update([report[bulb_ip]["status"] for bulb_ip in report])
+        for bulb_ip in report:
+            self.__dispatch_results.inc(status = report[bulb_ip]["status"])
+        if [bulb_ip for bulb_ip in report if report[bulb_ip]["status"] == "applied"]:
             self.__logger.info("Change applied")
         else:
             self.__logger.debug("No change is applied")
-        self.__logger.debug("Refreshing light status..")
-        try:
-            send_search_broadcast()
-        except:
-            self.__logger.error("Error refreshing light status")
-
-    def __start_apply_light_policy(self, daemon = False):
-        if self.__apply_light_policy_thread is None:
-            self.__apply_light_policy_thread = Thread(name = 'ApplyLightPolicyThread', target = self.__apply_light_policy_loop)
-            self.__apply_light_policy_thread.setDaemon(daemon)
-            self.__apply_light_policy_thread.start()
-
-    def __stop_apply_light_policy(self):
-        self.__logger.debug("Stopping light policy executor thread..")
-        if self.__apply_light_policy_thread is not None:
-            thread = self.__apply_light_policy_thread
-            # set thread to None so that the loop can exit
-            self.__apply_light_policy_thread = None
-            thread.join(0.2)
-            self.__logger.debug("Light policy executor thread stopped")
-
-    def __get_overlap_between_lists(self, list1, list2):
-        l1_multiset = Counter(list1)
-        l2_multiset = Counter(list2)
-        overlap = list((l1_multiset & l2_multiset).elements())
-        return overlap
+        # the policy may have been recompiled meanwhile, reused entries keep their identity
+        positions = dict((id(bulb), i) for i, bulb in enumerate(self.__scheduled_policy or []))
+        failed_ips = set([bulb_ip for bulb_ip in report if report[bulb_ip]["status"] in ("offline", "error", "timeout", "throttled")])
+        for bulb in bulbs:
+            self.__policy_in_flight.discard(id(bulb))
+            redo = id(bulb) in self.__policy_redo
+            self.__policy_redo.discard(id(bulb))
+            i = positions.get(id(bulb))
+            if i is None:
+                continue
+            when = bulb['policy_index'].next_change(now)
+            ramp_ends = [report[bulb_ip]["ramp"][0] for bulb_ip in bulb["bulb_ip"] if "ramp" in report.get(bulb_ip, {})]
+            if ramp_ends and len(ramp_ends) == len(bulb["bulb_ip"]):
+                # the bulbs run the ramp by themselves, only look at them again when it is over
+                when = min(ramp_ends)
+            if failed_ips & set(bulb["bulb_ip"]):
+                # retry bulbs that could not be reached
+                when = now + self.__apply_light_policy_interval if when is None else min(when, now + self.__apply_light_policy_interval)
+            if redo:
+                when = time.time()
+            if when is not None:
+                self.__policy_schedule[i] = when
+                heapq.heappush(self.__policy_heap, (when, i))
+            else:
+                self.__policy_schedule.pop(i, None)
+        if self.__event_loop_thread is not None:
+            self.__arm_light_policy_timer(time.time())
+
+    def __arm_light_policy_timer(self, now):
+        while self.__policy_heap and self.__policy_schedule.get(self.__policy_heap[0][1]) != self.__policy_heap[0][0]:
+            heapq.heappop(self.__policy_heap)
+        # wake up at the next brightness step, at midnight to compile the new day, or after policy_max_sleep
+        wake_up = min(self.__compiled_day[1], now + self.__policy_max_sleep)
+        if self.__policy_heap:
+            wake_up = min(wake_up, self.__policy_heap[0][0])
+        if self.__policy_timer is not None:
+            self.__policy_timer.cancel()
+        delay = max(0, wake_up - time.time())
+        self.__logger.debug("Next light policy evaluation in %.1f seconds", delay)
+        self.__policy_timer = self.__event_loop.call_later(delay, self.__apply_light_policy)
+
+    def __run_event_loop(self):
+        self.__logger.debug("Event loop running")
+        self.__event_loop.run_forever()
+        self.__logger.debug("Event loop stopped")
 
     def __at_least_one_device_online(self, device_list):
-        if len(device_list) > 0 and self.__get_overlap_between_lists(device_list, self.__device_online):
-            return True
-        else:
-            return False
+        for device_ip in device_list:
+            if device_ip in self.__device_online:
+                return True
+        return False
 
     def start(self, daemon = False):
         self.__logger.debug("Controller started")
         with self.__thread_rlock:
-            self.__start_yeelight(daemon = daemon)
-            self.__start_detect_device(daemon = daemon)
-            self.__start_apply_light_policy(daemon = daemon)
+            if self.__event_loop_thread is not None:
+                return
+            # discovery, device detection and light policy all share one event loop thread
+            self.__event_loop = EventLoop()
+            if self.__run_discovery:
+                self.__discovery = attach_discovery(self.__event_loop, interfaces = self.__discovery_interfaces,
+                                                    transport = self.__lan_transport)
+            connection_pool.attach(self.__event_loop)
+            command_queue.attach(self.__event_loop)
+            self.__presence.start(self.__event_loop)
+            self.__arm_config_watch()
+            if self.__snapshot_file is not None and self.__snapshot_interval:
+                self.__snapshot_timer = self.__event_loop.call_repeatedly(self.__snapshot_interval, self.save_snapshot)
+            if self.__restored_bulbs:
+                self.__event_loop.call_later(self.__snapshot_revalidate, self.__expire_restored_bulbs)
+            self.__scheduled_policy = None
+            self.__policy_in_flight = set()
+            self.__policy_redo = set()
+            add_bulb_state_listener(self.__on_bulb_state_changed)
+            bulb_discovery.parse_observers.append(self.__ssdp_parse_duration.observe)
+            if self.__metrics_address is not None:
+                self.__metrics_server = MetricsServer(self.__metrics, self.__metrics_address)
+                self.__metrics_server.start()
+                self.__logger.info("Serving metrics on http://%s:%d/metrics", *self.__metrics_server.address)
+            if self.__api_address is not None:
+                self.__control_server = ControlServer(self, self.__api_address, logger = self.__logger)
+                self.__control_server.start(self.__event_loop)
+                self.__logger.info("Serving the control API on http://%s:%d/", *self.__control_server.address)
+            self.__event_loop_thread = Thread(name = 'EventLoopThread', target = self.__run_event_loop)
+            self.__event_loop_thread.setDaemon(daemon)
+            self.__event_loop_thread.start()
             self.__RUNNING = True
+        self.__wake_light_policy()
 
     def stop(self, terminate_process = False):
         self.__logger.debug("Stopping Controller..")
         with self.__thread_rlock:
             self.__RUNNING = False
-            self.__stop_apply_light_policy()
-            self.__stop_detect_device()
-            self.__stop_detect_device_worker()
-            self.__stop_yeelight()
+            event_loop_thread = self.__event_loop_thread
+            remove_bulb_state_listener(self.__on_bulb_state_changed)
+            if self.__ssdp_parse_duration.observe in bulb_discovery.parse_observers:
+                bulb_discovery.parse_observers.remove(self.__ssdp_parse_duration.observe)
+            if self.__metrics_server is not None:
+                self.__metrics_server.stop()
+                self.__metrics_server = None
+            if self.__event_loop_thread is not None:
+                self.__event_loop.stop()
+                if self.__event_loop_thread is not threading.current_thread():
+                    self.__event_loop_thread.join(1)
+                self.__event_loop_thread = None
+            if self.__control_server is not None:
+                self.__control_server.stop()
+                self.__control_server = None
+            if self.__policy_timer is not None:
+                self.__policy_timer.cancel()
+                self.__policy_timer = None
+            if self.__config_timer is not None:
+                self.__config_timer.cancel()
+                self.__config_timer = None
+            if self.__snapshot_timer is not None:
+                self.__snapshot_timer.cancel()
+                self.__snapshot_timer = None
+            if self.__discovery is not None:
+                detach_discovery(self.__event_loop, self.__discovery)
+                self.__discovery.transport.close()
+                self.__discovery = None
+            self.__presence.stop()
+            self.save_snapshot()
+            self.__stop_dispatch_pool()
+            command_queue.detach()
+            connection_pool.detach()
+            connection_pool.close_all()
+            if event_loop_thread is not None and not event_loop_thread.is_alive():
+                # release the wakeup pipe, a start creates a new loop
+                self.__event_loop.close()
         self.__logger.debug("Controller stopped")
         if terminate_process:
             try:
@@ -234,11 +695,55 @@ class SmartYeelight(object):
     def is_running(self):
         return self.__RUNNING
 
+    def get_bulb_latency_stats(self):
+        return connection_pool.latency_stats()
+
+    def get_discovery_stats(self):
+        return bulb_discovery.latency_stats()
+
+    def get_bulbs(self):
+        return [bulb.as_dict() for bulb in bulb_registry]
+
+    def get_presence(self):
+        return { "monitored" : list(self.__device_on_monitor), "online" : list(self.__device_online) }
+
+    def get_status(self):
+        # summary of this controller, also what a sharded worker reports to its supervisor
+        policy_bulbs = set()
+        for bulb in self.__compiled_policy or []:
+            policy_bulbs.update(bulb["bulb_ip"])
+        return {
+            "pid" : os.getpid(),
+            "running" : self.__RUNNING,
+            "bulbs" : len(bulb_registry),
+            "bulbs_online" : len(self.get_online_bulbs()),
+            "policy_bulbs" : len(policy_bulbs),
+            "devices_online" : list(self.__device_online),
+            "dispatch" : dict(self.__dispatch_counts),
+            "latency" : connection_pool.latency_stats(),
+            "reconcile" : command_queue.stats(),
+        }
+
+    def get_online_bulbs(self):
+        # ips of the known bulbs that are reachable now, as opposed to restored or gone quiet
+        connected = connection_pool.connected()
+        seen_after = time.time() - BULB_ONLINE_WINDOW
+        return [bulb.ip for bulb in bulb_registry if bulb.ip in connected or bulb.last_seen >= seen_after]
+
     def register_signal_handler(self):
         signal.signal(signal.SIGTSTP, self.__signal_handler)
         signal.signal(signal.SIGINT, self.__signal_handler)
         signal.signal(signal.SIGTERM, self.__signal_handler)
         signal.signal(signal.SIGUSR1, self.__signal_handler)
+        signal.signal(signal.SIGHUP, self.__reload_signal_handler)
+
+    def __reload_signal_handler(self, signal, frame):
+        self.__logger.info("Reload signal captured: %s", signal)
+        if self.__event_loop_thread is not None:
+            # reload on the event loop, between two policy evaluations
+            self.__event_loop.call_soon_threadsafe(self.reload_config)
+        else:
+            self.reload_config()
 
     def __signal_handler(self, signal, frame):
         self.__logger.info("Terminate signal captured: %s. Stopping controller threads..", signal)
@@ -260,7 +765,7 @@ class SmartYeelight(object):
         else:
             return dateutil.parser.parse(str(iso_time))
 
-    def __get_localtime(self, iso_time, timezone = tz.tzlocal()):
+    def __get_localtime(self, iso_time, timezone = LOCAL_TZ):
         d = self.__get_datetime(iso_time)
         try:
             d = d.astimezone(timezone) # aware object can be in any timezone
@@ -268,188 +773,691 @@ class SmartYeelight(object):
             d = d.replace(tzinfo = timezone)
         return d
 
-    def __parse_time(self, time_string, current_time, format = '%H:%M:%S'):
-        time  = datetime.strptime(time_string, format).replace(year = current_time.year, month = current_time.month, day = current_time.day, tzinfo = tz.tzlocal())
-        return self.__get_localtime(time)
-
-    def __get_diff_between_datetime(self, datetime1, datetime2 = datetime(1970,1,1)):
-        td = datetime1 - datetime2
-        return (td.microseconds + (td.seconds + td.days * 86400) * 10**6) / 10**6
-
-    def __get_compiled_policy(self, light_policy, current_time = None, enforce_update = False):
-        if current_time is None:
-            current_time = datetime.now().replace(tzinfo = tz.tzlocal())
-        if enforce_update or self.__compiled_policy_date is None or current_time.date() != self.__compiled_policy_date.date():
-            self.__unregister_all_device_for_monitor()
-            self.__compiled_policy = self.__compile_policy(light_policy, current_time)
-            self.__compiled_policy_date = current_time
-            self.__logger.info('Local policy cache updated: %s', self.__compiled_policy)
-        return self.__compiled_policy
+    def __get_local_day(self, day):
+        # epoch seconds of the local midnights starting and ending a date, 23 or 25 hours apart on a DST change
+        start = datetime.combine(day, datetime.min.time()).replace(tzinfo = LOCAL_TZ)
+        end = datetime.combine(day + timedelta(days = 1), datetime.min.time()).replace(tzinfo = LOCAL_TZ)
+        return to_epoch(start), to_epoch(end)
 
-    def __get_compiled_key(self, key):
-        return '$'+ key +'$'
+    def __get_compiled_policy(self, light_policy, now = None, enforce_update = False):
+        # now is epoch seconds: a tick only compares it with the bounds of the compiled day
+        if now is None:
+            now = time.time()
+        new_day = not self.__compiled_day[0] <= now < self.__compiled_day[1]
+        if enforce_update or new_day:
+            current_time = datetime.fromtimestamp(now, LOCAL_TZ)
+            # sun times and clock times resolve to other instants on a new day
+            compiled_entries = {} if new_day else dict(self.__compiled_entries)
+            # compiled aside, so a policy that fails to compile changes nothing
+            compiled_policy = self.__compile_policy(light_policy, current_time, compiled_entries)
+            self.__compiled_entries = compiled_entries
+            self.__compiled_policy = compiled_policy
+            self.__compiled_day = self.__get_local_day(current_time.date())
+            self.__sync_devices_for_monitor(self.__compiled_policy)
+            self.__logger.info('Local policy cache updated for %s', current_time.date())
+            self.__logger.log(TRACE, 'Local policy cache: %s', self.__compiled_policy)
+        return self.__compiled_policy
 
-    def __compile_policy_value(self, str_value, value_dict):
-        value = str_value
-        if not '$' in value:
-            return value
-        self.__logger.debug("Compiling value %s", value)
+    def __get_policy_variables(self, value_dict):
+        # the variable table of policy expressions: datetimes as epoch seconds, numbers as they are
+        variables = {}
         for key in value_dict:
-            self.__logger.debug("Searching for key %s", key)
             val = value_dict[key]
             if id(type) and type(val) in (datetime, date):
-                self.__logger.debug("Value in dictionary: %s -> %s", key, val)
                 val = time.mktime(self.__get_localtime(val).timetuple())
-                self.__logger.debug("Timestamp converted: %s -> %s", key, val)
-            value = value.replace(self.__get_compiled_key(key), str(val))
-            self.__logger.debug("Value after convertsion: %s", value)
-        int_value = int(eval(value))
+            if isinstance(val, (int, long, float)):
+                variables[key] = val
+        return variables
+
+    def __compile_policy_value(self, str_value, variables, current_time):
+        self.__logger.debug("Compiling value %s", str_value)
+        def resolve_time(hour, minute, second):
+            return time.mktime((current_time.year, current_time.month, current_time.day, hour, minute, second, 0, 0, -1))
+        # expressions are parsed once and cached, a new day only evaluates them again
+        int_value = int(self.__policy_expressions.evaluate(str_value, variables, resolve_time))
         compiled_value = self.__get_localtime(int_value)
         self.__logger.debug("Compiled value: %s", compiled_value)
         return compiled_value
 
-    def __compile_policy(self, light_policy, current_time):
+    def __compile_policy(self, light_policy, current_time, compiled_entries = None):
+        # compiled_entries maps bulb entries compiled earlier the same day to their compiled policy;
+        # those are reused as they are and the map is replaced by the entries of light_policy
         compiled_policy = []
-        today = current_time.date()
-        today_sun_time = self.get_sun_time(today)
+        reusable = dict(compiled_entries or {})
+        compiled = {}
+        variables = None
         for bulb in light_policy:
             if 'bulb_ip' not in bulb:
                 continue
-            compiled_bulb_policy = { "bulb_ip" : bulb["bulb_ip"], "policies" : [] }
-            if 'light_on_only_when_device_online' in bulb and bulb['light_on_only_when_device_online']:
-                compiled_bulb_policy['light_on_only_when_device_online'] = bulb['light_on_only_when_device_online']
-                self.__register_device_for_monitor(compiled_bulb_policy['light_on_only_when_device_online'])
-            for policy in bulb['policies']:
-                compiled_light_policy = {}
-                # replace keywords with dynamic time
-                for key in policy:
-                    if isinstance(policy[key], basestring):
-                        compiled_light_policy[key] = self.__compile_policy_value(policy[key], today_sun_time)
-                    else:
-                        compiled_light_policy[key] = policy[key]
-                if 'bright_time' not in compiled_light_policy or 'dark_time' not in compiled_light_policy:
-                    continue
-                # 24-hour format
-                if isinstance(compiled_light_policy['bright_time'], basestring):
-                    compiled_light_policy['bright_time'] = self.__parse_time(compiled_light_policy['bright_time'], current_time)
-                if isinstance(compiled_light_policy['dark_time'], basestring):
-                    compiled_light_policy['dark_time'] =  self.__parse_time(compiled_light_policy['dark_time'], current_time)
-                # we remove the obsoleted from compiled policy
-                if max(compiled_light_policy['bright_time'], compiled_light_policy['dark_time']) < current_time:
-                    continue
-                if 'const_brightness' in compiled_light_policy:
-                    compiled_light_policy['const_brightness'] = int(compiled_light_policy['const_brightness'])
-                    compiled_light_policy.pop('min_brightness', None)
-                    compiled_light_policy.pop('max_brightness', None)
-                compiled_bulb_policy["policies"].append(compiled_light_policy)
+            key = json.dumps(bulb, sort_keys = True, default = str)
+            compiled_bulb_policy = compiled.get(key) or reusable.get(key)
+            if compiled_bulb_policy is None:
+                if variables is None:
+                    variables = self.__get_policy_variables(self.get_sun_time(current_time.date()))
+                compiled_bulb_policy = self.__compile_bulb_policy(bulb, variables, current_time)
+            compiled[key] = compiled_bulb_policy
             compiled_policy.append(compiled_bulb_policy)
-        self.__logger.debug('Policy compiled: %s', compiled_policy)
+        if compiled_entries is not None:
+            compiled_entries.clear()
+            compiled_entries.update(compiled)
+        self.__logger.log(TRACE, 'Policy compiled: %s', compiled_policy)
         return compiled_policy
 
+    def __compile_bulb_policy(self, bulb, variables, current_time):
+        compiled_bulb_policy = { "bulb_ip" : bulb["bulb_ip"], "policies" : [] }
+        if 'light_on_only_when_device_online' in bulb and bulb['light_on_only_when_device_online']:
+            compiled_bulb_policy['light_on_only_when_device_online'] = bulb['light_on_only_when_device_online']
+        for policy in bulb['policies']:
+            compiled_light_policy = {}
+            # evaluate time expressions: 24-hour times, $sun_time$ variables and arithmetic
+            for key in policy:
+                if isinstance(policy[key], basestring) and (key in ('bright_time', 'dark_time') or '$' in policy[key]):
+                    compiled_light_policy[key] = self.__compile_policy_value(policy[key], variables, current_time)
+                else:
+                    compiled_light_policy[key] = policy[key]
+            if 'bright_time' not in compiled_light_policy or 'dark_time' not in compiled_light_policy:
+                continue
+            # we remove the obsoleted from compiled policy
+            if max(compiled_light_policy['bright_time'], compiled_light_policy['dark_time']) < current_time:
+                continue
+            if 'const_brightness' in compiled_light_policy:
+                compiled_light_policy['const_brightness'] = int(compiled_light_policy['const_brightness'])
+                compiled_light_policy.pop('min_brightness', None)
+                compiled_light_policy.pop('max_brightness', None)
+            compiled_bulb_policy["policies"].append(compiled_light_policy)
+        # sorted segment table, so a brightness lookup is a bisect instead of a scan
+        compiled_bulb_policy["policy_index"] = PolicyIndex(compiled_bulb_policy["policies"])
+        return compiled_bulb_policy
+
     def calculate_light_brightness(self, current_time = None, light_policy = None):
         self.__logger.debug('Calculating light brightness..')
-        if current_time is None:
-            current_time = datetime.now().replace(tzinfo = tz.tzlocal())
+        current_epoch = time.time() if current_time is None else to_epoch(current_time)
         calculated_light_brigtness = []
         compiled_policy = self.__compiled_policy
         if light_policy is not None:
-            compiled_policy = self.__compile_policy(light_policy, current_time)
+            compiled_policy = self.__compile_policy(light_policy, current_time or datetime.fromtimestamp(current_epoch, LOCAL_TZ))
         if compiled_policy is None:
             self.__logger.error("No policy is found. Skip light update")
             return calculated_light_brigtness
+        return self.__calculate_light_brightness(compiled_policy, current_epoch)
+
+    def __calculate_light_brightness(self, compiled_policy, current_epoch):
+        calculated_light_brigtness = []
         for bulb in compiled_policy:
             calculated_light = { "bulb_ip" : bulb["bulb_ip"] }
             if 'light_on_only_when_device_online' in bulb and not self.__at_least_one_device_online(bulb["light_on_only_when_device_online"]):
                 # if required devices are not online, turn off the light
                 calculated_light["calculated_brightness"] = 0
             else:
-                for policy in bulb['policies']:
-                    brightness = self.__calculate_light_brightness(current_time, policy)
-                    if brightness > -1:
-                        calculated_light["calculated_brightness"] = brightness
-                        calculated_light["policy_matched"] = policy
-                        break
+                brightness, policy = bulb['policy_index'].lookup(current_epoch)
+                if brightness > -1:
+                    calculated_light["calculated_brightness"] = brightness
+                    calculated_light["policy_matched"] = policy
+                    ramp = self.__get_ramp(bulb, current_epoch)
+                    if ramp is not None and brightness > 0:
+                        calculated_light["ramp"] = ramp
             if 'calculated_brightness' in calculated_light:
                 calculated_light_brigtness.append(calculated_light)
-        self.__logger.debug('Calculated light brightness: %s', calculated_light_brigtness)
+        self.__logger.debug('Calculated light brightness of %d bulb policies', len(calculated_light_brigtness))
+        self.__logger.log(TRACE, 'Calculated light brightness: %s', calculated_light_brigtness)
         return calculated_light_brigtness
 
-    def __calculate_light_brightness(self, current_time, light_policy = {}):
-        bright_time, dark_time = light_policy['bright_time'], light_policy['dark_time']
-        if current_time < min(bright_time, dark_time) or current_time > max(bright_time, dark_time):
-            return -1   # return -1 when current time is not within the bright_time and dark_time range
-        # if there is a constant brightness value, return immediately
-        if 'const_brightness' in light_policy:
-            return light_policy['const_brightness']
-        min_brightness, max_brightness = 0, 100
-        if 'min_brightness' in light_policy:
-            min_brightness = light_policy['min_brightness']
-        if 'max_brightness' in light_policy:
-            max_brightness = light_policy['max_brightness']
-        time_scale = abs(self.__get_diff_between_datetime(bright_time, dark_time))
-        time_passed = abs(self.__get_diff_between_datetime(current_time, bright_time))
-        brightness = int(math.ceil(min_brightness + float(time_passed) / float(time_scale) * float(max_brightness - min_brightness)))
-        brightness += min_brightness
-        return brightness
+    def __get_ramp(self, bulb, current_epoch):
+        # (end, brightness at end) of a ramp long enough to hand over to the bulb
+        if self.__ramp_mode is None:
+            return None
+        ramp = bulb['policy_index'].ramp(current_epoch)
+        if ramp is None or ramp[0] - current_epoch < self.__ramp_min_duration:
+            return None
+        return ramp
+
+    def preview_light_brightness(self, start, end, resolution = 60, light_policy = None, devices_online = True, output = None):
+        # what-if evaluation of a policy (the deployed one by default) from start to end (aware datetimes) every
+        # resolution seconds, compiling it once per local day. Returns (epoch times, {bulb_ip: brightness}) as
+        # NumPy arrays, -1 where no policy applies; devices_online decides the presence bound entries. With
+        # output the result is also written to that CSV or *.parquet file.
+        policy_preview.require_numpy()
+        if light_policy is None:
+            light_policy = self.__light_policy
+        times = numpy.arange(to_epoch(start), to_epoch(end), resolution, dtype = numpy.float64)
+        brightness = dict((bulb_ip, numpy.full(len(times), -1, dtype = numpy.int64))
+                          for bulb in light_policy if 'bulb_ip' in bulb for bulb_ip in bulb['bulb_ip'])
+        day = start.astimezone(LOCAL_TZ).date()
+        while len(times):
+            first, last = numpy.searchsorted(times, self.__get_local_day(day))
+            if first < last:
+                midnight = datetime.combine(day, datetime.min.time()).replace(tzinfo = LOCAL_TZ)
+                compiled_policy = self.__compile_policy(light_policy, midnight)
+                day_brightness = policy_preview.bulb_brightness(compiled_policy, times[first:last], devices_online)
+                for bulb_ip, values in day_brightness.items():
+                    brightness[bulb_ip][first:last] = values
+            if last >= len(times):
+                break
+            day += timedelta(days = 1)
+        if output is not None:
+            policy_preview.write_preview(output, times, brightness)
+        return times, brightness
+
+    def next_light_change_time(self, current_time = None):
+        # the earliest time any bulb's calculated brightness changes (ignoring device presence), None if never
+        current_epoch = time.time() if current_time is None else to_epoch(current_time)
+        change_times = [bulb['policy_index'].next_change(current_epoch) for bulb in self.__compiled_policy]
+        change_times = [t for t in change_times if t is not None]
+        if not change_times:
+            return None
+        return self.__get_localtime(datetime.fromtimestamp(min(change_times), tz.tzutc()))
 
     def __get_geo(self):
-        api_url = 'https://freegeoip.net/json'
-        while self.__current_geo is None:
+        # only used when no latitude/longitude is configured
+        api_url = 'https://ipapi.co/json'
+        retry = 3
+        while self.__current_geo is None and retry > 0:
+            retry -= 1
             r = self.__http_get(api_url)
             self.__logger.info('Geo Location: %s', r)
-            self.__current_geo = r
+            if r is not None and 'latitude' in r and 'longitude' in r:
+                self.__current_geo = r
+        if self.__current_geo is None:
+            raise ValueError("Unable to locate the controller, please configure latitude and longitude")
         return self.__current_geo
 
+    def __get_sun_time_cache(self, geo):
+        lat, lng = float(geo['latitude']), float(geo['longitude'])
+        if self.__sun_time_cache is None or (self.__sun_time_cache.lat, self.__sun_time_cache.lng) != (lat, lng):
+            self.__sun_time_cache = SunTimeCache(lat, lng, cache_file = self.__sun_time_cache_file, logger = self.__logger)
+        return self.__sun_time_cache
+
     def get_sun_time(self, date, geo = None):
         if geo is None:
             geo = self.__get_geo()
-        lat, lng = geo['latitude'], geo['longitude']
-        api_url = 'http://api.sunrise-sunset.org/json?formatted=0&lat='+ str(lat) +'&lng='+ str(lng) +'&date='+ str(date)
-        self.__logger.debug('Sunset/Sunset API URL: %s', api_url)
-        r = self.__http_get(api_url)
-        t = r['results']
-        self.__logger.debug('Sunrise/Sunset (UTC) time for date '+ str(date) +': %s', t)
-        t['sunrise'] = self.__get_localtime(t['sunrise'])
-        t['sunset'] = self.__get_localtime(t['sunset'])
-        t['civil_twilight_begin'] = self.__get_localtime(t['civil_twilight_begin'])
-        t['civil_twilight_end'] = self.__get_localtime(t['civil_twilight_end'])
-        self.__logger.info('Sunrise/Sunset (local) time for date '+ str(date) +': %s', t)
+        # computed locally (NOAA solar calculator) and cached on disk for a year, no network needed
+        t = self.__get_sun_time_cache(geo).get(date)
+        self.__logger.log(TRACE, 'Sunrise/Sunset (UTC) time for date %s: %s', date, t)
+        for key in t:
+            if isinstance(t[key], datetime):
+                t[key] = self.__get_localtime(t[key])
+        self.__logger.info('Sunrise/Sunset (local) time for date %s: %s / %s', date, t['sunrise'], t['sunset'])
+        self.__logger.log(TRACE, 'Sun times (local) for date %s: %s', date, t)
         return t
 
     def change_yeelight_brightness(self, bulb_policy = []):
+        report = self.dispatch_yeelight_brightness(bulb_policy)
         change_applied = False
-        for policy in bulb_policy:
-            if self.__change_yeelight_brightness(policy):
+        for bulb_ip in report:
+            if report[bulb_ip]["status"] == "applied":
                 change_applied = True
+            elif report[bulb_ip]["status"] in ("error", "timeout"):
+                self.__logger.warning("Failed to change yeelight %s: %s", bulb_ip, report[bulb_ip])
         return change_applied
 
-    def __change_yeelight_brightness(self, bulb_policy):
-        bulb_ip_list, target_bulb_brightness = bulb_policy["bulb_ip"], bulb_policy["calculated_brightness"]
-        change_applied = False
-        for bulb_ip in bulb_ip_list:
-            if bulb_ip not in detected_bulbs:
-                self.__logger.warning("Bulb %s is offline.", bulb_ip)
+    def dispatch_yeelight_brightness(self, bulb_policy = [], timeout = None):
+        # send the calculated brightness to all target bulbs in parallel and return a report of
+        # {bulb_ip: {"status": ..., "commands": [...]}}; status is applied, unchanged, queued (sent once the
+        # bulb is below its command quota again), throttled, offline, error or timeout
+        if timeout is None:
+            timeout = self.__dispatch_timeout
+        # a bulb listed by several policies gets the last calculated brightness
+        target_brightness = {}
+        for policy in bulb_policy:
+            for bulb_ip in policy["bulb_ip"]:
+                target_brightness[bulb_ip] = (policy["calculated_brightness"], policy.get("ramp"))
+        return self.__dispatch(dict((bulb_ip, (self.__change_yeelight_brightness, (bulb_ip, brightness, ramp)))
+                                    for bulb_ip, (brightness, ramp) in target_brightness.items()), timeout)
+
+    def __dispatch_brightness_async(self, bulb_policy, callback):
+        # like dispatch_yeelight_brightness without waiting: callback(report) runs on the event loop
+        target_brightness = {}
+        for policy in bulb_policy:
+            for bulb_ip in policy["bulb_ip"]:
+                target_brightness[bulb_ip] = (policy["calculated_brightness"], policy.get("ramp"))
+        self.__dispatch_async(dict((bulb_ip, (self.__change_yeelight_brightness, (bulb_ip, brightness, ramp)))
+                                   for bulb_ip, (brightness, ramp) in target_brightness.items()), self.__dispatch_timeout, callback)
+
+    def __dispatch_async(self, jobs, timeout, callback):
+        # run {bulb_ip: (function, args)} on the dispatch pool and hand {bulb_ip: result} to callback on the
+        # event loop once every bulb answered, or when the timeout passed with the rest reported as timeout
+        loop = self.__event_loop
+        if not jobs:
+            loop.call_soon_threadsafe(callback, {})
+            return
+        pool = self.__get_dispatch_pool()
+        report = {}
+        lock = threading.Lock()
+        state = { 'finished' : False, 'timer' : None }
+        def finish():
+            with lock:
+                if state['finished']:
+                    return
+                state['finished'] = True
+            if state['timer'] is not None:
+                state['timer'].cancel()
+            callback(dict((bulb_ip, report.get(bulb_ip, { "status" : "timeout", "commands" : [] })) for bulb_ip in jobs))
+        def completed(bulb_ip, result):
+            with lock:
+                if state['finished']:
+                    return
+                report[bulb_ip] = result
+                done = len(report) == len(jobs)
+            if done:
+                loop.call_soon_threadsafe(finish)
+        for bulb_ip, (function, args) in jobs.items():
+            pool.apply_async(run_dispatch_job, (function, args), callback = lambda result, bulb_ip = bulb_ip: completed(bulb_ip, result))
+        # bulbs are served in waves of dispatch_workers, each one gets its own timeout
+        waves = int(math.ceil(float(len(jobs)) / self.__dispatch_workers))
+        state['timer'] = loop.call_later(timeout * waves, finish)
+
+    def __dispatch(self, jobs, timeout):
+        # run {bulb_ip: (function, args)} on the dispatch pool and collect {bulb_ip: result}
+        if not jobs:
+            return {}
+        pool = self.__get_dispatch_pool()
+        results = {}
+        for bulb_ip, (function, args) in jobs.items():
+            results[bulb_ip] = pool.apply_async(function, args)
+        # bulbs are served in waves of dispatch_workers, each one gets its own timeout
+        waves = int(math.ceil(float(len(results)) / self.__dispatch_workers))
+        deadline = time.time() + timeout * waves
+        report = {}
+        for bulb_ip, result in results.items():
+            try:
+                report[bulb_ip] = result.get(max(0, deadline - time.time()))
+            except multiprocessing.TimeoutError:
+                report[bulb_ip] = { "status" : "timeout", "commands" : [] }
+            except Exception as e:
+                report[bulb_ip] = { "status" : "error", "commands" : [], "error" : str(e) }
+        return report
+
+    def set_group(self, name, bulbs):
+        # a named group of bulbs given by ip or bulb name, an empty list removes the group
+        if bulbs:
+            self.__groups[name] = list(bulbs)
+        else:
+            self.__groups.pop(name, None)
+
+    def set_scene(self, name, state):
+        # a named state for apply_scene
+        self.__scenes[name] = self.__check_scene_state(state)
+
+    def get_groups(self):
+        return dict((name, list(bulbs)) for name, bulbs in self.__groups.items())
+
+    def get_scenes(self):
+        return dict((name, dict(state)) for name, state in self.__scenes.items())
+
+    def apply_scene(self, group, state, timeout = None):
+        # set all bulbs of a group (its name, or a list of bulb ips and names) to a state (a scene name, or a dict of
+        # power "on"/"off", bright, ct and rgb) at once. Every bulb gets a single command (set_scene, or the one
+        # property that differs) over its pooled connection, all bulbs in parallel. Returns a report like
+        # dispatch_yeelight_brightness. Bulbs under a light policy keep the scene until the policy's next brightness
+        # step or a new policy for them, the state changes the bulbs report back do not bring the policy back early.
+        bulb_ips, state = self.__resolve_scene(group, state)
+        if timeout is None:
+            timeout = self.__dispatch_timeout
+        self.__hold_scene(bulb_ips, time.time())
+        report = self.__dispatch(dict((bulb_ip, (self.__apply_bulb_state, (bulb_ip, state))) for bulb_ip in bulb_ips), timeout)
+        self.__hold_scene([bulb_ip for bulb_ip in report if report[bulb_ip]["status"] in ("offline", "error", "timeout")], None)
+        for bulb_ip in report:
+            self.__dispatch_results.inc(status = report[bulb_ip]["status"])
+        self.__logger.info("Scene %s applied to %d of %d bulbs", state,
+                           len([bulb_ip for bulb_ip in report if report[bulb_ip]["status"] in ("applied", "unchanged")]), len(report))
+        return report
+
+    def request_scene(self, group, state):
+        # like apply_scene, but only queues the state on the command queue and returns right away with
+        # {bulb_ip: "queued" or "offline"}; the command queue's sender threads send it within the bulbs'
+        # command quota, so this never waits on a bulb and can run on the event loop
+        bulb_ips, state = self.__resolve_scene(group, state)
+        self.__hold_scene(bulb_ips, time.time())
+        report = {}
+        for bulb_ip in bulb_ips:
+            bulb = bulb_registry.get_by_ip(bulb_ip)
+            if bulb is None:
+                report[bulb_ip] = "offline"
                 continue
-            bulb = detected_bulbs[bulb_ip]
-            self.__logger.debug("Bulb %s is online. Bulb info: %s", bulb_ip, bulb)
-            self.__logger.debug("Applying policy: %s", bulb_policy)
-            bulb_id, bulb_power, bulb_bright = bulb[0], bulb[2], int(bulb[3])
+            self.__offloaded_ramps.pop(bulb_ip, None)
+            command_queue.request(bulb_ip, bulb.port, **state)
+            report[bulb_ip] = "queued"
+        self.__hold_scene([bulb_ip for bulb_ip in report if report[bulb_ip] == "offline"], None)
+        self.__logger.info("Scene %s queued for %d of %d bulbs", state, report.values().count("queued"), len(report))
+        return report
+
+    def __resolve_scene(self, group, state):
+        # bulb ips of a group and the checked state of a scene, as taken by apply_scene
+        if isinstance(group, basestring):
+            if group not in self.__groups:
+                raise ValueError("Unknown group %r" % group)
+            group = self.__groups[group]
+        if isinstance(state, basestring):
+            if state not in self.__scenes:
+                raise ValueError("Unknown scene %r" % state)
+            state = self.__scenes[state]
+        state = self.__check_scene_state(state)
+        bulb_ips = []
+        for member in group:
+            bulb = bulb_registry.get_by_name(member)
+            bulb_ips.append(member if bulb is None else bulb.ip)
+        return bulb_ips, state
+
+    def __check_scene_state(self, state):
+        state = dict(state)
+        unknown = set(state) - set(SCENE_STATE_RANGES) - set(['power'])
+        if unknown:
+            raise ValueError("Unknown scene properties %s" % sorted(unknown))
+        if state.get('power', 'on') not in ('on', 'off'):
+            raise ValueError("Scene power must be 'on' or 'off', got %r" % state['power'])
+        for prop, (low, high) in SCENE_STATE_RANGES.items():
+            if prop in state and not (isinstance(state[prop], (int, long)) and low <= state[prop] <= high):
+                raise ValueError("Scene %s must be an integer in [%d, %d], got %r" % (prop, low, high, state[prop]))
+        if 'power' not in state:
+            state['power'] = 'on'
+        return state
+
+    def __apply_bulb_state(self, bulb_ip, state):
+        bulb = bulb_registry.get_by_ip(bulb_ip)
+        if bulb is None:
+            self.__logger.warning("Bulb %s is offline.", bulb_ip)
+            return { "status" : "offline", "commands" : [] }
+        try:
+            connection_pool.open(bulb_ip, bulb.port)
+            # a scene replaces a ramp handed over to the bulb
+            self.__offloaded_ramps.pop(bulb_ip, None)
+            return self.__request_state(bulb_ip, bulb.port, state)
+        except socket.error as e:
+            self.__commands_failed.inc(bulb = bulb_ip)
+            self.__logger.warning("Bulb %s is unreachable - %s", bulb_ip, e)
+            return { "status" : "error", "commands" : [], "error" : str(e) }
+
+    def __get_dispatch_pool(self):
+        with self.__dispatch_lock:
+            if self.__dispatch_pool is None:
+                self.__dispatch_pool = ThreadPool(self.__dispatch_workers)
+            return self.__dispatch_pool
+
+    def __stop_dispatch_pool(self):
+        with self.__dispatch_lock:
+            if self.__dispatch_pool is not None:
+                self.__dispatch_pool.terminate()
+                self.__dispatch_pool = None
+
+    def __change_yeelight_brightness(self, bulb_ip, target_bulb_brightness, ramp = None):
+        bulb = bulb_registry.get_by_ip(bulb_ip)
+        if bulb is None:
+            self.__logger.warning("Bulb %s is offline.", bulb_ip)
+            return { "status" : "offline", "commands" : [] }
+        self.__logger.log(TRACE, "Bulb %s is online. Bulb info: %s", bulb_ip, bulb)
+        if target_bulb_brightness > 0:
+            # a policy may run past the range of a bulb, which rejects such a brightness for good
+            target_bulb_brightness = max(1, min(100, target_bulb_brightness))
+        commands = []
+        try:
+            # keep a connection open so that state changes are pushed to us
+            connection_pool.open(bulb_ip, bulb.port)
+            # the connection may just have synced a newer state
+            bulb = bulb_registry.get_by_ip(bulb_ip) or bulb
+            self.__logger.debug("Applying brightness %s to bulb %s", target_bulb_brightness, bulb_ip)
+            bulb_power, bulb_bright = bulb.power, bulb.bright
+            offloaded = self.__offloaded_ramps.pop(bulb_ip, None)
+            if ramp is not None:
+                if offloaded is not None and offloaded[0] == ramp and bulb_power == 'on' \
+                        and not self.__ramp_drifted(offloaded, bulb_bright, target_bulb_brightness):
+                    self.__offloaded_ramps[bulb_ip] = offloaded
+                    return { "status" : "unchanged", "commands" : [], "ramp" : ramp }
+                commands = self.__get_ramp_commands(bulb, target_bulb_brightness, ramp)
+                self.__logger.info('Ramp yeelight %s from brightness %s to %s until %s', bulb_ip, target_bulb_brightness,
+                                   ramp[1], self.__get_localtime(int(ramp[0])))
+                if not self.__send_commands(bulb_ip, bulb.port, commands):
+                    return { "status" : "throttled", "commands" : [] }
+                self.__offloaded_ramps[bulb_ip] = (ramp, target_bulb_brightness, max(1, min(100, ramp[1])))
+                return { "status" : "applied", "commands" : commands, "ramp" : ramp }
             if target_bulb_brightness > 0:
-                if bulb_power == 'off': # turn on light
-                    self.__logger.debug("Turn on yeelight %s", bulb_ip)
-                    toggle_bulb(bulb_id)
-                    change_applied = True
-                if bulb_bright != target_bulb_brightness:
-                    self.__logger.info('Set yeelight %s to brightness %s', bulb_ip, target_bulb_brightness)
-                    set_bright(bulb_id, target_bulb_brightness)
-                    change_applied = True
+                state = { "power" : "on", "bright" : target_bulb_brightness }
             elif target_bulb_brightness == 0:
-                if bulb_power == 'on': # turn off light
-                    self.__logger.info("Turn yeelight %s off.", bulb_ip)
-                    toggle_bulb(bulb_id)
-                    change_applied = True
-        return change_applied
+                state = { "power" : "off" }
+            else:
+                return { "status" : "unchanged", "commands" : [] }
+            force = ()
+            if offloaded is not None and offloaded[0][0] > time.time():
+                # the bulb is still ramping: its reported brightness is not where it ends up
+                force = ("bright",)
+                if self.__ramp_mode == 'flow' and bulb_power == 'on':
+                    commands = [("stop_cf", "")]
+                    if not self.__send_commands(bulb_ip, bulb.port, commands):
+                        self.__offloaded_ramps[bulb_ip] = offloaded
+                        return { "status" : "throttled", "commands" : [] }
+            return self.__request_state(bulb_ip, bulb.port, state, force)
+        except socket.error as e:
+            self.__commands_failed.inc(max(1, len(commands)), bulb = bulb_ip)
+            self.__logger.warning("Bulb %s is unreachable - %s", bulb_ip, e)
+            return { "status" : "error", "commands" : [], "error" : str(e) }
+
+    def __request_state(self, bulb_ip, port, state, force = ()):
+        # the queue merges this with other pending requests, only sends what differs from the bulb
+        # and sends it again until the bulb reports it
+        started = time.time()
+        commands = command_queue.request(bulb_ip, port, flush = True, force = force, **state)
+        if not commands:
+            return { "status" : "queued" if command_queue.is_deferred(bulb_ip) else "unchanged", "commands" : [] }
+        self.__command_latency.observe(time.time() - started)
+        self.__commands_sent.inc(len(commands), bulb = bulb_ip)
+        self.__logger.info('Set yeelight %s to %s: %s', bulb_ip, state, commands)
+        return { "status" : "applied", "commands" : commands }
+
+    def __send_commands(self, bulb_ip, port, commands):
+        # raw commands, False when the bulb is over its command quota
+        started = time.time()
+        if not command_queue.send(bulb_ip, port, commands):
+            self.__logger.warning("Bulb %s is over its command quota, retrying later", bulb_ip)
+            return False
+        self.__command_latency.observe(time.time() - started)
+        self.__commands_sent.inc(len(commands), bulb = bulb_ip)
+        return True
+
+    def __get_ramp_commands(self, bulb, start_brightness, ramp):
+        # start from the current brightness, then let the bulb interpolate up to the end of the ramp
+        commands = []
+        if bulb.power == 'off':
+            commands.append(("set_power", '"on"'))
+        if bulb.bright != start_brightness:
+            commands.append(("set_bright", str(start_brightness)))
+        end_brightness = max(1, min(100, ramp[1]))
+        duration = max(MIN_RAMP_STEP_MS, int((ramp[0] - time.time()) * 1000))
+        if self.__ramp_mode == 'smooth' or bulb.color_mode == 3 or (bulb.color_mode == 1 and bulb.rgb is None):
+            # color flows have no hsv step: a bulb in hsv mode (or with an unknown color) keeps its color
+            # with a smooth brightness transition instead
+            commands.append(("set_bright", '%d,"smooth",%d' % (end_brightness, duration)))
+        elif bulb.color_mode == 1:
+            # a single rgb step keeps the color, one flow run that stays at its last state
+            commands.append(("start_cf", '1,1,"%d,1,%d,%d"' % (duration, bulb.rgb, end_brightness)))
+        else:
+            commands.append(("start_cf", '1,1,"%d,2,%d,%d"' % (duration, bulb.ct or DEFAULT_RAMP_CT, end_brightness)))
+        return commands
+
+    def __ramp_drifted(self, offloaded, bulb_bright, expected_brightness):
+        # a bulb reports the values of our own commands, i.e. the start or end of the ramp, which are on track
+        if bulb_bright is None:
+            # no brightness reported, the ramp cannot be trusted
+            return True
+        if bulb_bright in offloaded[1:]:
+            return False
+        return abs(bulb_bright - expected_brightness) > self.__ramp_drift_tolerance
+
+def run_dispatch_job(function, args):
+    # a dispatch job that reports an exception instead of raising it in the pool
+    try:
+        return function(*args)
+    except Exception as e:
+        return { "status" : "error", "commands" : [], "error" : str(e) }
+
+def shard_of(bulb_ip, shards):
+    # stable across processes and runs, unlike hash()
+    return (zlib.crc32(bulb_ip) & 0xffffffff) % shards
+
+def split_light_policy(light_policy, shards):
+    # one light policy per shard, holding only the bulbs of that shard
+    parts = [[] for shard in range(shards)]
+    for bulb_policy in light_policy:
+        bulb_ips = {}
+        for bulb_ip in bulb_policy["bulb_ip"]:
+            bulb_ips.setdefault(shard_of(bulb_ip, shards), []).append(bulb_ip)
+        for shard, ips in sorted(bulb_ips.items()):
+            part = dict(bulb_policy)
+            part["bulb_ip"] = ips
+            parts[shard].append(part)
+    return parts
 
+def run_controller_shard(shard, light_policy, controller_args, discovery_queue, status_queue, status_interval):
+    # worker process: a SmartYeelight without discovery of its own, fed by the supervisor
+    # the fork copied the bulbs and desired state the parent had, only this shard's share is forwarded
+    bulb_registry.clear()
+    command_queue.clear()
+    controller = SmartYeelight(run_discovery = False, **controller_args)
+    controller.deploy_policy(light_policy)
+    controller.start(daemon = True)
+    next_status = 0
+    try:
+        while True:
+            try:
+                data = discovery_queue.get(True, max(0, next_status - time.time()))
+            except Queue.Empty:
+                data = ""
+            if data is None:
+                break
+            if data:
+                handle_search_response(data)
+            if time.time() >= next_status:
+                status = controller.get_status()
+                status["shard"] = shard
+                status_queue.put(status)
+                next_status = time.time() + status_interval
+    finally:
+        controller.stop()
+
+class SmartYeelightSupervisor(object):
+    # Drives a large fleet with one SmartYeelight worker process per shard of the bulbs, split by
+    # a hash of the bulb ip. Discovery runs only here: every answer is forwarded to the worker owning
+    # the bulb, and the workers report their status back every status_interval seconds.
+
+    def __init__(self, workers = multiprocessing.cpu_count(), status_interval = 5, logging_level = logging.INFO,
+                 discovery_interfaces = None, lan_transport = None, **controller_args):
+        self.__workers = workers
+        self.__status_interval = status_interval
+        self.__discovery_interfaces = discovery_interfaces
+        self.__lan_transport = lan_transport
+        self.__controller_args = dict(controller_args, logging_level = logging_level)
+        self.__light_policy = []
+        self.__processes = []
+        self.__discovery_queues = []
+        self.__status_queue = None
+        self.__status = {}
+        self.__status_lock = threading.Lock()
+        self.__event_loop = None
+        self.__threads = []
+        self.__RUNNING = False
+        self.__logger = logging.getLogger("SmartYeelightSupervisor")
+        if not self.__logger.handlers:
+            handler = logging.StreamHandler(sys.stdout)
+            handler.setFormatter(logging.Formatter('%(asctime)s - %(processName)s - %(levelname)s - %(message)s'))
+            self.__logger.addHandler(handler)
+        self.__logger.setLevel(logging_level)
+
+    def deploy_policy(self, light_policy):
+        self.__light_policy = light_policy
+        if self.__RUNNING:
+            # the bulbs are re-split, restart the workers with their new share
+            self.stop()
+            self.start()
+
+    def start(self):
+        if self.__RUNNING:
+            return
+        self.__status_queue = multiprocessing.Queue()
+        self.__discovery_queues = []
+        self.__processes = []
+        for shard, light_policy in enumerate(split_light_policy(self.__light_policy, self.__workers)):
+            discovery_queue = multiprocessing.Queue()
+            process = multiprocessing.Process(name = 'ControllerShard-%d' % shard, target = run_controller_shard,
+                                              args = (shard, light_policy, self.__get_shard_args(shard), discovery_queue,
+                                                      self.__status_queue, self.__status_interval))
+            process.daemon = True
+            process.start()
+            self.__discovery_queues.append(discovery_queue)
+            self.__processes.append(process)
+            self.__logger.info("Started worker %s (pid %s) for %d bulb policies", process.name, process.pid, len(light_policy))
+        self.__event_loop = EventLoop()
+        discovery = attach_discovery(self.__event_loop, interfaces = self.__discovery_interfaces, transport = self.__lan_transport)
+        discovery.listeners.append(self.__forward_discovery)
+        self.__RUNNING = True
+        self.__threads = [Thread(name = 'EventLoopThread', target = self.__event_loop.run_forever),
+                          Thread(name = 'StatusThread', target = self.__collect_status)]
+        for thread in self.__threads:
+            thread.setDaemon(True)
+            thread.start()
+
+    def __get_shard_args(self, shard):
+        # each worker saves its own snapshot, suffixed with the shard, and serves its API and
+        # metrics on its own port, counting up from the one configured (0 stays any free port)
+        controller_args = dict(self.__controller_args)
+        if controller_args.get('snapshot_file'):
+            controller_args['snapshot_file'] = '%s.%d' % (controller_args['snapshot_file'], shard)
+        for key in ('api_address', 'metrics_address'):
+            if controller_args.get(key):
+                host, port = controller_args[key]
+                controller_args[key] = (host, port + shard if port else 0)
+        return controller_args
+
+    def stop(self):
+        if not self.__RUNNING:
+            return
+        self.__RUNNING = False
+        self.__event_loop.stop()
+        for thread in self.__threads:
+            thread.join(1)
+        bulb_discovery.listeners.remove(self.__forward_discovery)
+        detach_discovery(self.__event_loop, bulb_discovery)
+        bulb_discovery.transport.close()
+        self.__event_loop.close()
+        for discovery_queue in self.__discovery_queues:
+            discovery_queue.put(None)
+        for process in self.__processes:
+            process.join(self.__status_interval)
+            if process.is_alive():
+                self.__logger.warning("Worker %s did not stop, terminating it", process.name)
+                process.terminate()
+        with self.__status_lock:
+            self.__status = {}
+        self.__logger.info("All workers stopped")
+
+    def is_running(self):
+        return self.__RUNNING
+
+    def status(self):
+        # aggregated status of all workers plus the last report of each one
+        with self.__status_lock:
+            workers = dict(self.__status)
+        dispatch = Counter()
+        for status in workers.values():
+            dispatch.update(status["dispatch"])
+        return {
+            "workers" : len(self.__processes),
+            "alive" : len([process for process in self.__processes if process.is_alive()]),
+            "bulbs" : sum([status["bulbs"] for status in workers.values()]),
+            "bulbs_online" : sum([status["bulbs_online"] for status in workers.values()]),
+            "policy_bulbs" : sum([status["policy_bulbs"] for status in workers.values()]),
+            "dispatch" : dict(dispatch),
+            "shards" : workers,
+        }
+
+    def __forward_discovery(self, data, bulb):
+        self.__discovery_queues[shard_of(bulb.ip, self.__workers)].put(data)
+
+    def __collect_status(self):
+        while self.__RUNNING:
+            try:
+                status = self.__status_queue.get(True, 0.5)
+            except Queue.Empty:
+                continue
+            with self.__status_lock:
+                self.__status[status["shard"]] = status
 
 if __name__ == "__main__":
     light_policy = [
@@ -497,7 +1505,11 @@ if __name__ == "__main__":
         }
     ]
     light = SmartYeelight(logging_level = logging.DEBUG)
-    light.deploy_policy(light_policy)
+    if len(sys.argv) > 1:
+        # a JSON/YAML file with "policy", "log", "presence", "groups" and "scenes" sections, reloaded whenever it changes
+        light.watch_config_file(sys.argv[1])
+    else:
+        light.deploy_policy(light_policy)
     light.start(daemon = True)
     while True:
         try:
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import os
+import json
+import mmap
+import time
+import struct
+import tempfile
+
+# A compact on-disk snapshot of named JSON sections, written atomically and read through mmap.
+#
+# Layout: a header (magic, version, section count, creation time), a table with the name,
+# offset and length of every section, then the sections themselves as compact JSON. A reader
+# maps the file and only decodes the sections it asks for.
+
+MAGIC = 'YLSNAP\x00\x01'
+VERSION = 1
+HEADER = struct.Struct('<8sIId')
+SECTION = struct.Struct('<16sQQ')
+
+class SnapshotError(ValueError):
+    pass
+
+def write_snapshot(path, sections):
+    # sections: (name, JSON serializable value) pairs or a dict; the file is replaced atomically
+    if isinstance(sections, dict):
+        sections = sections.items()
+    payloads = []
+    for name, value in sections:
+        if len(name) > 16:
+            raise SnapshotError("Section name too long: %r" % name)
+        payloads.append((name, json.dumps(value, separators = (',', ':'))))
+    offset = HEADER.size + SECTION.size * len(payloads)
+    parts = [HEADER.pack(MAGIC, VERSION, len(payloads), time.time())]
+    for name, payload in payloads:
+        parts.append(SECTION.pack(name, offset, len(payload)))
+        offset += len(payload)
+    parts.extend([payload for name, payload in payloads])
+    directory = os.path.dirname(path) or '.'
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # write to a temporary file and rename, so a crash never leaves a torn snapshot
+    fd, tmp_path = tempfile.mkstemp(dir = directory, prefix = '.snapshot')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(''.join(parts))
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class Snapshot(object):
+    # Read-only view of a snapshot file; sections are decoded on first access.
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as snapshot_file:
+            size = os.fstat(snapshot_file.fileno()).st_size
+            if size < HEADER.size:
+                raise SnapshotError("Snapshot %s is truncated" % path)
+            self.__map = mmap.mmap(snapshot_file.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, version, count, self.created = HEADER.unpack_from(self.__map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise SnapshotError("%s is not a snapshot of version %d" % (path, VERSION))
+        if HEADER.size + SECTION.size * count > size:
+            self.close()
+            raise SnapshotError("Snapshot %s is truncated" % path)
+        self.__sections = {}
+        for i in range(count):
+            name, offset, length = SECTION.unpack_from(self.__map, HEADER.size + SECTION.size * i)
+            if offset + length > size:
+                self.close()
+                raise SnapshotError("Snapshot %s is truncated" % path)
+            self.__sections[name.rstrip('\x00')] = (offset, length)
+        self.__decoded = {}
+
+    def __contains__(self, name):
+        return name in self.__sections
+
+    def names(self):
+        return list(self.__sections)
+
+    def get(self, name, default = None):
+        if name not in self.__sections:
+            return default
+        if name not in self.__decoded:
+            offset, length = self.__sections[name]
+            try:
+                self.__decoded[name] = json.loads(self.__map[offset:offset + length])
+            except ValueError as e:
+                raise SnapshotError("Section %s of %s is corrupt - %s" % (name, self.path, e))
+        return self.__decoded[name]
+
+    def close(self):
+        if self.__map is not None:
+            self.__map.close()
+            self.__map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
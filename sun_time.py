@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+import os
+import json
+import math
+import calendar
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from dateutil import tz
+
+# zenith angles (degrees) of the events reported by the former sunrise-sunset.org API
+ZENITH = {
+    'sunrise' : 90.833,     # includes atmospheric refraction and the solar disc radius
+    'civil_twilight' : 96.0,
+    'nautical_twilight' : 102.0,
+    'astronomical_twilight' : 108.0,
+}
+SUN_TIME_KEYS = ('sunrise', 'sunset', 'solar_noon', 'civil_twilight_begin', 'civil_twilight_end',
+                 'nautical_twilight_begin', 'nautical_twilight_end', 'astronomical_twilight_begin',
+                 'astronomical_twilight_end')
+# cache files of an earlier version may hold None for events that do not happen
+CACHE_VERSION = 2
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'yeelight-controller', 'sun_time.json')
+CACHE_DAYS = 366
+UTC = tz.tzutc()
+
+def julian_day(day):
+    return day.toordinal() + 1721424.5
+
+def solar_position(jd):
+    # NOAA solar calculator: declination (degrees) and equation of time (minutes)
+    jc = (jd - 2451545.0) / 36525.0
+    mean_long = (280.46646 + jc * (36000.76983 + jc * 0.0003032)) % 360
+    mean_anom = 357.52911 + jc * (35999.05029 - 0.0001537 * jc)
+    eccent = 0.016708634 - jc * (0.000042037 + 0.0000001267 * jc)
+    m = math.radians(mean_anom)
+    eq_ctr = math.sin(m) * (1.914602 - jc * (0.004817 + 0.000014 * jc)) \
+        + math.sin(2 * m) * (0.019993 - 0.000101 * jc) + math.sin(3 * m) * 0.000289
+    omega = math.radians(125.04 - 1934.136 * jc)
+    app_long = mean_long + eq_ctr - 0.00569 - 0.00478 * math.sin(omega)
+    mean_obliq = 23 + (26 + (21.448 - jc * (46.815 + jc * (0.00059 - jc * 0.001813))) / 60) / 60
+    obliq = math.radians(mean_obliq + 0.00256 * math.cos(omega))
+    declination = math.degrees(math.asin(math.sin(obliq) * math.sin(math.radians(app_long))))
+    var_y = math.tan(obliq / 2) ** 2
+    l0 = math.radians(mean_long)
+    eq_of_time = 4 * math.degrees(var_y * math.sin(2 * l0) - 2 * eccent * math.sin(m)
+                                  + 4 * eccent * var_y * math.sin(m) * math.cos(2 * l0)
+                                  - 0.5 * var_y * var_y * math.sin(4 * l0) - 1.25 * eccent * eccent * math.sin(2 * m))
+    return declination, eq_of_time
+
+def hour_angle(lat, declination, zenith):
+    # clamped where the sun never crosses the zenith angle on that day: 180 degrees when it stays
+    # above it all day (polar day), 0 when it stays below (polar night)
+    lat, declination = math.radians(lat), math.radians(declination)
+    cos_ha = math.cos(math.radians(zenith)) / (math.cos(lat) * math.cos(declination)) - math.tan(lat) * math.tan(declination)
+    return math.degrees(math.acos(max(-1.0, min(1.0, cos_ha))))
+
+def calculate_sun_time(day, lat, lng):
+    # UTC epoch seconds of all events of a day. Events that do not happen fall back to the clamped
+    # hour angle: in a polar day the sun rises 12 hours before solar noon and sets 12 hours after it,
+    # in a polar night it rises and sets at solar noon, so policies still compile there
+    midnight = calendar.timegm(day.timetuple())
+    # evaluate the sun position at the approximate local solar noon
+    declination, eq_of_time = solar_position(julian_day(day) + 0.5 - lng / 360.0)
+    noon = 720 - 4 * lng - eq_of_time
+    result = { 'solar_noon' : midnight + noon * 60 }
+    for event, zenith in ZENITH.items():
+        ha = hour_angle(lat, declination, zenith)
+        if event == 'sunrise':
+            begin, end = 'sunrise', 'sunset'
+        else:
+            begin, end = event + '_begin', event + '_end'
+        result[begin] = midnight + (noon - 4 * ha) * 60
+        result[end] = midnight + (noon + 4 * ha) * 60
+    ha = hour_angle(lat, declination, ZENITH['sunrise'])
+    result['day_length'] = int(8 * ha * 60)
+    return result
+
+def to_datetime(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, UTC)
+
+class SunTimeCache(object):
+    # Sun times for a location, computed locally and kept for a full year in memory and on disk.
+
+    def __init__(self, lat, lng, cache_file = DEFAULT_CACHE_FILE, days = CACHE_DAYS, logger = None):
+        self.lat = float(lat)
+        self.lng = float(lng)
+        self.cache_file = cache_file
+        self.days = days
+        self.__logger = logger
+        self.__lock = threading.Lock()
+        self.__cache = {}
+        self.__load()
+
+    def get(self, day):
+        # dict of aware UTC datetimes for every event of the day, plus day_length in seconds
+        key = day.isoformat()
+        with self.__lock:
+            if key not in self.__cache:
+                self.__fill(day)
+                self.__save()
+            raw = self.__cache[key]
+        result = dict((event, to_datetime(raw[event])) for event in SUN_TIME_KEYS)
+        result['day_length'] = raw['day_length']
+        return result
+
+    def __fill(self, start):
+        # drop the past and precompute a year ahead
+        for key in [key for key in self.__cache if key < start.isoformat()]:
+            del self.__cache[key]
+        for offset in range(self.days):
+            day = start + timedelta(days = offset)
+            self.__cache[day.isoformat()] = calculate_sun_time(day, self.lat, self.lng)
+
+    def __load(self):
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file) as cache_file:
+                data = json.load(cache_file)
+        except (IOError, ValueError) as e:
+            self.__log_warning("Ignoring unreadable sun time cache %s - %s", self.cache_file, e)
+            return
+        if data.get('version') == CACHE_VERSION and data.get('lat') == self.lat and data.get('lng') == self.lng:
+            self.__cache = data.get('days', {})
+
+    def __save(self):
+        if self.cache_file is None:
+            return
+        data = { 'version' : CACHE_VERSION, 'lat' : self.lat, 'lng' : self.lng, 'days' : self.__cache }
+        try:
+            cache_dir = os.path.dirname(self.cache_file) or '.'
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            # write to a temporary file and rename, so a crash never leaves a torn cache
+            fd, tmp_path = tempfile.mkstemp(dir = cache_dir, prefix = '.sun_time')
+            with os.fdopen(fd, 'w') as tmp_file:
+                json.dump(data, tmp_file)
+            os.rename(tmp_path, self.cache_file)
+        except (IOError, OSError) as e:
+            self.__log_warning("Unable to write sun time cache %s - %s", self.cache_file, e)
+
+    def __log_warning(self, msg, *args):
+        if self.__logger is not None:
+            self.__logger.warning(msg, *args)
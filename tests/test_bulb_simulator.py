@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+# Checks of the bulb simulator the benchmarks and the other tests run against.
+#
+# Usage: python -m unittest discover -s tests
+
+import os
+import sys
+import json
+import errno
+import time
+import socket
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from bulb_simulator import BulbSimulator
+
+def command(cmd_id, method, params):
+    return json.dumps({ 'id' : cmd_id, 'method' : method, 'params' : params }) + '\r\n'
+
+def read_reply(sock, cmd_id):
+    data = ''
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise AssertionError("connection closed before reply %d" % cmd_id)
+        data += chunk
+        for line in data.split('\n'):
+            if line.strip() and json.loads(line).get('id') == cmd_id:
+                return json.loads(line)
+
+class SimulatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = BulbSimulator(2, network = '127.11.0.0').start()
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        self.simulator.stop()
+
+    def connect(self, bulb, rcvbuf = None):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if rcvbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        sock.settimeout(5)
+        sock.connect((bulb.ip, bulb.port))
+        self.sockets.append(sock)
+        return sock
+
+    def test_command_and_notify(self):
+        sock = self.connect(self.simulator.bulbs[0])
+        sock.sendall(command(1, 'set_bright', [31, 'smooth', 500]))
+        self.assertEqual(read_reply(sock, 1)['result'], ['ok'])
+        self.assertEqual(self.simulator.bulbs[0].state['bright'], 31)
+
+    def test_client_that_does_not_read(self):
+        # one connection never reads its replies; the other bulb answers as quickly as ever
+        stalled = self.connect(self.simulator.bulbs[0], rcvbuf = 4096)
+        props = ['power', 'bright', 'ct', 'rgb', 'hue', 'sat', 'color_mode', 'name'] * 8
+        # far more replies than the socket buffers hold
+        commands = ''.join([command(i, 'get_prop', props) for i in range(40000)])
+        stalled.setblocking(0)
+        deadline = time.time() + 2
+        while commands and time.time() < deadline:
+            try:
+                commands = commands[stalled.send(commands):]
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # dropped for not reading, as a real bulb does
+                    break
+                time.sleep(0.01)
+        time.sleep(0.2)
+        sock = self.connect(self.simulator.bulbs[1])
+        start = time.time()
+        sock.sendall(command(1, 'set_power', ['on', 'smooth', 500]))
+        self.assertEqual(read_reply(sock, 1)['result'], ['ok'])
+        self.assertLess(time.time() - start, 0.5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+# Checks of the pooled bulb connections of YeelightWifiBulbLanCtrl.
+#
+# Usage: python -m unittest discover -s tests
+
+import os
+import sys
+import time
+import socket
+import resource
+import threading
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from YeelightWifiBulbLanCtrl import BulbConnection, EventLoop, bulb_registry
+from bulb_simulator import BulbSimulator
+
+HIGH_FD = 1100
+
+def bulb_fields(ip, **fields):
+    return dict({ 'id' : 'bulb-' + ip, 'ip' : ip, 'port' : 55443, 'support' : ['set_bright'], 'power' : 'on',
+                  'bright' : 50, 'last_seen' : time.time() }, **fields)
+
+class HighFdTest(unittest.TestCase):
+    # a fleet opens more connections than select() takes (FD_SETSIZE is 1024)
+
+    def setUp(self):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard != resource.RLIM_INFINITY and hard <= HIGH_FD:
+            self.skipTest("open file limit %d is too low" % hard)
+        self.saved_limit = (soft, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, HIGH_FD + 1), hard))
+        bulb_registry.clear()
+        bulb_registry.restore([bulb_fields('127.0.0.1')])
+        # take the low fds so that the connection gets a high one
+        self.fillers = [os.open(os.devnull, os.O_RDONLY)]
+        while self.fillers[-1] < HIGH_FD:
+            self.fillers.append(os.open(os.devnull, os.O_RDONLY))
+        self.conn = BulbConnection('127.0.0.1', 55443)
+        self.conn.sock, self.far = socket.socketpair()
+
+    def tearDown(self):
+        self.conn.close()
+        self.far.close()
+        for fd in self.fillers:
+            os.close(fd)
+        bulb_registry.clear()
+        resource.setrlimit(resource.RLIMIT_NOFILE, self.saved_limit)
+
+    def test_connection_is_kept_and_read(self):
+        self.assertGreaterEqual(self.conn.sock.fileno(), 1024)
+        self.assertFalse(self.conn.is_stale())
+        self.far.sendall('{"method":"props","params":{"bright":31}}\r\n')
+        time.sleep(0.05)
+        self.assertFalse(self.conn.is_stale())
+        self.assertEqual(bulb_registry.get_by_ip('127.0.0.1').bright, 31)
+
+    def test_closed_by_the_bulb(self):
+        self.far.close()
+        self.assertTrue(self.conn.is_stale())
+
+class SilentBulbTest(unittest.TestCase):
+    # a sender stuck writing to a bulb that does not read must not hold up the event loop
+
+    def setUp(self):
+        self.simulator = BulbSimulator(1, network = '127.13.0.0').start()
+        self.live = self.simulator.bulbs[0]
+        # accepts connections but never reads or answers
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self.server.bind(('127.13.1.1', 0))
+        self.server.listen(1)
+        bulb_registry.clear()
+        bulb_registry.restore([bulb_fields(self.live.ip, port = self.live.port), bulb_fields('127.13.1.1')])
+        self.loop = EventLoop()
+        self.thread = threading.Thread(target = self.loop.run_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.silent = BulbConnection('127.13.1.1', self.server.getsockname()[1], timeout = 1, loop = self.loop)
+        self.silent.ensure_connected()
+        self.silent_peer = self.server.accept()[0]
+
+    def tearDown(self):
+        self.silent_peer.close()
+        self.server.close()
+        self.loop.stop()
+        self.thread.join(5)
+        self.loop.close()
+        self.silent.close()
+        bulb_registry.clear()
+        self.simulator.stop()
+
+    def test_loop_keeps_reading(self):
+        # far more than the socket buffers hold, the write blocks until the timeout
+        commands = [('set_bright', '%d, "smooth", 500' % (i % 100 + 1)) for i in range(200000)]
+        def send():
+            try:
+                self.silent.send(commands)
+            except socket.error:
+                pass
+        sender = threading.Thread(target = send)
+        sender.start()
+        time.sleep(0.3)
+        # readable while the sender holds the lock
+        self.silent_peer.sendall('{"method":"props","params":{"bright":12}}\r\n')
+        time.sleep(0.1)
+        live = BulbConnection(self.live.ip, self.live.port, loop = self.loop)
+        try:
+            start = time.time()
+            live.send([('set_bright', '31, "smooth", 500')])
+            while bulb_registry.get_by_ip(self.live.ip).bright != 31 and time.time() - start < 1:
+                time.sleep(0.01)
+            self.assertLess(time.time() - start, 0.5)
+        finally:
+            live.close()
+            sender.join(10)
+
+if __name__ == '__main__':
+    unittest.main()
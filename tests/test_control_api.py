@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+# Checks of the control API served by a controller of simulated bulbs.
+#
+# Usage: python -m unittest discover -s tests
+
+import os
+import sys
+import imp
+import json
+import time
+import base64
+import socket
+import struct
+import logging
+import threading
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from YeelightWifiBulbLanCtrl import bulb_registry
+from bulb_simulator import BulbSimulator
+from control_api import MAX_REQUEST_SIZE, CLOSE_PROTOCOL_ERROR, CLOSE_TOO_BIG, OP_CLOSE
+
+controller_module = imp.load_source('smart_controller', os.path.join(ROOT, 'smart-controller.py'))
+
+def const_policy(bulb_ips, brightness):
+    return [{ 'bulb_ip' : bulb_ips, 'policies' : [
+        { 'bright_time' : '00:00:00', 'dark_time' : '23:59:59', 'const_brightness' : brightness }] }]
+
+def read_all(sock):
+    data = ''
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return data
+        data += chunk
+
+class ControlApiTest(unittest.TestCase):
+
+    def setUp(self):
+        bulb_registry.clear()
+        self.simulator = BulbSimulator(2, network = '127.16.0.0').start()
+        self.ips = [bulb.ip for bulb in self.simulator.bulbs]
+        self.controller = controller_module.SmartYeelight(logging_level = logging.CRITICAL, latitude = 0, longitude = 0,
+                                                          sun_time_cache_file = None,
+                                                          lan_transport = self.simulator.transport(),
+                                                          api_address = ('127.0.0.1', 0))
+        self.controller.deploy_policy(const_policy(self.ips, 40))
+        self.controller.start(daemon = True)
+        self.address = self.controller._SmartYeelight__control_server.address
+
+    def tearDown(self):
+        self.controller.stop()
+        bulb_registry.clear()
+        self.simulator.stop()
+
+    def connect(self):
+        sock = socket.create_connection(self.address, 5)
+        sock.settimeout(5)
+        return sock
+
+    def request(self, method, path, body = '', headers = None):
+        # (status, decoded JSON body) of a request sent as it is
+        if headers is None:
+            headers = { 'Content-Length' : len(body) }
+        sock = self.connect()
+        try:
+            sock.sendall('%s %s HTTP/1.1\r\nHost: test\r\n%s\r\n%s' % (
+                method, path, ''.join(['%s: %s\r\n' % header for header in headers.items()]), body))
+            response = read_all(sock)
+        finally:
+            sock.close()
+        head, _, body = response.partition('\r\n\r\n')
+        return int(head.split()[1]), json.loads(body)
+
+    def test_put_policy(self):
+        policy = const_policy(self.ips[:1], 66)
+        self.assertEqual(self.request('PUT', '/policy', json.dumps(policy)), (200, { 'bulb_policies' : 1 }))
+        self.assertEqual(self.request('GET', '/policy'), (200, policy))
+
+    def test_slow_deploy(self):
+        # compiling may wait on the geo lookup and the sun times, the loop keeps serving meanwhile
+        deploy_policy = self.controller.deploy_policy
+        def slow_deploy_policy(policy):
+            time.sleep(1)
+            deploy_policy(policy)
+        self.controller.deploy_policy = slow_deploy_policy
+        results = []
+        put = threading.Thread(target = lambda: results.append(self.request('PUT', '/policy',
+                                                                            json.dumps(const_policy(self.ips, 66)))))
+        put.start()
+        time.sleep(0.2)
+        start = time.time()
+        self.assertEqual(self.request('GET', '/bulbs')[0], 200)
+        self.assertLess(time.time() - start, 0.5)
+        put.join(5)
+        self.assertEqual(results, [(200, { 'bulb_policies' : 1 })])
+
+    def test_rejected_policy(self):
+        deployed = self.request('GET', '/policy')
+        bad_time = [{ 'bulb_ip' : self.ips, 'policies' : [
+            { 'bright_time' : '$no_such_time$', 'dark_time' : '23:59:59', 'const_brightness' : 5 }] }]
+        for body in (json.dumps(bad_time), json.dumps({ 'bulb_ip' : self.ips }), '[{"bulb_ip": "10.0.0.1"}]', '[{'):
+            status, result = self.request('PUT', '/policy', body)
+            self.assertEqual(status, 400, result)
+            self.assertTrue(result['error'])
+        self.assertEqual(self.request('GET', '/policy'), deployed)
+
+    def test_request_size(self):
+        status, result = self.request('PUT', '/policy', headers = { 'Content-Length' : MAX_REQUEST_SIZE + 1 })
+        self.assertEqual(status, 413)
+        for length in (-1, 'ten'):
+            status, result = self.request('GET', '/bulbs', headers = { 'Content-Length' : length })
+            self.assertEqual(status, 400)
+
+    def websocket(self):
+        sock = self.connect()
+        sock.sendall('GET /events HTTP/1.1\r\nHost: test\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                     'Sec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\n\r\n' % base64.b64encode(os.urandom(16)))
+        response = ''
+        while '\r\n\r\n' not in response:
+            response += sock.recv(4096)
+        self.assertEqual(response.split()[1], '101')
+        return sock
+
+    def close_code(self, sock, frame):
+        # status code of the close frame the server answers frame with, before it hangs up
+        sock.sendall(frame)
+        data = read_all(sock)
+        self.assertEqual(ord(data[0]) & 0x0f, OP_CLOSE)
+        return struct.unpack_from('!H', data, 2)[0]
+
+    def test_websocket_frames(self):
+        sock = self.websocket()
+        try:
+            # unmasked text frame
+            self.assertEqual(self.close_code(sock, struct.pack('!BB', 0x81, 5) + 'hello'), CLOSE_PROTOCOL_ERROR)
+        finally:
+            sock.close()
+        sock = self.websocket()
+        try:
+            # the header of a masked frame longer than any request
+            self.assertEqual(self.close_code(sock, struct.pack('!BBQ', 0x81, 0x80 | 127, MAX_REQUEST_SIZE + 1) + 'mask'),
+                             CLOSE_TOO_BIG)
+        finally:
+            sock.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# Checks of the controller against simulated bulbs.
+#
+# Usage: python -m unittest discover -s tests
+
+import os
+import sys
+import imp
+import time
+import shutil
+import logging
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from YeelightWifiBulbLanCtrl import bulb_registry
+from bulb_simulator import BulbSimulator
+
+controller_module = imp.load_source('smart_controller', os.path.join(ROOT, 'smart-controller.py'))
+
+def wait_for(condition, timeout = 2):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+class ControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        bulb_registry.clear()
+        self.simulator = BulbSimulator(2, network = '127.14.0.0').start()
+        self.ips = [bulb.ip for bulb in self.simulator.bulbs]
+        self.controller = controller_module.SmartYeelight(logging_level = logging.ERROR, latitude = 0, longitude = 0,
+                                                          sun_time_cache_file = None,
+                                                          lan_transport = self.simulator.transport())
+
+    def tearDown(self):
+        self.controller.stop()
+        bulb_registry.clear()
+        self.simulator.stop()
+
+    def start(self):
+        self.controller.start(daemon = True)
+        self.assertTrue(wait_for(lambda: len(bulb_registry) == len(self.ips)))
+
+    def test_brightness_past_range(self):
+        self.start()
+        report = self.controller.dispatch_yeelight_brightness([{ 'bulb_ip' : self.ips, 'calculated_brightness' : 140 }])
+        self.assertEqual([result['status'] for result in report.values()], ['applied', 'applied'])
+        self.assertTrue(wait_for(lambda: [bulb.state['bright'] for bulb in self.simulator.bulbs] == [100, 100]))
+
+    def test_invalid_log_section(self):
+        self.controller.load_config({ 'scenes' : { 'evening' : { 'bright' : 30 } } })
+        scenes = self.controller.get_scenes()
+        directory = tempfile.mkdtemp()
+        try:
+            for log in ({ 'logging_level' : 'LOUD' }, { 'logging_level' : [10] }, { 'log_level' : 'DEBUG' },
+                        { 'log_file' : os.path.join(directory, 'missing', 'controller.log') }):
+                self.assertRaises(ValueError, self.controller.load_config,
+                                  { 'log' : log, 'scenes' : { 'night' : { 'bright' : 1 } } })
+                self.assertEqual(self.controller.get_scenes(), scenes)
+            self.controller.load_config({ 'log' : { 'logging_level' : 'warning',
+                                                    'log_file' : os.path.join(directory, 'controller.log') } })
+            self.assertEqual(logging.getLogger('SmartYeelightCtrl').level, logging.WARNING)
+            self.assertTrue(os.path.exists(os.path.join(directory, 'controller.log')))
+        finally:
+            # closes the log file again
+            self.controller.load_config({ 'log' : { 'logging_level' : logging.ERROR } })
+            shutil.rmtree(directory)
+
+    def test_scene_holds_until_the_next_policy_step(self):
+        now = time.time()
+        clock = lambda t: time.strftime('%H:%M:%S', time.localtime(t))
+        if clock(now - 60) > clock(now + 120):
+            self.skipTest("the policy would cross midnight")
+        # 37 until the step in 3 seconds, 45 after it
+        step = int(now) + 3
+        self.controller.deploy_policy([{ 'bulb_ip' : self.ips, 'policies' : [
+            { 'bright_time' : clock(now - 60), 'dark_time' : clock(step), 'const_brightness' : 37 },
+            { 'bright_time' : clock(step), 'dark_time' : clock(now + 120), 'const_brightness' : 45 }] }])
+        self.start()
+        brightness = lambda: [bulb.state['bright'] for bulb in self.simulator.bulbs]
+        self.assertTrue(wait_for(lambda: brightness() == [37, 37]))
+        report = self.controller.apply_scene(self.ips, { 'bright' : 20 })
+        self.assertEqual([result['status'] for result in report.values()], ['applied', 'applied'])
+        # the bulbs report the scene back, which wakes the policy for them
+        time.sleep(0.5)
+        self.assertEqual(brightness(), [20, 20])
+        self.assertTrue(wait_for(lambda: brightness() == [45, 45], step + 2 - time.time()))
+
+    def test_new_policy_replaces_a_scene(self):
+        self.controller.deploy_policy([{ 'bulb_ip' : self.ips, 'policies' : [
+            { 'bright_time' : '00:00:00', 'dark_time' : '23:59:59', 'const_brightness' : 37 }] }])
+        self.start()
+        brightness = lambda: [bulb.state['bright'] for bulb in self.simulator.bulbs]
+        self.assertTrue(wait_for(lambda: brightness() == [37, 37]))
+        self.controller.apply_scene(self.ips, { 'bright' : 20 })
+        self.controller.deploy_policy([{ 'bulb_ip' : self.ips[:1], 'policies' : [
+            { 'bright_time' : '00:00:00', 'dark_time' : '23:59:59', 'const_brightness' : 66 }] }])
+        self.assertTrue(wait_for(lambda: brightness()[0] == 66))
+        time.sleep(0.3)
+        # the other bulb left the policy and keeps its scene
+        self.assertEqual(brightness(), [66, 20])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+# Checks of the controller's metrics.
+#
+# Usage: python -m unittest discover -s tests
+
+import os
+import sys
+import imp
+import time
+import logging
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from YeelightWifiBulbLanCtrl import bulb_registry, connection_pool
+from bulb_simulator import BulbSimulator
+
+controller_module = imp.load_source('smart_controller', os.path.join(ROOT, 'smart-controller.py'))
+
+def gauge(text, name):
+    for line in text.splitlines():
+        if line.startswith(name + ' '):
+            return float(line.split()[1])
+
+class OnlineBulbsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = BulbSimulator(3, network = '127.12.0.0').start()
+        now = time.time()
+        # seen just now; not seen for an hour; not seen for an hour but connected
+        bulb_registry.clear()
+        bulb_registry.restore([{ 'id' : bulb.id, 'ip' : bulb.ip, 'port' : bulb.port, 'support' : ['set_bright'],
+                                 'last_seen' : last_seen }
+                               for bulb, last_seen in zip(self.simulator.bulbs, (now, now - 3600, now - 3600))])
+        connection_pool.open(self.simulator.bulbs[2].ip, self.simulator.bulbs[2].port)
+        self.controller = controller_module.SmartYeelight(logging_level = logging.ERROR, latitude = 0, longitude = 0,
+                                                          sun_time_cache_file = None, run_discovery = False)
+
+    def tearDown(self):
+        connection_pool.close_all()
+        bulb_registry.clear()
+        self.simulator.stop()
+
+    def test_online_and_known(self):
+        metrics = self.controller.get_metrics()
+        self.assertEqual(gauge(metrics, 'yeelight_bulbs_known'), 3)
+        self.assertEqual(gauge(metrics, 'yeelight_bulbs_online'), 2)
+        self.assertEqual(sorted(self.controller.get_online_bulbs()),
+                         sorted([self.simulator.bulbs[0].ip, self.simulator.bulbs[2].ip]))
+        self.assertEqual(self.controller.get_status()['bulbs_online'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+# Checks of the policy expression parser, which replaced eval() of "$var$ - 3600" values.
+#
+# Usage: python -m unittest discover -s tests
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from policy_expr import parse, evaluate, ExpressionCache, ExpressionError
+
+def value(text, variables = {}, resolve_time = None):
+    return evaluate(parse(text), variables, resolve_time)
+
+class ExpressionTest(unittest.TestCase):
+
+    def test_precedence(self):
+        self.assertEqual(value('1 + 2 * 3'), 7)
+        self.assertEqual(value('(1 + 2) * 3'), 9)
+        self.assertEqual(value('2 - 3 - 4'), -5)
+        self.assertEqual(value('8 / 2 / 2'), 2)
+        self.assertEqual(value('-2 * 3 + 10'), 4)
+        self.assertEqual(value('--5'), 5)
+        self.assertEqual(value('10 - -5'), 15)
+
+    def test_durations(self):
+        self.assertEqual(value('1h30m'), 5400)
+        self.assertEqual(value('90s + 1m'), 150)
+        self.assertEqual(value('0.5h'), 1800)
+
+    def test_variables_and_functions(self):
+        variables = { 'sunset' : 1000, 'sunrise' : 400 }
+        self.assertEqual(value('$sunset$ - 3600', variables), 1000 - 3600)
+        self.assertEqual(value('min($sunset$, $sunrise$ + 1m)', variables), 460)
+        self.assertEqual(value('max($sunset$, 1, 2000)', variables), 2000)
+
+    def test_times_of_day(self):
+        resolve_time = lambda hour, minute, second: hour * 3600 + minute * 60 + second
+        self.assertEqual(value('23:00', resolve_time = resolve_time), 23 * 3600)
+        self.assertEqual(value('01:30:15 + 1h', resolve_time = resolve_time), 2 * 3600 + 30 * 60 + 15)
+        self.assertRaises(ExpressionError, value, '23:00')
+
+    def test_errors(self):
+        self.assertRaises(ExpressionError, value, '$nosuch$')
+        self.assertRaises(ExpressionError, parse, 'floor(1)')
+        self.assertRaises(ExpressionError, parse, '(1 + 2')
+        self.assertRaises(ExpressionError, parse, '1 + 2)')
+        self.assertRaises(ExpressionError, parse, '1 +')
+        self.assertRaises(ExpressionError, parse, '1 2')
+        self.assertRaises(ExpressionError, parse, '1 # 2')
+        self.assertRaises(ExpressionError, parse, '')
+        self.assertTrue(issubclass(ExpressionError, ValueError))
+
+    def test_no_python(self):
+        # policy files are data: nothing but arithmetic on numbers, durations, times and variables
+        for text in ('__import__("os").system("true")', '().__class__', 'open("/etc/passwd")', '$sunset$.real',
+                     'lambda: 1', '1 if 1 else 2', '"abc"', '[1][0]'):
+            self.assertRaises(ExpressionError, parse, text)
+
+    def test_cache(self):
+        cache = ExpressionCache()
+        self.assertIs(cache.compile('$a$ + 1'), cache.compile('$a$ + 1'))
+        self.assertEqual(cache.evaluate('$a$ + 1', { 'a' : 1 }), 2)
+        self.assertEqual(cache.evaluate('$a$ + 1', { 'a' : 5 }), 6)
+
+if __name__ == '__main__':
+    unittest.main()
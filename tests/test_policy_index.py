@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# Checks of PolicyIndex, the segment table calculate_light_brightness looks brightness up in.
+#
+# Usage: python -m unittest discover -s tests
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from policy_index import PolicyIndex
+
+class PolicyIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = PolicyIndex([
+            { 'bright_time' : 100, 'dark_time' : 200, 'const_brightness' : 30 },
+            # overlaps the first policy, which wins on [150, 200]
+            { 'bright_time' : 150, 'dark_time' : 300, 'const_brightness' : 60 },
+            # a ramp from 10 (plus min_brightness) at 1000 to 90 at 1800
+            { 'bright_time' : 1000, 'dark_time' : 1800, 'min_brightness' : 10, 'max_brightness' : 90 },
+        ])
+
+    def brightness(self, t):
+        return self.index.lookup(t)[0]
+
+    def test_closed_ranges(self):
+        self.assertEqual(self.brightness(99.999), -1)
+        self.assertEqual(self.brightness(100), 30)
+        self.assertEqual(self.brightness(200), 30)
+        self.assertEqual(self.brightness(200.001), 60)
+        self.assertEqual(self.brightness(300), 60)
+        self.assertEqual(self.brightness(300.001), -1)
+        self.assertEqual(self.brightness(5000), -1)
+
+    def test_first_policy_wins(self):
+        self.assertEqual(self.brightness(150), 30)
+        self.assertEqual(self.index.lookup(175)[1]['const_brightness'], 30)
+
+    def test_ramp(self):
+        self.assertEqual(self.brightness(1000), 20)
+        self.assertEqual(self.brightness(1400), 60)
+        self.assertEqual(self.brightness(1800), 100)
+        self.assertEqual(self.index.ramp(1400), (1800, 100))
+        self.assertIsNone(self.index.ramp(150))
+        self.assertIsNone(self.index.ramp(1000))
+
+    def test_next_change(self):
+        self.assertEqual(self.index.next_change(0), 100)
+        self.assertEqual(self.index.next_change(100), 100 + 1e-6)
+        self.assertEqual(self.index.next_change(120), 150)
+        self.assertEqual(self.index.next_change(250), 300)
+        self.assertEqual(self.index.next_change(400), 1000)
+        self.assertIsNone(self.index.next_change(1800))
+        self.assertIsNone(self.index.next_change(5000))
+
+    def test_next_change_of_a_ramp(self):
+        # the first whole second at which the ramp shows another value, found by scanning
+        for t in (1000.5, 1003, 1399.2, 1795):
+            current = self.brightness(t)
+            expected = int(t) + 1
+            while expected < 1800 and self.brightness(expected) == current:
+                expected += 1
+            self.assertEqual(self.index.next_change(t), min(expected, 1800))
+
+    def test_empty(self):
+        index = PolicyIndex([])
+        self.assertEqual(index.lookup(0), (-1, None))
+        self.assertIsNone(index.next_change(0))
+
+if __name__ == '__main__':
+    unittest.main()
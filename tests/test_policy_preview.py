@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+# Checks of the vectorized policy preview against the policy evaluation of a tick.
+#
+# Usage: python -m unittest discover -s tests
+
+import os
+import sys
+import imp
+import time
+import random
+import logging
+import unittest
+from datetime import datetime, timedelta
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from policy_preview import numpy
+
+LIGHT_POLICY = [{
+    'bulb_ip' : ['192.168.2.31'],
+    'policies' : [
+        { 'dark_time' : '00:00:00', 'bright_time' : '01:30:00', 'max_brightness' : 40, 'min_brightness' : 1 },
+        { 'bright_time' : '01:30:00', 'dark_time' : '$sunrise$', 'const_brightness' : 0 },
+        { 'bright_time' : '$civil_twilight_end$ - 3600', 'dark_time' : '$sunset$' },
+        { 'bright_time' : '$sunrise$', 'dark_time' : '$sunset$', 'const_brightness' : 0 },
+        { 'bright_time' : '$civil_twilight_end$', 'dark_time' : '23:00:00', 'const_brightness' : 100 },
+        { 'dark_time' : '23:00:00', 'bright_time' : '23:59:59', 'max_brightness' : 100, 'min_brightness' : 40 },
+    ],
+}]
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class PreviewEquivalenceTest(unittest.TestCase):
+    # the batch preview and a policy tick must agree at any instant, DST changes included
+
+    @classmethod
+    def setUpClass(cls):
+        cls.saved_tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'America/New_York'
+        time.tzset()
+        # the controller takes its local timezone when it is loaded
+        cls.module = imp.load_source('smart_controller_new_york', os.path.join(ROOT, 'smart-controller.py'))
+        cls.controller = cls.module.SmartYeelight(logging_level = logging.ERROR, latitude = 40.71, longitude = -74.01,
+                                                  sun_time_cache_file = None)
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.saved_tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = cls.saved_tz
+        time.tzset()
+
+    def test_random_instants(self):
+        local_tz = self.module.LOCAL_TZ
+        start = datetime(2026, 1, 1, tzinfo = local_tz)
+        rng = random.Random(2026)
+        for i in range(300):
+            t = start + timedelta(seconds = rng.randint(0, 365 * 86400 - 1))
+            times, brightness = self.controller.preview_light_brightness(t, t + timedelta(seconds = 1), 1, LIGHT_POLICY)
+            result = self.controller.calculate_light_brightness(t, LIGHT_POLICY)
+            expected = result[0]['calculated_brightness'] if result else -1
+            self.assertEqual(brightness['192.168.2.31'][0], expected, "at %s" % t)
+
+if __name__ == '__main__':
+    unittest.main()
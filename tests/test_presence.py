@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+# Checks of the in-process presence prober and of its options.
+#
+# Usage: python -m unittest discover -s tests
+
+import os
+import sys
+import time
+import threading
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import presence
+from presence import PresenceProber, check_probe_options
+from YeelightWifiBulbLanCtrl import EventLoop
+
+DEVICE = '10.77.0.1'
+
+class ArpPresenceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_read_arp_table = presence.read_arp_table
+        self.arp_table = {}
+        presence.read_arp_table = lambda: self.arp_table
+        self.changes = []
+        self.changed = threading.Event()
+        self.loop = EventLoop()
+        self.thread = threading.Thread(target = self.loop.run_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.prober.stop)
+        self.loop.stop()
+        self.thread.join(5)
+        self.loop.close()
+        presence.read_arp_table = self.saved_read_arp_table
+
+    def on_change(self, ip, online):
+        self.changes.append((ip, online))
+        self.changed.set()
+
+    def start(self, **options):
+        # rounds every 50 ms, each probe gives up after 10 ms
+        self.prober = PresenceProber(interval = 0.05, timeout = 0.01, methods = ('arp',), on_change = self.on_change,
+                                     **options)
+        self.prober.add(DEVICE)
+        self.loop.call_soon_threadsafe(self.prober.start, self.loop)
+
+    def test_arp_table_entry_is_a_hit(self):
+        self.start()
+        self.arp_table[DEVICE] = '00:11:22:33:44:55'
+        self.assertTrue(self.changed.wait(2))
+        self.assertEqual(self.changes, [(DEVICE, True)])
+        self.assertTrue(self.prober.is_online(DEVICE))
+
+    def test_online_threshold(self):
+        self.arp_table[DEVICE] = '00:11:22:33:44:55'
+        start = time.time()
+        self.start(online_threshold = 3)
+        self.assertTrue(self.changed.wait(2))
+        # the first round runs right away, the third 100 ms later
+        self.assertGreaterEqual(time.time() - start, 0.09)
+        self.assertEqual(self.changes, [(DEVICE, True)])
+
+    def test_offline_after_misses(self):
+        self.start(offline_delay = 2, retry_delay = 0.01)
+        self.arp_table[DEVICE] = '00:11:22:33:44:55'
+        self.assertTrue(self.changed.wait(2))
+        self.changed.clear()
+        del self.arp_table[DEVICE]
+        self.assertTrue(self.changed.wait(2))
+        self.assertEqual(self.changes, [(DEVICE, True), (DEVICE, False)])
+
+class ProbeOptionsTest(unittest.TestCase):
+
+    def test_valid(self):
+        options = check_probe_options({ 'methods' : ['icmp', 'arp'], 'online_threshold' : 2, 'tcp_ports' : [80] })
+        self.assertEqual(options, { 'methods' : ('icmp', 'arp'), 'online_threshold' : 2, 'tcp_ports' : (80,) })
+
+    def test_invalid(self):
+        for options in ({ 'methods' : ['ping'] }, { 'methods' : 'arp' }, { 'methods' : [] }, { 'online_threshold' : 0 },
+                        { 'backoff' : -1 }, { 'tcp_ports' : [70000] }, { 'interval' : 5 }):
+            self.assertRaises(ValueError, check_probe_options, options)
+        self.assertRaises(ValueError, PresenceProber, methods = ('icmp', 'dns'))
+
+    def test_configure(self):
+        prober = PresenceProber()
+        prober.configure(methods = ['arp'], backoff = 3)
+        self.assertEqual((prober.methods, prober.backoff), (('arp',), 3))
+        self.assertRaises(ValueError, prober.configure, methods = ['arp'], backoff = 0)
+        self.assertEqual((prober.methods, prober.backoff), (('arp',), 3))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+# Checks of the state snapshot file and of the controller restoring from it.
+#
+# Usage: python -m unittest discover -s tests
+
+import os
+import sys
+import imp
+import time
+import shutil
+import logging
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from state_snapshot import Snapshot, SnapshotError, write_snapshot
+from YeelightWifiBulbLanCtrl import bulb_registry, connection_pool
+from bulb_simulator import BulbSimulator
+
+controller_module = imp.load_source('smart_controller', os.path.join(ROOT, 'smart-controller.py'))
+
+GONE_IP = '127.15.1.1'
+
+def wait_for(condition, timeout = 2):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+class SnapshotFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'state', 'snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        write_snapshot(self.path, [('bulbs', [{ 'id' : '0x1', 'bright' : 31 }]), ('geo', None)])
+        with Snapshot(self.path) as snapshot:
+            self.assertEqual(sorted(snapshot.names()), ['bulbs', 'geo'])
+            self.assertEqual(snapshot.get('bulbs'), [{ 'id' : '0x1', 'bright' : 31 }])
+            self.assertEqual(snapshot.get('geo', 'none'), None)
+            self.assertEqual(snapshot.get('policy', 'none'), 'none')
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['snapshot'])
+
+    def test_damaged(self):
+        write_snapshot(self.path, { 'bulbs' : [{ 'id' : '0x1' }] })
+        with open(self.path, 'rb') as snapshot_file:
+            data = snapshot_file.read()
+        for damaged in (data[:10], 'X' + data[1:], data[:-4], data[:-4] + '}}}}'):
+            with open(self.path, 'wb') as snapshot_file:
+                snapshot_file.write(damaged)
+            def read():
+                with Snapshot(self.path) as snapshot:
+                    snapshot.get('bulbs')
+            self.assertRaises(SnapshotError, read)
+
+class RestoreTest(unittest.TestCase):
+
+    def setUp(self):
+        bulb_registry.clear()
+        self.simulator = BulbSimulator(1, network = '127.15.0.0').start()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'snapshot')
+        live = self.simulator.bulbs[0]
+        seen = time.time() - 600
+        write_snapshot(self.path, [('bulbs', [
+            { 'id' : live.id, 'ip' : live.ip, 'port' : live.port, 'support' : ['set_bright'], 'bright' : 50, 'last_seen' : seen },
+            { 'id' : 'gone', 'ip' : GONE_IP, 'port' : 55443, 'support' : ['set_bright'], 'bright' : 50, 'last_seen' : seen }])])
+        # no discovery: a restored bulb can only be seen again over its connection
+        self.controller = controller_module.SmartYeelight(logging_level = logging.ERROR, latitude = 0, longitude = 0,
+                                                          sun_time_cache_file = None, run_discovery = False,
+                                                          snapshot_file = self.path, snapshot_revalidate = 0.5)
+
+    def tearDown(self):
+        self.controller.stop()
+        bulb_registry.clear()
+        self.simulator.stop()
+        shutil.rmtree(self.directory)
+
+    def test_bulbs_that_answer_are_kept(self):
+        live = self.simulator.bulbs[0]
+        self.assertEqual(sorted([bulb.ip for bulb in bulb_registry]), sorted([live.ip, GONE_IP]))
+        self.controller.start(daemon = True)
+        # the state synced on connect is the only answer of the bulb
+        connection_pool.open(live.ip, live.port)
+        self.assertTrue(wait_for(lambda: bulb_registry.get_by_ip(GONE_IP) is None))
+        self.assertNotEqual(bulb_registry.get_by_ip(live.ip), None)
+        self.controller.save_snapshot()
+        with Snapshot(self.path) as snapshot:
+            bulbs = snapshot.get('bulbs')
+        self.assertEqual([bulb['ip'] for bulb in bulbs], [live.ip])
+        self.assertGreater(bulbs[0]['last_seen'], time.time() - 5)
+
+if __name__ == '__main__':
+    unittest.main()